@@ -4,14 +4,20 @@ from datetime import datetime
 from optparse import OptionParser
 from sys import stderr
 
+import hashlib
+import io
 import os
 import socket
 import spark_ec2
 import subprocess
 import sys
-import boto
+import threading
 import time
 
+# S3 transfers are split in parts of this size, up to S3_THREADS of them in flight
+S3_PART_SIZE = 32 * 1024 * 1024
+S3_THREADS = 8
+
 def get_opt_parser():
     parser = OptionParser(
         prog="launch_ec2_trainer",
@@ -37,15 +43,23 @@ def get_opt_parser():
     parser.add_option(
         "--stop-cluster", action="store_true", default=False,
         help="Whether to stop the aws cluster after training")
+    parser.add_option(
+        "--warm-pool", action="store_true", default=False,
+        help="Park the aws cluster after training: stop its set up master and terminate its " +
+             "slaves. A parked cluster is started by launching only slaves and setting it " +
+             "up without installing its modules again")
     parser.add_option(
         "--train-date", default="",
         help="Override the date of train set")
     parser.add_option(
-        "--num-slaves", default=18,
+        "--num-slaves", type="int", default=18,
         help="Number of slave nodes to create in the aws cluster")
     parser.add_option(
         "--work-dir", default="/home/hduser/spark-ec2/launch-script",
         help="Working directory. Must contain spark.pem for connecting AWS servers")
+    parser.add_option(
+        "--poll-interval", type="int", default=10,
+        help="Seconds between checks for the done file on S3 while training runs")
     return parser
 
 
@@ -68,171 +82,378 @@ def can_acquire_lock(lock_name):
         return False
 
 
-def launch_aws_cluster(conn, our_opts, ec2_opts):
-    (master_nodes, slave_nodes) = spark_ec2.launch_cluster(conn, ec2_opts, our_opts.cluster_name)
-    spark_ec2.wait_for_cluster_state(
-        conn=conn,
-        opts=ec2_opts,
-        cluster_instances=(master_nodes + slave_nodes),
-        cluster_state='ssh-ready'
-    )
-    spark_ec2.setup_cluster(conn, master_nodes, slave_nodes, ec2_opts, True)
-    return master_nodes
-
+def check_cluster_health(cluster, num_nodes, tries=3):
+    """
+    Check that the cluster's master and all but at most one of its num_nodes slaves are
+    healthy (see spark_ec2.probe_cluster_health). Unhealthy slaves are repaired, and
+    the cluster is only set up again if its master has problems.
+    """
+    delay = 30  # seconds
+    for n in range(tries):
+        health = cluster.health()
+        unhealthy = dict((address, result) for (address, result) in health["slaves"].items()
+                         if result["problems"])
+        for (address, result) in sorted(unhealthy.items()):
+            print("{a}: {p}".format(a=address, p=", ".join(result["problems"])))
+        for problem in health["master"]["problems"]:
+            print("master: {p}".format(p=problem))
+        healthy = len(health["slaves"]) - len(unhealthy)
+        # Ok if one slave is down
+        if not health["master"]["problems"] and healthy >= num_nodes - 1:
+            return True
+        if n == tries - 1:
+            break
+        if health["master"]["problems"]:
+            print("The master is not healthy. Running setup script..")
+            cluster.setup()
+        else:
+            (restarted, replaced) = ([], [])
+            if unhealthy:
+                print("{n} slaves are not healthy. Repairing them..".format(n=len(unhealthy)))
+                (restarted, replaced) = cluster.repair(health)
+            missing = num_nodes - len(health["slaves"])
+            if missing > 0:
+                print("The cluster is {m} slaves short. Adding them..".format(m=missing))
+                cluster.add_slaves(missing)
+            if restarted:
+                # Give the restarted daemons time to register with the master
+                time.sleep(delay)
+                delay *= 2
+    return False
+
+
+def get_hdfs_stat(opts, path):
+    """
+    Get (size in bytes, whether it is a directory, modification time) of path on HDFS,
+    or None if it doesn't exist. The size of a directory is that of all its files.
+    """
+    try:
+        output = subprocess.check_output([opts.hadoop_cmd, "fs", "-stat", "%b %F %y", path])
+    except subprocess.CalledProcessError:
+        return None
+    fields = output.decode("utf-8").split()
+    size = int(fields[0])
+    is_dir = fields[1] == "directory"
+    mtime = datetime.strptime(" ".join(fields[-2:]), "%Y-%m-%d %H:%M:%S")
+    if is_dir:
+        size = int(subprocess.check_output([opts.hadoop_cmd, "fs", "-du", "-s", path]).split()[0])
+    return (size, is_dir, mtime)
+
+
+def get_trainset(opts):
+    print("Checking training input at {input} on HDFS..".format(input=opts.input))
+    trainset = get_hdfs_stat(opts, opts.input)
+    if trainset is None:
+        print("{input} doesn't exist on HDFS! Unable to continue.".format(input=opts.input))
+        sys.exit(1)
+    return trainset
 
-def ssh_args(opts):
-    parts = ['-o', 'StrictHostKeyChecking=no']
-    parts += ['-o', 'UserKnownHostsFile=/dev/null']
-    if opts.identity_file is not None:
-        parts += ['-i', opts.identity_file]
-    return parts
 
+def get_s3_size(bucket, key_name):
+    """
+    Size of the key, or of all the keys under key_name/ if it is a directory written by
+    distcp. None if there is neither.
+    """
+    key = bucket.get_key(key_name)
+    if key is not None:
+        return key.size
+    keys = list(bucket.list(prefix=key_name + "/"))
+    if not keys:
+        return None
+    return sum(k.size for k in keys)
 
-def ssh_command(opts):
-    return ['ssh'] + ssh_args(opts)
 
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
 
-def stringify_command(parts):
-    if isinstance(parts, str):
-        return parts
-    else:
-        return ' '.join(map(pipes.quote, parts))
 
-def check_yarn_service(master, ec2_opts, num_nodes):
+def file_etag(path, part_size):
+    """
+    The ETag S3 gives the content of the local file path uploaded in parts of part_size
+    bytes: the md5 of the md5s of the parts, followed by "-" and the number of parts.
+    """
+    md5s = []
+    with open(path, "rb") as f:
+        while True:
+            md5 = hashlib.md5()
+            left = part_size
+            while left > 0:
+                chunk = f.read(min(left, 1024 * 1024))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                left -= len(chunk)
+            if left == part_size:
+                break
+            md5s.append(md5.digest())
+    return "{m}-{n}".format(m=hashlib.md5(b"".join(md5s)).hexdigest(), n=len(md5s))
+
+
+def match_etag(key, path):
+    """
+    Whether the local file path has the content of key, as told by the key's ETag, or
+    None if that can't be told. The ETag of a key uploaded in parts is made of the md5s
+    of its parts, so it can only be checked if the part size is known: parts of
+    S3_PART_SIZE (which upload_to_s3() uses) and the key's size split evenly into its
+    number of parts, rounded up to a MB, are tried.
     """
-    Check whether all the node managers are running
+    etag = key.etag.strip('"')
+    if "-" not in etag:
+        return file_md5(path) == etag
+    parts = int(etag.split("-")[1])
+    mb = 1024 * 1024
+    for part_size in [S3_PART_SIZE, -(-key.size // (parts * mb)) * mb]:
+        if -(-key.size // part_size) == parts and file_etag(path, part_size) == etag:
+            return True
+    return None
+
+
+def has_key_content(key, path):
     """
-    output = spark_ec2.ssh_read(master, ec2_opts, "/root/ephemeral-hdfs/bin/yarn node -list -all |grep RUNNING |wc -l")
-    # Ok if one slave is down
-    return int(output) >= int(num_nodes) - 1
+    Whether the local file path is known to have the content of key, from its size and
+    ETag (see match_etag()).
+    """
+    return os.path.getsize(path) == key.size and match_etag(key, path) is True
+
+
+def with_retries(func, tries=3):
+    for attempt in range(tries):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == tries - 1:
+                raise
+            print("S3 request failed, retrying: {e}".format(e=e), file=stderr)
+            time.sleep(2 ** attempt)
 
 
-def check_hdfs_service(master, ec2_opts, num_nodes):
+def upload_to_s3(fp, size, bucket, key_name):
     """
-    Check whether all the HDFS nodes (data nodes) are running.
+    Upload the size bytes read from fp (e.g. the output of `hadoop fs -cat`) to key_name.
+    Larger uploads are split in parts, which are uploaded by up to S3_THREADS threads
+    while the next parts are being read. Nothing is left on S3 if fp doesn't have
+    exactly size bytes.
     """
-    output = spark_ec2.ssh_read(master, ec2_opts, "/root/ephemeral-hdfs/bin/hdfs dfsadmin -report|grep Name |wc -l")
-    # Ok if one slave is down
-    return int(output) >= int(num_nodes) - 1
-
-# Run a command on a host through ssh, retrying up to five times
-# and then throwing an exception if ssh continues to fail.
-def ssh(host, opts, command):
-    tries = 0
-    while True:
-        try:
-            return subprocess.check_call(
-                ssh_command(opts) + ['-t', '-t', '%s@%s' % (opts.user, host),
-                                     stringify_command(command)])
-        except subprocess.CalledProcessError as e:
-            if tries > 5:
-                # If this was an ssh failure, provide the user with hints.
-                if e.returncode == 255:
-                    raise UsageError(
-                        "Failed to SSH to remote host {0}.\n"
-                        "Please check that you have provided the correct --identity-file and "
-                        "--key-pair parameters and try again.".format(host))
-                else:
-                    raise e
-            print("Error executing remote command, retrying after 30 seconds: {0}".format(e),
-                  file=stderr)
-            time.sleep(30)
-            tries = tries + 1
-
-def get_trainset_date(opts):
+    if size <= S3_PART_SIZE:
+        data = fp.read()
+        if len(data) != size:
+            raise IOError("Expected {s} bytes for {k}, got {n}".format(
+                s=size, k=key_name, n=len(data)))
+        with_retries(lambda: bucket.new_key(key_name).set_contents_from_string(data))
+        return
+    upload = bucket.initiate_multipart_upload(key_name)
     try:
-        print("Checking training input at {input} on HDFS..".format(input=opts.input))
-        train_date_str = subprocess.check_output([opts.hadoop_cmd, "fs", "-stat", opts.input]).rstrip()
-        train_date = datetime.strptime(train_date_str, "%Y-%m-%d %H:%M:%S")
-    except subprocess.CalledProcessError:
-        print("{input} doesn't exist on HDFS! Unable to continue.".format(input=opts.input))
-        sys.exit(1)
-    return train_date
-
-def launch_copy_input(opts):
-    trainset_date = get_trainset_date(opts)
-    # run distcp to copy training data to S3
-    s3_folder_path = "s3n://" + opts.s3_folder
-    s3_input_prefix = s3_folder_path + "/" + trainset_date.strftime("%Y%m%d")
-    if subprocess.call([opts.hadoop_cmd, "distcp", opts.input, s3_input_prefix + "/withpubs_pricer.gz"]) != 0:
-        print("distcp failed!")
+        # Also bounds the number of parts held in memory
+        slots = threading.BoundedSemaphore(S3_THREADS)
+        errors = []
+        threads = []
+
+        def upload_part(part_num, data):
+            try:
+                with_retries(lambda: upload.upload_part_from_file(io.BytesIO(data), part_num))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                slots.release()
+
+        num_read = 0
+        while num_read < size and not errors:
+            data = fp.read(min(S3_PART_SIZE, size - num_read))
+            if not data:
+                break
+            num_read += len(data)
+            slots.acquire()
+            thread = threading.Thread(target=upload_part, args=(len(threads) + 1, data))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        if num_read != size or fp.read(1):
+            raise IOError("Expected {s} bytes for {k}, got a different amount".format(
+                s=size, k=key_name))
+        upload.complete_upload()
+    except:
+        upload.cancel_upload()
+        raise
+
+
+def download_from_s3(key, path):
+    """
+    Download key to the local file path with up to S3_THREADS parallel ranged GETs,
+    unless path has its content already.
+    """
+    if os.path.isfile(path) and has_key_content(key, path):
+        print("{p} is up to date with s3://{b}/{k}".format(p=path, b=key.bucket.name, k=key.name))
+        return
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.truncate(key.size)
+
+    def download_range(start):
+        end = min(start + S3_PART_SIZE, key.size) - 1
+        with open(tmp_path, "r+b") as f:
+            def get_range():
+                f.seek(start)
+                key.bucket.new_key(key.name).get_contents_to_file(
+                    f, headers={"Range": "bytes=%d-%d" % (start, end)})
+            with_retries(get_range)
+
+    spark_ec2.parallel_map(download_range, range(0, key.size, S3_PART_SIZE), S3_THREADS)
+    # Keys uploaded in parts of an unknown size can only be checked by their size
+    if os.path.getsize(tmp_path) != key.size or match_etag(key, tmp_path) is False:
+        os.remove(tmp_path)
+        raise IOError("Downloaded s3://{b}/{k} doesn't match its size or ETag".format(
+            b=key.bucket.name, k=key.name))
+    os.rename(tmp_path, path)
+
+
+def launch_copy_input(bucket, trainset, opts):
+    (size, is_dir, mtime) = trainset
+    key_name = get_s3_key_name(opts, mtime.strftime("%Y%m%d"), "withpubs_pricer.gz")
+    if is_dir:
+        # run distcp to copy training data to S3
+        s3_path = "s3n://{b}/{k}".format(b=bucket.name, k=key_name)
+        if subprocess.call([opts.hadoop_cmd, "distcp", opts.input, s3_path]) != 0:
+            print("distcp failed!")
+            sys.exit(1)
+        print("Distcp finished!\n")
+        return
+    # A single file is streamed out of HDFS and uploaded from here, rather than having
+    # distcp run a MapReduce job for it
+    print("Uploading {input} to s3://{b}/{k}..".format(input=opts.input, b=bucket.name, k=key_name))
+    proc = subprocess.Popen([opts.hadoop_cmd, "fs", "-cat", opts.input], stdout=subprocess.PIPE)
+    try:
+        upload_to_s3(proc.stdout, size, bucket, key_name)
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode != 0:
+        print("Reading {input} from HDFS failed!".format(input=opts.input))
         sys.exit(1)
-    print("Distcp finished!\n")
+    print("Upload finished!\n")
 
 
-def check_trainset_on_s3(opts):
+def check_trainset_on_s3(bucket, trainset, opts):
     """
     Check whether train set on s3 is present and appeared to be the same as the trainset on HDFS.
-    Returns True if the two directories are identical.
+    Returns True if both have the same size.
     """
-    trainset_date = get_trainset_date(opts)
-    s3_path = "s3n://" + opts.s3_folder + "/" + trainset_date.strftime("%Y%m%d") + "/withpubs_pricer.gz"
-    if run_cmd("{hadoop} fs -test -d {s3_path}".format(hadoop=opts.hadoop_cmd, s3_path=s3_path)) != 0:
+    (input_size, is_dir, mtime) = trainset
+    s3_size = get_s3_size(bucket, get_s3_key_name(opts, mtime.strftime("%Y%m%d"), "withpubs_pricer.gz"))
+    if s3_size is None:
         return False
-    if run_cmd("{hadoop} fs -test -d {input}".format(hadoop=opts.hadoop_cmd, input=opts.input)) != 0:
-        print("Trainset {input} is not found!".format(input=opts.input))
-        sys.exit(1)
-    input_size = subprocess.check_output("{hadoop} fs -du -s {input}".format(hadoop=opts.hadoop_cmd, input=opts.input).split()).split()[0]
-    s3_size = subprocess.check_output("{hadoop} fs -du -s {s3_path}".format(hadoop=opts.hadoop_cmd, s3_path=s3_path).split()).split()[0]
     if input_size != s3_size:
         print("Input trainset size: {input_size}, trainset size on S3: {s3_size}".format(input_size=input_size, s3_size=s3_size))
         return False
     else:
         return True
-    
 
-def launch_training_job(master_nodes, trainset_date, opts, ec2_opts):
+
+def copy_model_from_s3(bucket, trainset_date, opts):
+    """
+    Copy the model the trainer wrote to S3 to --model-file on HDFS, through a local copy
+    in the work dir. The local copy is only downloaded again if its content changed,
+    but HDFS always gets it: --model-file is the same path every day, so the model of
+    another day can be there with the same size.
+    """
+    key = bucket.get_key(get_s3_key_name(opts, trainset_date, opts.model_file))
+    if key is None:
+        print("Model file {m} not found on S3!".format(m=opts.model_file))
+        sys.exit(1)
+    download_from_s3(key, opts.model_file)
+    if run_cmd("{hadoop} fs -put -f {model} {model}".format(hadoop=opts.hadoop_cmd, model=opts.model_file)):
+        print("Copying model to HDFS failed!")
+        sys.exit(1)
+
+
+def launch_training_job(cluster, trainset_date):
     # TODO: check whether HDFS is running
     # TODO: check whether YARN is running
     """Launch a training job on spark cluster."""
-    master = master_nodes[0].public_dns_name
     print("Setting up HDFS on the cluster..")
-    ssh(host=master, opts=ec2_opts, command="chmod u+x /root/spark-ec2/setup_pricer_data.sh")
-    ssh(host=master, opts=ec2_opts, command="/root/spark-ec2/setup_pricer_data.sh")
+    cluster.ssh("chmod u+x /root/spark-ec2/setup_pricer_data.sh")
+    cluster.ssh("/root/spark-ec2/setup_pricer_data.sh")
     print("Running trainer with train date={d}..".format(d=trainset_date))
-    ssh(host=master, opts=ec2_opts, command="chmod u+x /root/spark-ec2/run_aws_trainer.sh")
-    ssh(host=master, opts=ec2_opts, command="nohup /root/spark-ec2/run_aws_trainer.sh {d} 2>&1 </dev/null |tee log.aws_trainer".format(d=trainset_date))
+    cluster.ssh("chmod u+x /root/spark-ec2/run_aws_trainer.sh")
+    cluster.ssh("nohup /root/spark-ec2/run_aws_trainer.sh {d} 2>&1 </dev/null |tee log.aws_trainer".format(d=trainset_date))
     print("Trainer was launched successfully..")
-    
-def stop_aws_cluster(conn, opts, ec2_opts):
-    (master_nodes, slave_nodes) = spark_ec2.get_existing_cluster(conn, ec2_opts, opts.cluster_name, die_on_error=False)
-    print("Stopping master...")
-    for inst in master_nodes:
-        if inst.state not in ["shutting-down", "terminated"]:
-            inst.stop()
-    print("Stopping slaves...")
-    for inst in slave_nodes:
-        if inst.state not in ["shutting-down", "terminated"]:
-            if inst.spot_instance_request_id:
-                inst.terminate()
-            else:
-                inst.stop()
-    print("All instances stopped...")
-
-def get_boto_conn(ec2_opts):
-    try:
-        conn = boto.ec2.connect_to_region(ec2_opts.region)
-    except Exception as e:
-        print(repr(e), file=stderr)
-        sys.exit(1)
-    return conn
 
-def get_ec2_opts(opts):
-    launch_cmd = ("-k spark -i spark.pem --region=us-east-1 --zone=us-east-1d "
-                  "--instance-type=r3.4xlarge --spot-price=0.60  --spark-version=v1.5.0 "
-                  "--copy-aws-credentials --vpc-id=vpc-a39d60c7 --subnet-id=subnet-f5350dac "
-                  "--hadoop-major-version=yarn --ebs-vol-size=250 --ebs-vol-type=gp2 "
-                  "--spark-ec2-git-repo=https://github.com/lckung/spark-ec2 "
-                  "--use-existing-master --ami=ami-49cc9b2c --resume").split()
-    opt_parser = spark_ec2.get_parser()
-    (ec2_opts, args) = opt_parser.parse_args(args=launch_cmd)
-    ec2_opts.slaves = opts.num_slaves
-    return ec2_opts
 
+def get_cluster(opts):
+    """
+    The spark_ec2.Cluster the trainer runs on.
+    """
+    return spark_ec2.Cluster(
+        opts.cluster_name,
+        key_pair="spark",
+        identity_file="spark.pem",
+        region="us-east-1",
+        zone="us-east-1d",
+        instance_type="r3.4xlarge",
+        spot_price=0.60,
+        spark_version="v1.5.0",
+        copy_aws_credentials=True,
+        vpc_id="vpc-a39d60c7",
+        subnet_id="subnet-f5350dac",
+        hadoop_major_version="yarn",
+        ebs_vol_size=250,
+        ebs_vol_type="gp2",
+        spark_ec2_git_repo="https://github.com/lckung/spark-ec2",
+        use_existing_master=True,
+        ami="ami-49cc9b2c",
+        slaves=opts.num_slaves)
+
+
+def get_s3_bucket(opts):
+    """
+    The bucket of --s3-folder. Requests through it share one pooled S3 connection.
+    """
+    spark_ec2.setup_boto()
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    # Bucket names with dots (spark.data) don't match S3's certificate as host names
+    conn = S3Connection(calling_format=OrdinaryCallingFormat())
+    return conn.get_bucket(opts.s3_folder.split("/", 1)[0], validate=False)
+
+
+def get_s3_key_name(opts, *parts):
+    """
+    Name of the key for parts (e.g. date, file name) under --s3-folder in its bucket.
+    """
+    return "/".join(opts.s3_folder.split("/", 1)[1:] + list(parts))
 
-def has_done_file(trainset_date, opts):
-    return run_cmd("{hadoop} fs -stat s3n://{prefix}/{date}/{done_file}".format(
-        hadoop=opts.hadoop_cmd, prefix=opts.s3_folder, date=trainset_date, done_file=opts.done_file)) == 0
+
+def has_done_file(bucket, trainset_date, opts):
+    # A HEAD request, no need to start a hadoop client for that
+    return bucket.get_key(get_s3_key_name(opts, trainset_date, opts.done_file)) is not None
+
+
+def wait_for_done_file(bucket, trainset_date, opts):
+    """
+    Wait for the trainer on the cluster to write the done file, checking for it every
+    --poll-interval seconds. Failed checks are retried with exponential backoff.
+    """
+    from boto.exception import BotoClientError, BotoServerError
+    start_time = time.time()
+    delay = opts.poll_interval
+    while True:
+        try:
+            if has_done_file(bucket, trainset_date, opts):
+                break
+            delay = opts.poll_interval
+        except (BotoClientError, BotoServerError, socket.error) as e:
+            delay = min(delay * 2, 300)
+            print("Couldn't check for the done file, retrying in {d} seconds: {e}".format(
+                d=delay, e=e), file=stderr)
+        time.sleep(delay)
+    print("Done file detected after {m} minutes! Training job is done".format(
+        m=int(time.time() - start_time) // 60))
 
 
 def main():
@@ -245,74 +466,64 @@ def main():
         print("Setting work dir to {dir}".format(dir=opts.work_dir))
         os.chdir(opts.work_dir)
     # check if input is there
-    if not check_trainset_on_s3(opts):
-        launch_copy_input(opts)
+    trainset = get_trainset(opts)
+    bucket = get_s3_bucket(opts)
+    if not check_trainset_on_s3(bucket, trainset, opts):
+        launch_copy_input(bucket, trainset, opts)
     else:
         print("Skipping distcp step..")
 
-    ec2_opts = get_ec2_opts(opts)
-    conn = get_boto_conn(ec2_opts) 
+    cluster = get_cluster(opts)
     # launch an AWS cluster
     print("Checking whether there exists an aws cluster..")
-    master_nodes, slave_nodes = spark_ec2.get_existing_cluster(conn, ec2_opts, opts.cluster_name, die_on_error=False)
+    master_nodes, slave_nodes = cluster.refresh()
     
-    if slave_nodes:
+    if cluster.warm_pool() is not None:
+        print("Starting cluster {cluster} from its warm pool..".format(cluster=opts.cluster_name))
+        cluster.warm_start(opts.num_slaves)
+    elif slave_nodes:
         if master_nodes:
             print("Starting master...")
-            for inst in master_nodes:
-                if inst.state not in ["shutting-down", "terminated"]:
-                    inst.start()
+            spark_ec2.batch_instance_action(cluster.conn, cluster.opts, "start", [
+                i for i in master_nodes if i.state not in ["shutting-down", "terminated"]])
     
         print("Cluster {cluster} is already running".format(cluster=opts.cluster_name))
         print("Wait until the cluster is SSH-ready..")
-        spark_ec2.wait_for_cluster_state(
-            conn=conn,
-            opts=ec2_opts,
-            cluster_instances=(master_nodes + slave_nodes),
-            cluster_state='ssh-ready'
-        )
+        cluster.wait()
         print("Checking required service..")
-        setup_counts = 0
-        while not check_yarn_service(master_nodes[0].public_dns_name, ec2_opts, opts.num_slaves) or \
-        not check_hdfs_service(master_nodes[0].public_dns_name, ec2_opts, opts.num_slaves):
-            if setup_counts >= 1:
-                print("Yarn and HDFS still not ready after setup script. Something is wrong. Quitting..")
-                sys.exit(1)
-            print("Yarn service or HDFS is not ready. Running setup script..")
-            spark_ec2.setup_cluster(conn, master_nodes, slave_nodes, ec2_opts, True)
-            setup_counts += 1
+        if not check_cluster_health(cluster, opts.num_slaves):
+            print("Cluster still not healthy after repairing it. Something is wrong. Quitting..")
+            sys.exit(1)
     else:
         print("Launching aws cluster '{name}'..".format(name=opts.cluster_name))
-        master_nodes = launch_aws_cluster(conn, opts, ec2_opts)
+        cluster.launch()
+        cluster.wait()
+        cluster.setup()
     
     # launch the training job
     if opts.train_date == "":
-        trainset_date = get_trainset_date(opts).strftime("%Y%m%d")
+        trainset_date = trainset[2].strftime("%Y%m%d")
     else:
         trainset_date = opts.train_date
     
     print("Train date is set to {d}".format(d=trainset_date))
-    if not has_done_file(trainset_date, opts):
+    if not has_done_file(bucket, trainset_date, opts):
         print("Done file not detected. Launching training job on AWS cluster..")
-        launch_training_job(master_nodes, trainset_date, opts, ec2_opts)
+        launch_training_job(cluster, trainset_date)
         print("Waiting for training job..")
 
     # wait till training is done
-    while (True):
-        if has_done_file(trainset_date, opts):
-            print("Done file detected! Training job is done")
-            break
-        time.sleep(60)
-        print(".")
+    wait_for_done_file(bucket, trainset_date, opts)
     
-    # run distcp to copy the model back to S3 and bidderpath
-    if run_cmd("{hadoop} distcp s3n://{prefix}/{date}/{model_file} {model}".format(
-        hadoop=opts.hadoop_cmd, prefix=opts.s3_folder, date=trainset_date, model_file=opts.model_file, model=opts.model_file)):
-        print("distcp model back failed!")
-        sys.exit(1)
-    print("Model file distcp is done!")
-    if opts.stop_cluster:
-        stop_aws_cluster(conn, opts, ec2_opts)
+    # copy the model back from S3 to bidderpath
+    copy_model_from_s3(bucket, trainset_date, opts)
+    print("Model file copy is done!")
+    if opts.warm_pool:
+        cluster.park()
+        print("Master stopped and slaves terminated, the cluster is parked...")
+    elif opts.stop_cluster:
+        cluster.stop()
+        print("All instances stopped...")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Measure how long a cheap spark-ec2 action (get-master by default) takes, cold and warm.
+
+cold: like the first run after installing or upgrading spark-ec2. Python has no
+      compiled bytecode for spark_ec2 and its libraries, and the cluster state cache
+      is not used, so boto is imported and EC2 is asked for the cluster's instances.
+warm: like any later run. Everything is compiled and the master comes from the
+      cluster state cache (after one run to fill it, which is not counted).
+
+Cold runs talk to EC2, so they need credentials and an existing cluster.
+"""
+
+from __future__ import division, print_function, with_statement
+
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+SPARK_EC2_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def remove_bytecode():
+    for (dir_path, dir_names, file_names) in os.walk(SPARK_EC2_DIR):
+        for name in file_names:
+            if name.endswith((".pyc", ".pyo")):
+                os.remove(os.path.join(dir_path, name))
+
+
+def time_run(args):
+    start_time = time.time()
+    with open(os.devnull, "w") as devnull:
+        returncode = subprocess.call(args, stdout=devnull)
+    if returncode != 0:
+        print("ERROR: {c} exited with {r}".format(c=" ".join(args), r=returncode), file=sys.stderr)
+        sys.exit(1)
+    return time.time() - start_time
+
+
+def main():
+    parser = OptionParser(
+        usage="%prog [options] <cluster_name> [-- spark-ec2 options]",
+        description=__doc__.strip().split("\n")[0])
+    parser.add_option(
+        "--action", default="get-master",
+        help="spark-ec2 action to time (default: %default)")
+    parser.add_option(
+        "--runs", type="int", default=5,
+        help="Number of cold and of warm runs (default: %default)")
+    (opts, args) = parser.parse_args()
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+    command = [os.path.join(SPARK_EC2_DIR, "spark-ec2"), opts.action] + args
+
+    cold = []
+    for n in range(opts.runs):
+        remove_bytecode()
+        cold.append(time_run(command + ["--cache-ttl", "0"]))
+    time_run(command)
+    warm = [time_run(command) for n in range(opts.runs)]
+
+    print("{0:<6} {1:>8} {2:>8} {3:>8}".format("", "min (s)", "median", "max"))
+    for (name, times) in [("cold", cold), ("warm", warm)]:
+        times.sort()
+        print("{0:<6} {1:>8.3f} {2:>8.3f} {3:>8.3f}".format(
+            name, times[0], times[len(times) // 2], times[-1]))
+
+
+if __name__ == "__main__":
+    main()
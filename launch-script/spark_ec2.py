@@ -21,33 +21,34 @@
 
 from __future__ import division, print_function, with_statement
 
+import atexit
 import codecs
+import contextlib
+import copy
 import hashlib
-import itertools
+import json
 import logging
 import os
 import os.path
 import pipes
 import random
+import re
 import shutil
 import string
-from stat import S_IRUSR
+from stat import S_IRUSR, S_IRWXU
 import subprocess
 import sys
 import tarfile
 import tempfile
 import textwrap
+import threading
 import time
 import warnings
-from datetime import datetime
+from datetime import datetime, timedelta
 from optparse import OptionParser
 from sys import stderr
 
-if sys.version < "3":
-    from urllib2 import urlopen, Request, HTTPError
-else:
-    from urllib.request import urlopen, Request
-    from urllib.error import HTTPError
+if sys.version >= "3":
     raw_input = input
     xrange = range
 
@@ -95,32 +96,56 @@ SPARK_TACHYON_MAP = {
 DEFAULT_SPARK_VERSION = SPARK_EC2_VERSION
 DEFAULT_SPARK_GITHUB_REPO = "https://github.com/apache/spark"
 
+# Where spark-ec2 caches what it learned about clusters between runs
+SPARK_EC2_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".spark-ec2")
+
 # Default location to get the spark-ec2 scripts (and ami-list) from
 DEFAULT_SPARK_EC2_GITHUB_REPO = "https://github.com/amplab/spark-ec2"
 DEFAULT_SPARK_EC2_BRANCH = "branch-1.5"
 
+# Scripts of the spark-ec2 checkout this script is in that the default spark-ec2 repo
+# doesn't have. They are copied to the master's spark-ec2 directory along with the
+# deployed files, whichever --spark-ec2-git-repo was cloned there.
+LOCAL_SCRIPTS = ["resize-cluster.sh"]
+
+
+def import_urllib():
+    """
+    Get urlopen, Request and HTTPError. urllib takes a while to import and most
+    runs don't need it, so it is only imported when it is used.
+    """
+    if sys.version < "3":
+        from urllib2 import urlopen, Request, HTTPError
+    else:
+        from urllib.request import urlopen, Request
+        from urllib.error import HTTPError
+    return (urlopen, Request, HTTPError)
+
 
 def setup_external_libs(libs):
     """
     Download external libraries from PyPI to SPARK_EC2_DIR/lib/ and prepend them to our PATH.
+
+    Libraries that are there already are used as they are, without going to the network.
+    A downloaded library is hashed as it comes in, and only shows up under its own
+    name in SPARK_EC2_DIR/lib/ once it matched its md5 and was completely extracted, so
+    an interrupted download is simply done again by the next run.
     """
     PYPI_URL_PREFIX = "https://pypi.python.org/packages/source"
     SPARK_EC2_LIB_DIR = os.path.join(SPARK_EC2_DIR, "lib")
 
-    if not os.path.exists(SPARK_EC2_LIB_DIR):
-        print("Downloading external libraries that spark-ec2 needs from PyPI to {path}...".format(
-            path=SPARK_EC2_LIB_DIR
-        ))
-        print("This should be a one-time operation.")
-        os.mkdir(SPARK_EC2_LIB_DIR)
-
     for lib in libs:
         versioned_lib_name = "{n}-{v}".format(n=lib["name"], v=lib["version"])
         lib_dir = os.path.join(SPARK_EC2_LIB_DIR, versioned_lib_name)
 
         if not os.path.isdir(lib_dir):
-            tgz_file_path = os.path.join(SPARK_EC2_LIB_DIR, versioned_lib_name + ".tar.gz")
+            if not os.path.exists(SPARK_EC2_LIB_DIR):
+                print("Downloading external libraries that spark-ec2 needs from PyPI to "
+                      "{path}...".format(path=SPARK_EC2_LIB_DIR))
+                print("This should be a one-time operation.")
+                os.mkdir(SPARK_EC2_LIB_DIR)
             print(" - Downloading {lib}...".format(lib=lib["name"]))
+            (urlopen, Request, HTTPError) = import_urllib()
             download_stream = urlopen(
                 "{prefix}/{first_letter}/{lib_name}/{lib_name}-{lib_version}.tar.gz".format(
                     prefix=PYPI_URL_PREFIX,
@@ -129,16 +154,28 @@ def setup_external_libs(libs):
                     lib_version=lib["version"]
                 )
             )
-            with open(tgz_file_path, "wb") as tgz_file:
-                tgz_file.write(download_stream.read())
-            with open(tgz_file_path, "rb") as tar:
-                if hashlib.md5(tar.read()).hexdigest() != lib["md5"]:
+            tmp_dir = tempfile.mkdtemp(prefix=versioned_lib_name + ".", dir=SPARK_EC2_LIB_DIR)
+            try:
+                tgz_file_path = os.path.join(tmp_dir, versioned_lib_name + ".tar.gz")
+                md5 = hashlib.md5()
+                with open(tgz_file_path, "wb") as tgz_file:
+                    for chunk in iter(lambda: download_stream.read(65536), b""):
+                        md5.update(chunk)
+                        tgz_file.write(chunk)
+                if md5.hexdigest() != lib["md5"]:
                     print("ERROR: Got wrong md5sum for {lib}.".format(lib=lib["name"]), file=stderr)
                     sys.exit(1)
-            tar = tarfile.open(tgz_file_path)
-            tar.extractall(path=SPARK_EC2_LIB_DIR)
-            tar.close()
-            os.remove(tgz_file_path)
+                tar = tarfile.open(tgz_file_path)
+                tar.extractall(path=tmp_dir)
+                tar.close()
+                try:
+                    os.rename(os.path.join(tmp_dir, versioned_lib_name), lib_dir)
+                except OSError:
+                    # Fine if another spark-ec2 run got there first
+                    if not os.path.isdir(lib_dir):
+                        raise
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
             print(" - Finished downloading {lib}.".format(lib=lib["name"]))
         sys.path.insert(1, lib_dir)
 
@@ -152,11 +189,24 @@ external_libs = [
     }
 ]
 
-setup_external_libs(external_libs)
+# Set by setup_boto(), so that importing this module has no side effects
+boto = ec2 = None
+BlockDeviceMapping = BlockDeviceType = EBSBlockDeviceType = None
 
-import boto
-from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType, EBSBlockDeviceType
-from boto import ec2
+
+def setup_boto():
+    """
+    Make sure boto is available (see setup_external_libs()) and import it.
+    Must be called before using anything that talks to EC2.
+    """
+    global boto, ec2, BlockDeviceMapping, BlockDeviceType, EBSBlockDeviceType
+    if boto is not None:
+        return
+    setup_external_libs(external_libs)
+    import boto
+    from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType, \
+        EBSBlockDeviceType
+    from boto import ec2
 
 
 class UsageError(Exception):
@@ -168,14 +218,24 @@ def get_parser():
         prog="spark-ec2",
         version="%prog {v}".format(v=SPARK_EC2_VERSION),
         usage="%prog [options] <action> <cluster_name>\n\n"
-        + "<action> can be: launch, destroy, login, stop, start, get-master, reboot-slaves")
+        + "<action> can be: launch, destroy, login, stop, start, get-master, reboot-slaves, "
+        + "add-slaves, remove-slaves, price-advisor")
 
     parser.add_option(
         "-s", "--slaves", type="int", default=1,
-        help="Number of slaves to launch (default: %default)")
+        help="Number of slaves to launch, or to add or remove with add-slaves and " +
+             "remove-slaves (default: %default)")
     parser.add_option(
         "-w", "--wait", type="int",
         help="DEPRECATED (no longer necessary) - Seconds to wait for nodes to start")
+    parser.add_option(
+        "--wait-for-state", action="store_true", dest="wait_for_state", default=None,
+        help="Wait for the instances to be stopped (stop), terminated (destroy) or " +
+             "booted again and reachable over SSH (reboot-slaves) before exiting")
+    parser.add_option(
+        "--no-wait", action="store_false", dest="wait_for_state",
+        help="Only send the start requests and exit, without waiting for the cluster " +
+             "to come up and setting it up (start)")
     parser.add_option(
         "-k", "--key-pair",
         help="Key pair to use on instances")
@@ -194,9 +254,13 @@ def get_parser():
         help="EC2 region used to launch instances in, or to find them in (default: %default)")
     parser.add_option(
         "-z", "--zone", default="",
-        help="Availability zone to launch instances in, or 'all' to spread " +
+        help="Availability zone to launch instances in, 'all' to spread " +
              "slaves across multiple (an additional $0.01/Gb for bandwidth" +
-             "between zones applies) (default: a single zone chosen at random)")
+             "between zones applies), or 'auto' to pick the zone with the cheapest and " +
+             "most stable spot prices (see price-advisor); 'auto' only bids the " +
+             "recommended spot price if --spot-timeout or --spot-fallback is given " +
+             "without --spot-price " +
+             "(default: a single zone chosen at random)")
     parser.add_option(
         "-a", "--ami",
         help="Amazon Machine Image ID to use")
@@ -264,6 +328,27 @@ def get_parser():
         "--spot-price", metavar="PRICE", type="float",
         help="If specified, launch slaves as spot instances with the given " +
              "maximum price (in dollars)")
+    parser.add_option(
+        "--spot-timeout", metavar="MINUTES", type="int", default=None,
+        help="Give up on spot requests that are stalled (e.g. because the price is too high " +
+             "or there is no capacity) after this many minutes (default: wait forever)")
+    parser.add_option(
+        "--spot-fallback", default="none", choices=["none", "on-demand", "zone"],
+        help="What to do with slaves whose spot requests were given up on: 'none' to abort, " +
+             "'on-demand' to launch them as on-demand instances, or 'zone' to request them " +
+             "as spot instances in another availability zone (default: %default)")
+    parser.add_option(
+        "--price-history-days", metavar="DAYS", type="int", default=7,
+        help="Days of spot price history considered by price-advisor and --zone auto " +
+             "(default: %default)")
+    parser.add_option(
+        "--advisor-instance-types", metavar="TYPES", default="",
+        help="Comma-separated instance types for price-advisor to compare " +
+             "(default: the --instance-type)")
+    parser.add_option(
+        "--max-spot-risk", metavar="FRACTION", type="float", default=0.05,
+        help="Highest fraction of time the spot price may have spent above the bid for " +
+             "price-advisor and --zone auto to consider a zone (default: %default)")
     parser.add_option(
         "--ganglia", action="store_true", default=True,
         help="Setup Ganglia monitoring on cluster (default: %default). NOTE: " +
@@ -321,12 +406,49 @@ def get_parser():
     parser.add_option(
         "--instance-profile-name", default=None,
         help="IAM profile name to launch instances under")
+    parser.add_option(
+        "--cache-ttl", metavar="SECONDS", type="int", default=300,
+        help="How long the cluster state cached in {d} is trusted. Within this time, ".format(
+            d=SPARK_EC2_CACHE_DIR) +
+             "get-master and login don't query EC2 at all and other actions only look up " +
+             "the cached instance ids; 0 disables the cache (default: %default)")
+    parser.add_option(
+        "--no-ssh-multiplexing", action="store_false", dest="ssh_multiplexing", default=True,
+        help="Open a new SSH connection for every remote command instead of sharing one " +
+             "ControlMaster connection per host")
+    parser.add_option(
+        "--parallelism", type="int", default=20,
+        help="Maximum number of hosts spark-ec2 talks to concurrently, e.g. when probing " +
+             "instances for SSH readiness (default: %default)")
+    parser.add_option(
+        "--profile", metavar="FILE",
+        help="Time each phase of the run (wall time, EC2 API calls, SSH commands and time " +
+             "spent sleeping between retries), print a summary at the end and write a " +
+             "Chrome trace (chrome://tracing) of the run to FILE")
+    parser.add_option(
+        "--rolling-batch-size", type="int", default=0,
+        help="With reboot-slaves, reboot this many slaves at a time, waiting for each batch " +
+             "to be reachable over SSH again and for its DataNodes and NodeManagers to be " +
+             "back before rebooting the next one (default: reboot all slaves at once)")
+    parser.add_option(
+        "--api-rate", type="float", default=20,
+        help="Maximum average number of EC2 API requests sent per second, in bursts " +
+             "of up to twice as many (default: %default)")
+    parser.add_option(
+        "--output", type="choice", choices=["text", "json"], default="text",
+        help="'text' or 'json'. With 'json', stdout is a stream of newline-delimited JSON " +
+             "events (phases starting and ending, instances reaching a state, EC2 API " +
+             "errors and finally the cluster's instances and addresses) and everything " +
+             "else is printed to stderr (default: %default)")
     return parser
 
 # Configure and parse our command-line arguments
 def parse_args():
     parser = get_parser()
     (opts, args) = parser.parse_args()
+    # price-advisor doesn't act on a cluster, so the cluster name is optional for it
+    if args == ["price-advisor"]:
+        args.append(None)
     if len(args) != 2:
         parser.print_help()
         sys.exit(1)
@@ -350,10 +472,36 @@ def parse_args():
     return (opts, action, cluster_name)
 
 
-# Get the EC2 security group of the given name, creating it if it doesn't exist
-def get_or_make_group(conn, name, vpc_id):
-    groups = conn.get_all_security_groups()
-    group = [g for g in groups if g.name == name]
+def make_opts(**options):
+    """
+    Get the options spark-ec2 would run with if only the given ones were set on its
+    command line, without parsing any. Options are named like the attributes of the
+    parsed options, e.g. make_opts(key_pair="spark", slaves=4, spot_price=0.6).
+    """
+    opts = get_parser().get_default_values()
+    for (name, value) in options.items():
+        if not hasattr(opts, name):
+            raise UsageError("Unknown spark-ec2 option: " + name)
+        setattr(opts, name, value)
+    return opts
+
+
+# Get the EC2 security groups with the given names, filtering by name (and VPC) on the
+# server side rather than listing every group in the account
+def get_security_groups(conn, names, vpc_id):
+    filters = {"group-name": names}
+    if vpc_id is not None:
+        filters["vpc-id"] = vpc_id
+    return conn.get_all_security_groups(filters=filters)
+
+
+# Get the EC2 security group of the given name, creating it if it doesn't exist.
+# existing_groups may hold the result of an earlier get_security_groups() call
+# to avoid looking the group up again.
+def get_or_make_group(conn, name, vpc_id, existing_groups=None):
+    if existing_groups is None:
+        existing_groups = get_security_groups(conn, [name], vpc_id)
+    group = [g for g in existing_groups if g.name == name]
     if len(group) > 0:
         return group[0]
     else:
@@ -361,6 +509,118 @@ def get_or_make_group(conn, name, vpc_id):
         return conn.create_security_group(name, "Spark EC2 group", vpc_id)
 
 
+def get_ip_permission_params(group, rules):
+    """
+    Build the request parameters adding or removing rules of a security group.
+
+    rules: a list of (ip_protocol, from_port, to_port, source) tuples, where source is a
+           CIDR block, a boto.ec2.securitygroup.SecurityGroup or a security group id.
+           Rules for the same protocol and port range are merged into one permission.
+    """
+    permissions = []
+    sources = {}
+    for (ip_protocol, from_port, to_port, source) in rules:
+        key = (ip_protocol, from_port, to_port)
+        if key not in sources:
+            permissions.append(key)
+            sources[key] = []
+        sources[key].append(source)
+
+    params = {"GroupId": group.id}
+    for (n, key) in enumerate(permissions, 1):
+        prefix = "IpPermissions.%d." % n
+        params[prefix + "IpProtocol"] = key[0]
+        # Rules for all protocols have no port range
+        if key[1] is not None:
+            params[prefix + "FromPort"] = key[1]
+        if key[2] is not None:
+            params[prefix + "ToPort"] = key[2]
+        cidr_ips = [src for src in sources[key]
+                    if isinstance(src, str) and not src.startswith("sg-")]
+        src_group_ids = [src if isinstance(src, str) else src.id for src in sources[key]
+                         if src not in cidr_ips]
+        for (m, cidr_ip) in enumerate(cidr_ips, 1):
+            params[prefix + "IpRanges.%d.CidrIp" % m] = cidr_ip
+        for (m, src_group_id) in enumerate(src_group_ids, 1):
+            params[prefix + "Groups.%d.GroupId" % m] = src_group_id
+    return params
+
+
+def authorize_group_rules(conn, group, rules):
+    """
+    Add all the given ingress rules to a security group with a single
+    AuthorizeSecurityGroupIngress call, instead of one call per rule.
+
+    rules: a list of (ip_protocol, from_port, to_port, source) tuples, where source
+           is either a CIDR block or a boto.ec2.securitygroup.SecurityGroup.
+           Rules for the same protocol and port range are merged into one permission.
+    """
+    return conn.get_status("AuthorizeSecurityGroupIngress",
+                           get_ip_permission_params(group, rules), verb="POST")
+
+
+def revoke_group_rules(conn, group):
+    """
+    Remove all the rules of a security group that refer to other groups with a single
+    RevokeSecurityGroupIngress call. These are the rules that keep groups referring to
+    each other from being deleted.
+    """
+    rules = [(rule.ip_protocol, rule.from_port, rule.to_port, str(grant.group_id))
+             for rule in group.rules for grant in rule.grants if grant.group_id]
+    if not rules:
+        return True
+    return conn.get_status("RevokeSecurityGroupIngress",
+                           get_ip_permission_params(group, rules), verb="POST")
+
+
+def delete_security_groups(conn, groups, timeout=600):
+    """
+    Delete security groups as soon as EC2 allows it, that is once they don't refer to
+    each other anymore and the instances using them are gone.
+
+    Rather than sleeping a fixed amount of time, deleting a group is retried with
+    exponential backoff for as long as EC2 reports it as still in use, for up to
+    timeout seconds.
+
+    Returns a dict mapping each group's name to a (deleted, outcome) tuple.
+    """
+    outcomes = {}
+    remaining = []
+    for group in groups:
+        try:
+            revoke_group_rules(conn, group)
+            remaining.append(group)
+        except boto.exception.EC2ResponseError as e:
+            outcomes[group.name] = (False, "failed to revoke its rules ({c})".format(
+                c=e.error_code))
+
+    start_time = time.time()
+    delay = 1  # seconds
+    while remaining:
+        for group in list(remaining):
+            try:
+                # It is needed to use group_id to make it work with VPC
+                conn.delete_security_group(group_id=group.id)
+                outcome = (True, "deleted after {t}s".format(t=int(time.time() - start_time)))
+            except boto.exception.EC2ResponseError as e:
+                if e.error_code == "DependencyViolation":
+                    continue
+                elif e.error_code == "InvalidGroup.NotFound":
+                    outcome = (True, "already deleted")
+                else:
+                    outcome = (False, "failed ({c})".format(c=e.error_code))
+            outcomes[group.name] = outcome
+            remaining.remove(group)
+        if remaining and time.time() - start_time + delay > timeout:
+            for group in remaining:
+                outcomes[group.name] = (False, "still in use after {t}s".format(t=timeout))
+            break
+        elif remaining:
+            profiler.sleep(delay)
+            delay = min(delay * 2, 30)
+    return outcomes
+
+
 def get_validate_spark_version(version, repo):
     if "." in version:
         version = version.replace("v", "")
@@ -370,6 +630,7 @@ def get_validate_spark_version(version, repo):
         return version
     else:
         github_commit_url = "{repo}/commit/{commit_hash}".format(repo=repo, commit_hash=version)
+        (urlopen, Request, HTTPError) = import_urllib()
         request = Request(github_commit_url)
         request.get_method = lambda: 'HEAD'
         try:
@@ -447,36 +708,117 @@ def get_tachyon_version(spark_version):
     return SPARK_TACHYON_MAP.get(spark_version, "")
 
 
-# Attempt to resolve an appropriate AMI given the architecture and region of the request.
-def get_spark_ami(opts):
+# How long an AMI id downloaded from the spark-ec2 repo is reused without downloading it again
+AMI_CACHE_TTL = 24 * 60 * 60  # seconds
+
+
+def get_ami_cache_path():
+    return os.path.join(SPARK_EC2_CACHE_DIR, "ami-cache.json")
+
+
+def load_ami_cache():
+    try:
+        with open(get_ami_cache_path()) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_ami_cache(cache):
+    path = get_ami_cache_path()
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp_path = "%s.%d" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        print("Could not cache the AMI id in {p}: {e}".format(p=path, e=e), file=stderr)
+
+
+def get_spark_ami_candidates(opts):
+    """
+    Generate (AMI id, where it comes from) to try for the architecture and region of
+    the request, from the cheapest source to the most expensive one:
+     - the ami-list directory next to this script (or in the spark-ec2 checkout it is
+       in), unless --spark-ec2-git-repo or --spark-ec2-git-branch ask for another
+       spark-ec2 than the default one, whose ami-list may differ,
+     - AMIs previously downloaded from the spark-ec2 repo, for up to AMI_CACHE_TTL,
+     - the ami-list of the spark-ec2 repo on GitHub.
+    Later sources are only consulted if the earlier AMIs are rejected by the caller.
+    """
     if opts.instance_type in EC2_INSTANCE_TYPES:
         instance_type = EC2_INSTANCE_TYPES[opts.instance_type]
     else:
         instance_type = "pvm"
         print("Don't recognize %s, assuming type is pvm" % opts.instance_type, file=stderr)
 
+    ami_dirs = []
+    if opts.spark_ec2_git_repo == DEFAULT_SPARK_EC2_GITHUB_REPO and \
+            opts.spark_ec2_git_branch == DEFAULT_SPARK_EC2_BRANCH:
+        ami_dirs = [os.path.join(SPARK_EC2_DIR, "ami-list"),
+                    os.path.join(os.path.dirname(SPARK_EC2_DIR), "ami-list")]
+    for ami_dir in ami_dirs:
+        local_path = os.path.join(ami_dir, opts.region, instance_type)
+        if os.path.isfile(local_path):
+            with open(local_path) as f:
+                yield (f.read().strip(), local_path)
+            break
+
     # URL prefix from which to fetch AMI information
     ami_prefix = "{r}/{b}/ami-list".format(
         r=opts.spark_ec2_git_repo.replace("https://github.com", "https://raw.github.com", 1),
         b=opts.spark_ec2_git_branch)
 
     ami_path = "%s/%s/%s" % (ami_prefix, opts.region, instance_type)
+    cache = load_ami_cache()
+    if ami_path in cache and time.time() - cache[ami_path]["fetched"] < AMI_CACHE_TTL:
+        yield (cache[ami_path]["ami"], ami_path + " (cached)")
+
     reader = codecs.getreader("ascii")
+    (urlopen, Request, HTTPError) = import_urllib()
     try:
         ami = reader(urlopen(ami_path)).read().strip()
     except:
         print("Could not resolve AMI at: " + ami_path, file=stderr)
         sys.exit(1)
+    cache[ami_path] = {"ami": ami, "fetched": time.time()}
+    save_ami_cache(cache)
+    yield (ami, ami_path)
 
-    print("Spark AMI: " + ami)
-    return ami
+
+def get_spark_image(conn, opts):
+    """
+    Look up the image to launch instances from: opts.ami if it is set, else the first
+    AMI from get_spark_ami_candidates() that exists in the region. Each candidate is
+    checked with one DescribeImages call, and opts.ami is set to the one that is used.
+    Returns a boto.ec2.image.Image.
+    """
+    if opts.ami is not None:
+        candidates = [(opts.ami, "--ami")]
+    else:
+        candidates = get_spark_ami_candidates(opts)
+    for (ami, source) in candidates:
+        try:
+            image = conn.get_all_images(image_ids=[ami])[0]
+        except (boto.exception.EC2ResponseError, IndexError):
+            print("Could not find AMI {a} from {s}".format(a=ami, s=source), file=stderr)
+            continue
+        opts.ami = ami
+        print("Spark AMI: {a} (from {s})".format(a=ami, s=source))
+        return image
+    sys.exit(1)
 
 
 # Launch a cluster of the given name, by setting up its security groups,
 # and then starting new instances in them.
 # Returns a tuple of EC2 reservation objects for the master and slaves
 # Fails if there already instances running in the cluster's groups.
-def launch_cluster(conn, opts, cluster_name):
+# If existing_cluster, the (master_nodes, slave_nodes) of a running cluster, is given,
+# opts.slaves slaves are added to it instead, and only the new slaves are returned
+# along with the existing masters.
+def launch_cluster(conn, opts, cluster_name, existing_cluster=None):
     if opts.identity_file is None:
         print("ERROR: Must provide an identity file (-i) for ssh connections.", file=stderr)
         sys.exit(1)
@@ -490,98 +832,89 @@ def launch_cluster(conn, opts, cluster_name):
         with open(opts.user_data) as user_data_file:
             user_data_content = user_data_file.read()
 
-    print("Setting up security groups...")
-    master_group = get_or_make_group(conn, cluster_name + "-master", opts.vpc_id)
-    slave_group = get_or_make_group(conn, cluster_name + "-slaves", opts.vpc_id)
-    authorized_address = opts.authorized_address
-    if master_group.rules == []:  # Group was just now created
-        if opts.vpc_id is None:
-            master_group.authorize(src_group=master_group)
-            master_group.authorize(src_group=slave_group)
-        else:
-            master_group.authorize(ip_protocol='icmp', from_port=-1, to_port=-1,
-                                   src_group=master_group)
-            master_group.authorize(ip_protocol='tcp', from_port=0, to_port=65535,
-                                   src_group=master_group)
-            master_group.authorize(ip_protocol='udp', from_port=0, to_port=65535,
-                                   src_group=master_group)
-            master_group.authorize(ip_protocol='icmp', from_port=-1, to_port=-1,
-                                   src_group=slave_group)
-            master_group.authorize(ip_protocol='tcp', from_port=0, to_port=65535,
-                                   src_group=slave_group)
-            master_group.authorize(ip_protocol='udp', from_port=0, to_port=65535,
-                                   src_group=slave_group)
-        master_group.authorize('tcp', 22, 22, authorized_address)
-        master_group.authorize('tcp', 8080, 8081, authorized_address)
-        master_group.authorize('tcp', 18080, 18080, authorized_address)
-        master_group.authorize('tcp', 19999, 19999, authorized_address)
-        master_group.authorize('tcp', 50030, 50030, authorized_address)
-        master_group.authorize('tcp', 50070, 50070, authorized_address)
-        master_group.authorize('tcp', 60070, 60070, authorized_address)
-        master_group.authorize('tcp', 4040, 4045, authorized_address)
-        # Rstudio (GUI for R) needs port 8787 for web access
-        master_group.authorize('tcp', 8787, 8787, authorized_address)
-        # HDFS NFS gateway requires 111,2049,4242 for tcp & udp
-        master_group.authorize('tcp', 111, 111, authorized_address)
-        master_group.authorize('udp', 111, 111, authorized_address)
-        master_group.authorize('tcp', 2049, 2049, authorized_address)
-        master_group.authorize('udp', 2049, 2049, authorized_address)
-        master_group.authorize('tcp', 4242, 4242, authorized_address)
-        master_group.authorize('udp', 4242, 4242, authorized_address)
-        # RM in YARN mode uses 8088
-        master_group.authorize('tcp', 8088, 8088, authorized_address)
-        if opts.ganglia:
-            master_group.authorize('tcp', 5080, 5080, authorized_address)
-    if slave_group.rules == []:  # Group was just now created
-        if opts.vpc_id is None:
-            slave_group.authorize(src_group=master_group)
-            slave_group.authorize(src_group=slave_group)
-        else:
-            slave_group.authorize(ip_protocol='icmp', from_port=-1, to_port=-1,
-                                  src_group=master_group)
-            slave_group.authorize(ip_protocol='tcp', from_port=0, to_port=65535,
-                                  src_group=master_group)
-            slave_group.authorize(ip_protocol='udp', from_port=0, to_port=65535,
-                                  src_group=master_group)
-            slave_group.authorize(ip_protocol='icmp', from_port=-1, to_port=-1,
-                                  src_group=slave_group)
-            slave_group.authorize(ip_protocol='tcp', from_port=0, to_port=65535,
-                                  src_group=slave_group)
-            slave_group.authorize(ip_protocol='udp', from_port=0, to_port=65535,
-                                  src_group=slave_group)
-        slave_group.authorize('tcp', 22, 22, authorized_address)
-        slave_group.authorize('tcp', 8080, 8081, authorized_address)
-        slave_group.authorize('tcp', 50060, 50060, authorized_address)
-        slave_group.authorize('tcp', 50075, 50075, authorized_address)
-        slave_group.authorize('tcp', 60060, 60060, authorized_address)
-        slave_group.authorize('tcp', 60075, 60075, authorized_address)
-
-    # Check if instances are already running in our groups
-    existing_masters, existing_slaves = get_existing_cluster(conn, opts, cluster_name,
-                                                             die_on_error=False)
-    if existing_slaves or (existing_masters and not opts.use_existing_master):
-        print("ERROR: There are already instances running in group %s or %s" %
-              (master_group.name, slave_group.name), file=stderr)
-        sys.exit(1)
+    with profiler.phase("security groups"):
+        print("Setting up security groups...")
+        master_group_name = cluster_name + "-master"
+        slave_group_name = cluster_name + "-slaves"
+        group_names = [master_group_name, slave_group_name]
+        # Look up the additional group along with ours when it is given by name
+        additional_group = opts.additional_security_group
+        if additional_group and not additional_group.startswith("sg-"):
+            group_names.append(additional_group)
+        existing_groups = get_security_groups(conn, group_names, opts.vpc_id)
+        master_group = get_or_make_group(conn, master_group_name, opts.vpc_id, existing_groups)
+        slave_group = get_or_make_group(conn, slave_group_name, opts.vpc_id, existing_groups)
+        authorized_address = opts.authorized_address
+        # Members of the cluster can talk to each other on every port
+        cluster_rules = []
+        for src_group in [master_group, slave_group]:
+            cluster_rules += [('icmp', -1, -1, src_group),
+                              ('tcp', 0, 65535, src_group),
+                              ('udp', 0, 65535, src_group)]
+        group_rules = []
+        if master_group.rules == []:  # Group was just now created
+            master_rules = cluster_rules + [
+                ('tcp', 22, 22, authorized_address),
+                ('tcp', 8080, 8081, authorized_address),
+                ('tcp', 18080, 18080, authorized_address),
+                ('tcp', 19999, 19999, authorized_address),
+                ('tcp', 50030, 50030, authorized_address),
+                ('tcp', 50070, 50070, authorized_address),
+                ('tcp', 60070, 60070, authorized_address),
+                ('tcp', 4040, 4045, authorized_address),
+                # Rstudio (GUI for R) needs port 8787 for web access
+                ('tcp', 8787, 8787, authorized_address),
+                # HDFS NFS gateway requires 111,2049,4242 for tcp & udp
+                ('tcp', 111, 111, authorized_address),
+                ('udp', 111, 111, authorized_address),
+                ('tcp', 2049, 2049, authorized_address),
+                ('udp', 2049, 2049, authorized_address),
+                ('tcp', 4242, 4242, authorized_address),
+                ('udp', 4242, 4242, authorized_address),
+                # RM in YARN mode uses 8088
+                ('tcp', 8088, 8088, authorized_address)
+            ]
+            if opts.ganglia:
+                master_rules.append(('tcp', 5080, 5080, authorized_address))
+            group_rules.append((master_group, master_rules))
+        if slave_group.rules == []:  # Group was just now created
+            slave_rules = cluster_rules + [
+                ('tcp', 22, 22, authorized_address),
+                ('tcp', 8080, 8081, authorized_address),
+                ('tcp', 50060, 50060, authorized_address),
+                ('tcp', 50075, 50075, authorized_address),
+                ('tcp', 60060, 60060, authorized_address),
+                ('tcp', 60075, 60075, authorized_address)
+            ]
+            group_rules.append((slave_group, slave_rules))
+        parallel_map(lambda group_and_rules: authorize_group_rules(conn, *group_and_rules),
+                     group_rules, opts.parallelism)
+
+    if existing_cluster is not None:
+        (existing_masters, existing_slaves) = existing_cluster
+    else:
+        # Check if instances are already running in our groups
+        with profiler.phase("check existing cluster"):
+            existing_masters, existing_slaves = get_existing_cluster(conn, opts, cluster_name,
+                                                                     die_on_error=False)
+        if existing_slaves or (existing_masters and not opts.use_existing_master):
+            print("ERROR: There are already instances running in group %s or %s" %
+                  (master_group.name, slave_group.name), file=stderr)
+            sys.exit(1)
 
     # Figure out Spark AMI
-    if opts.ami is None:
-        opts.ami = get_spark_ami(opts)
+    with profiler.phase("AMI lookup"):
+        image = get_spark_image(conn, opts)
 
     # we use group ids to work around https://github.com/boto/boto/issues/350
     additional_group_ids = []
-    if opts.additional_security_group:
-        additional_group_ids = [sg.id
-                                for sg in conn.get_all_security_groups()
-                                if opts.additional_security_group in (sg.name, sg.id)]
+    if additional_group.startswith("sg-"):
+        additional_group_ids = [sg.id for sg in
+                                conn.get_all_security_groups(group_ids=[additional_group])]
+    elif additional_group:
+        additional_group_ids = [sg.id for sg in existing_groups if sg.name == additional_group]
     print("Launching instances...")
 
-    try:
-        image = conn.get_all_images(image_ids=[opts.ami])[0]
-    except:
-        print("Could not find AMI " + opts.ami, file=stderr)
-        sys.exit(1)
-
     # Create block device mapping so that we can add EBS volumes if asked to.
     # The first drive is attached as /dev/sds, 2nd as /dev/sdt, ... /dev/sdz
     block_map = BlockDeviceMapping()
@@ -602,130 +935,159 @@ def launch_cluster(conn, opts, cluster_name):
             name = '/dev/sd' + string.letters[i + 1]
             block_map[name] = dev
 
+    def request_slaves(zone_and_count):
+        (zone, num_slaves_this_zone) = zone_and_count
+        return conn.request_spot_instances(
+            price=opts.spot_price,
+            image_id=opts.ami,
+            launch_group="launch-group-%s" % cluster_name,
+            placement=zone,
+            count=num_slaves_this_zone,
+            key_name=opts.key_pair,
+            security_group_ids=[slave_group.id] + additional_group_ids,
+            instance_type=opts.instance_type,
+            block_device_map=block_map,
+            subnet_id=opts.subnet_id,
+            placement_group=opts.placement_group,
+            user_data=user_data_content,
+            ebs_optimized=True,
+            instance_profile_name=opts.instance_profile_name)
+
+    def launch_slaves(zone_and_count):
+        (zone, num_slaves_this_zone) = zone_and_count
+        slave_res = image.run(
+            key_name=opts.key_pair,
+            security_group_ids=[slave_group.id] + additional_group_ids,
+            instance_type=opts.instance_type,
+            placement=zone,
+            min_count=num_slaves_this_zone,
+            max_count=num_slaves_this_zone,
+            block_device_map=block_map,
+            subnet_id=opts.subnet_id,
+            placement_group=opts.placement_group,
+            user_data=user_data_content,
+            instance_initiated_shutdown_behavior=opts.instance_initiated_shutdown_behavior,
+            instance_profile_name=opts.instance_profile_name)
+        print("Launched {s} slave{plural_s} in {z}, regid = {r}".format(
+              s=num_slaves_this_zone,
+              plural_s=('' if num_slaves_this_zone == 1 else 's'),
+              z=zone,
+              r=slave_res.id))
+        return slave_res.instances
+
     # Launch slaves
-    if opts.spot_price is not None:
-        # Launch spot instances with the requested price
-        print("Requesting %d slaves as spot instances with price $%.3f" %
-              (opts.slaves, opts.spot_price))
-        zones = get_zones(conn, opts)
-        num_zones = len(zones)
-        i = 0
-        my_req_ids = []
-        for zone in zones:
-            num_slaves_this_zone = get_partition(opts.slaves, num_zones, i)
-            slave_reqs = conn.request_spot_instances(
-                price=opts.spot_price,
-                image_id=opts.ami,
-                launch_group="launch-group-%s" % cluster_name,
-                placement=zone,
-                count=num_slaves_this_zone,
-                key_name=opts.key_pair,
-                security_group_ids=[slave_group.id] + additional_group_ids,
-                instance_type=opts.instance_type,
-                block_device_map=block_map,
-                subnet_id=opts.subnet_id,
-                placement_group=opts.placement_group,
-                user_data=user_data_content,
-                ebs_optimized=True,
-                instance_profile_name=opts.instance_profile_name)
-            my_req_ids += [req.id for req in slave_reqs]
-            i += 1
-
-        print("Waiting for spot instances to be granted...")
-        try:
-            while True:
-                time.sleep(10)
-                reqs = conn.get_all_spot_instance_requests()
-                id_to_req = {}
-                for r in reqs:
-                    id_to_req[r.id] = r
-                active_instance_ids = []
-                for i in my_req_ids:
-                    if i in id_to_req and id_to_req[i].state == "active":
-                        active_instance_ids.append(id_to_req[i].instance_id)
-                if len(active_instance_ids) == opts.slaves:
-                    print("All %d slaves granted" % opts.slaves)
-                    reservations = conn.get_all_reservations(active_instance_ids)
-                    slave_nodes = []
-                    for r in reservations:
-                        slave_nodes += r.instances
-                    break
-                else:
-                    print("%d of %d slaves granted, waiting longer" % (
-                        len(active_instance_ids), opts.slaves))
-        except:
-            print("Canceling spot instance requests")
-            conn.cancel_spot_instance_requests(my_req_ids)
-            # Log a warning if any of these requests actually launched instances:
-            (master_nodes, slave_nodes) = get_existing_cluster(
-                conn, opts, cluster_name, die_on_error=False)
-            running = len(master_nodes) + len(slave_nodes)
-            if running:
-                print(("WARNING: %d instances are still running" % running), file=stderr)
-            sys.exit(0)
+    with profiler.phase("launch slaves"):
+        if opts.spot_price is not None:
+            # Launch spot instances with the requested price
+            print("Requesting %d slaves as spot instances with price $%.3f" %
+                  (opts.slaves, opts.spot_price))
+            zone_partitions = get_zone_partitions(conn, opts)
+            tried_zones = set(zone for (zone, count) in zone_partitions)
+            my_req_ids = []
+            slave_nodes = []
+            try:
+                while zone_partitions:
+                    req_zones = {}
+                    for (zone, slave_reqs) in zip(
+                            [zone for (zone, count) in zone_partitions],
+                            parallel_map(request_slaves, zone_partitions, opts.parallelism)):
+                        req_zones.update((req.id, zone) for req in slave_reqs)
+                    my_req_ids += list(req_zones)
+
+                    print("Waiting for spot instances to be granted...")
+                    (active_instance_ids, open_req_ids) = wait_for_spot_instances(
+                        conn, opts, list(req_zones))
+                    if open_req_ids:
+                        print("Canceling %d ungranted spot instance requests" % len(open_req_ids))
+                        active_instance_ids += cancel_spot_requests(conn, open_req_ids)
+                    if active_instance_ids:
+                        slave_nodes += conn.get_only_instances(active_instance_ids)
+
+                    num_missing = opts.slaves - len(slave_nodes)
+                    zone_partitions = []
+                    if num_missing <= 0:
+                        break
+                    if opts.spot_fallback == "on-demand":
+                        print("Launching %d remaining slaves as on-demand instances" % num_missing)
+                        # Keep the slaves in the zones their spot requests were made in
+                        missing = {}
+                        for r in open_req_ids[:num_missing]:
+                            missing[req_zones[r]] = missing.get(req_zones[r], 0) + 1
+                        for instances in parallel_map(launch_slaves, list(missing.items()),
+                                                      opts.parallelism):
+                            slave_nodes += instances
+                    elif opts.spot_fallback == "zone":
+                        other_zones = [z.name for z in conn.get_all_zones()
+                                       if z.name not in tried_zones]
+                        if not other_zones:
+                            raise UsageError("No availability zone left to request the remaining "
+                                             "{n} spot instances in".format(n=num_missing))
+                        zone = random.choice(other_zones)
+                        tried_zones.add(zone)
+                        print("Requesting %d remaining slaves as spot instances in %s" %
+                              (num_missing, zone))
+                        zone_partitions = [(zone, num_missing)]
+                    else:
+                        raise UsageError("Only {g} of {n} spot instances were granted".format(
+                            g=len(slave_nodes), n=opts.slaves))
+            except:
+                print("Canceling spot instance requests")
+                conn.cancel_spot_instance_requests(my_req_ids)
+                # Log a warning if any of these requests actually launched instances:
+                (master_nodes, slave_nodes) = get_existing_cluster(
+                    conn, opts, cluster_name, die_on_error=False)
+                running = len(master_nodes) + len(slave_nodes)
+                if running:
+                    print(("WARNING: %d instances are still running" % running), file=stderr)
+                if isinstance(sys.exc_info()[1], UsageError):
+                    raise
+                sys.exit(0)
+        else:
+            # Launch non-spot instances
+            slave_nodes = []
+            zone_partitions = [(z, n) for (z, n) in get_zone_partitions(conn, opts) if n > 0]
+            for instances in parallel_map(launch_slaves, zone_partitions, opts.parallelism):
+                slave_nodes += instances
+
+    # Launch or resume masters
+    if existing_cluster is not None:
+        master_nodes = existing_masters
     else:
-        # Launch non-spot instances
-        zones = get_zones(conn, opts)
-        num_zones = len(zones)
-        i = 0
-        slave_nodes = []
-        for zone in zones:
-            num_slaves_this_zone = get_partition(opts.slaves, num_zones, i)
-            if num_slaves_this_zone > 0:
-                slave_res = image.run(
+        with profiler.phase("launch master"):
+            if existing_masters:
+                print("Starting master...")
+                batch_instance_action(conn, opts, "start", [
+                    i for i in existing_masters if i.state not in ["shutting-down", "terminated"]])
+                master_nodes = existing_masters
+            else:
+                master_type = opts.master_instance_type
+                if master_type == "":
+                    master_type = opts.instance_type
+                if opts.zone == 'all':
+                    opts.zone = random.choice(conn.get_all_zones()).name
+                master_res = image.run(
                     key_name=opts.key_pair,
-                    security_group_ids=[slave_group.id] + additional_group_ids,
-                    instance_type=opts.instance_type,
-                    placement=zone,
-                    min_count=num_slaves_this_zone,
-                    max_count=num_slaves_this_zone,
+                    security_group_ids=[master_group.id] + additional_group_ids,
+                    instance_type=master_type,
+                    placement=opts.zone,
+                    min_count=1,
+                    max_count=1,
                     block_device_map=block_map,
                     subnet_id=opts.subnet_id,
                     placement_group=opts.placement_group,
                     user_data=user_data_content,
                     instance_initiated_shutdown_behavior=opts.instance_initiated_shutdown_behavior,
                     instance_profile_name=opts.instance_profile_name)
-                slave_nodes += slave_res.instances
-                print("Launched {s} slave{plural_s} in {z}, regid = {r}".format(
-                      s=num_slaves_this_zone,
-                      plural_s=('' if num_slaves_this_zone == 1 else 's'),
-                      z=zone,
-                      r=slave_res.id))
-            i += 1
 
-    # Launch or resume masters
-    if existing_masters:
-        print("Starting master...")
-        for inst in existing_masters:
-            if inst.state not in ["shutting-down", "terminated"]:
-                inst.start()
-        master_nodes = existing_masters
-    else:
-        master_type = opts.master_instance_type
-        if master_type == "":
-            master_type = opts.instance_type
-        if opts.zone == 'all':
-            opts.zone = random.choice(conn.get_all_zones()).name
-        master_res = image.run(
-            key_name=opts.key_pair,
-            security_group_ids=[master_group.id] + additional_group_ids,
-            instance_type=master_type,
-            placement=opts.zone,
-            min_count=1,
-            max_count=1,
-            block_device_map=block_map,
-            subnet_id=opts.subnet_id,
-            placement_group=opts.placement_group,
-            user_data=user_data_content,
-            instance_initiated_shutdown_behavior=opts.instance_initiated_shutdown_behavior,
-            instance_profile_name=opts.instance_profile_name)
+                master_nodes = master_res.instances
+                print("Launched master in %s, regid = %s" % (opts.zone, master_res.id))
 
-        master_nodes = master_res.instances
-        print("Launched master in %s, regid = %s" % (zone, master_res.id))
+    new_nodes = slave_nodes if existing_cluster is not None else master_nodes + slave_nodes
 
-    # This wait time corresponds to SPARK-4983
+    # Instances can take a while to show up in the API after being launched (SPARK-4983)
     print("Waiting for AWS to propagate instance metadata...")
-    time.sleep(15)
+    with profiler.phase("instance propagation"):
+        wait_for_instances_visible(conn, [i.id for i in new_nodes])
 
     # Give the instances descriptive names and set additional tags
     additional_tags = {}
@@ -733,43 +1095,301 @@ def launch_cluster(conn, opts, cluster_name):
         additional_tags = dict(
             map(str.strip, tag.split(':', 1)) for tag in opts.additional_tags.split(',')
         )
-
-    for master in master_nodes:
-        master.add_tags(
-            dict(additional_tags, Name='{cn}-master-{iid}'.format(cn=cluster_name, iid=master.id))
-        )
-
-    for slave in slave_nodes:
-        slave.add_tags(
-            dict(additional_tags, Name='{cn}-slave-{iid}'.format(cn=cluster_name, iid=slave.id))
+    with profiler.phase("tag instances"):
+        tag_instances(
+            conn=conn,
+            opts=opts,
+            names=dict(
+                [(master.id, '{cn}-master-{iid}'.format(cn=cluster_name, iid=master.id))
+                 for master in master_nodes if master in new_nodes] +
+                [(slave.id, '{cn}-slave-{iid}'.format(cn=cluster_name, iid=slave.id))
+                 for slave in slave_nodes]),
+            tags=additional_tags
         )
 
     # Return all the instances
     return (master_nodes, slave_nodes)
 
 
+# Spot request status codes after which a request is unlikely to be fulfilled any time soon.
+# See http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/spot-bid-status.html
+SPOT_STALLED_STATUS_CODES = set([
+    "price-too-high",
+    "capacity-not-available",
+    "capacity-oversubscribed",
+    "launch-group-constraint",
+    "az-group-constraint",
+    "placement-group-constraint",
+    "constraint-not-fulfillable"
+])
+
+
+def wait_for_spot_instances(conn, opts, req_ids, max_batch=100):
+    """
+    Wait for the given spot instance requests to be fulfilled, describing only those
+    requests (in batches) instead of every spot request in the account.
+
+    Gives up on requests that EC2 closed without fulfilling them, and, once
+    opts.spot_timeout minutes have passed, on requests that are stalled on one of
+    SPOT_STALLED_STATUS_CODES (e.g. because the price is too high).
+
+    Returns a tuple of the ids of the instances launched for fulfilled requests and
+    the ids of the requests that were given up on.
+    """
+    start_time = time.time()
+    pending = list(req_ids)
+    active_instance_ids = []
+    given_up = []
+    while pending:
+        profiler.sleep(10)
+        reqs = []
+        for j in xrange(0, len(pending), max_batch):
+            try:
+                reqs += conn.get_all_spot_instance_requests(
+                    request_ids=pending[j:j + max_batch])
+            except boto.exception.EC2ResponseError as e:
+                # New requests may not be visible yet
+                if e.error_code != "InvalidSpotInstanceRequestID.NotFound":
+                    raise
+        timed_out = opts.spot_timeout is not None and \
+            time.time() - start_time > opts.spot_timeout * 60
+        status_counts = {}
+        for r in reqs:
+            code = r.status.code if r.status else r.state
+            if r.state == "active":
+                active_instance_ids.append(r.instance_id)
+                pending.remove(r.id)
+                continue
+            status_counts[code] = status_counts.get(code, 0) + 1
+            if r.state in ["closed", "cancelled", "failed"] or \
+               (timed_out and code in SPOT_STALLED_STATUS_CODES):
+                print("Giving up on spot request {r}: {c}".format(r=r.id, c=code), file=stderr)
+                given_up.append(r.id)
+                pending.remove(r.id)
+        if pending:
+            print("%d of %d slaves granted, waiting longer (%s)" % (
+                len(active_instance_ids), len(req_ids),
+                ", ".join("%s: %d" % c for c in sorted(status_counts.items()))))
+    print("%d of %d slaves granted" % (len(active_instance_ids), len(req_ids)))
+    return (active_instance_ids, given_up)
+
+
+def cancel_spot_requests(conn, req_ids):
+    """
+    Cancel the given spot instance requests.
+    Returns the ids of any instances that were launched for them before they got cancelled.
+    """
+    conn.cancel_spot_instance_requests(req_ids)
+    return [r.instance_id for r in conn.get_all_spot_instance_requests(request_ids=req_ids)
+            if r.instance_id]
+
+
+def wait_for_instances_visible(conn, instance_ids, timeout=300):
+    """
+    Poll DescribeInstances until EC2 knows about all the given instances, backing
+    off from 1 up to 15 seconds between polls, instead of sleeping a fixed time.
+    """
+    start_time = time.time()
+    delay = 1
+    while True:
+        try:
+            conn.get_only_instances(instance_ids=instance_ids)
+            return
+        except boto.exception.EC2ResponseError as e:
+            if e.error_code != "InvalidInstanceID.NotFound" or \
+               time.time() - start_time > timeout:
+                raise
+        profiler.sleep(delay)
+        delay = min(delay * 2, 15)
+
+
+def create_tags(conn, resource_ids, tags, max_tries=6):
+    """
+    Create tags on EC2 resources, retrying with exponential backoff while EC2
+    reports them as not found (eventual consistency).
+    """
+    delay = 1
+    tries = 1
+    while True:
+        try:
+            return conn.create_tags(resource_ids, tags)
+        except boto.exception.EC2ResponseError as e:
+            if not e.error_code.endswith(".NotFound") or tries >= max_tries:
+                raise
+        profiler.sleep(delay)
+        delay = min(delay * 2, 15)
+        tries += 1
+
+
+def tag_instances(conn, opts, names, tags):
+    """
+    Set a Name tag on each instance and tag all of them with the given tags.
+
+    names: a dict mapping instance ids to their Name tag.
+    tags: a dict of tags shared by all the instances. These are set with a single
+          CreateTags call; Name tags differ per instance, so they are set with one
+          call per instance, opts.parallelism at a time.
+    """
+    instance_ids = list(names)
+    if tags:
+        create_tags(conn, instance_ids, tags)
+    parallel_map(lambda iid: create_tags(conn, [iid], {'Name': names[iid]}),
+                 instance_ids, opts.parallelism)
+
+
+def get_cluster_state_path(opts, cluster_name):
+    return os.path.join(SPARK_EC2_CACHE_DIR, "clusters", opts.region, cluster_name + ".json")
+
+
+def load_cluster_state(opts, cluster_name):
+    """
+    Load the cached state of a cluster, as saved by save_cluster_state().
+    Returns None if there is none or if it is older than opts.cache_ttl seconds.
+    """
+    path = get_cluster_state_path(opts, cluster_name)
+    if opts.cache_ttl <= 0 or not os.path.isfile(path):
+        return None
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if time.time() - state["updated"] > opts.cache_ttl:
+        return None
+    return state
+
+
+def save_cluster_state(opts, cluster_name, master_nodes, slave_nodes):
+    """
+    Cache the instance ids, roles, addresses and last known states of a cluster's instances.
+    The cache is only an optimization, so spark-ec2 goes on without it if it can't be
+    written (e.g. when ~/.spark-ec2 isn't writable).
+    """
+    if opts.cache_ttl <= 0:
+        return
+    path = get_cluster_state_path(opts, cluster_name)
+    instances = []
+    for (role, nodes) in [("master", master_nodes), ("slave", slave_nodes)]:
+        for i in nodes:
+            instances.append({
+                "id": i.id,
+                "role": role,
+                "public_dns_name": i.public_dns_name,
+                "private_ip_address": i.private_ip_address,
+                "state": i.state
+            })
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Write to a temporary file first so that concurrent readers never see half a file
+        tmp_path = "%s.%d" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump({"updated": time.time(), "instances": instances}, f, indent=2)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        print("Could not cache the cluster's state in {p}: {e}".format(p=path, e=e),
+              file=stderr)
+
+
+def forget_cluster_state(opts, cluster_name):
+    path = get_cluster_state_path(opts, cluster_name)
+    try:
+        if os.path.isfile(path):
+            os.remove(path)
+    except OSError as e:
+        # A stale cache would be used until it expires
+        print("Could not remove the cluster's cached state {p}: {e}".format(p=path, e=e),
+              file=stderr)
+
+
+def get_warm_pool_path(opts, cluster_name):
+    return os.path.join(SPARK_EC2_CACHE_DIR, "clusters", opts.region, cluster_name + ".pool.json")
+
+
+def load_warm_pool(opts, cluster_name):
+    """
+    Load the warm pool of a cluster, as saved by save_warm_pool(), or None if it has none.
+    Unlike the cluster state, it doesn't expire.
+    """
+    try:
+        with open(get_warm_pool_path(opts, cluster_name)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_warm_pool(opts, cluster_name, pool):
+    path = get_warm_pool_path(opts, cluster_name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = "%s.%d" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(pool, f, indent=2)
+    os.rename(tmp_path, path)
+
+
+def forget_warm_pool(opts, cluster_name):
+    path = get_warm_pool_path(opts, cluster_name)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def get_cached_master(opts, cluster_name):
+    """
+    Get the address of a cluster's running master from the cluster state cache,
+    without any EC2 API call. Returns None if the cache can't tell.
+    """
+    state = load_cluster_state(opts, cluster_name)
+    if state is None:
+        return None
+    masters = [i for i in state["instances"] if i["role"] == "master"]
+    if not masters or masters[0]["state"] != "running":
+        return None
+    if opts.private_ips:
+        return masters[0]["private_ip_address"]
+    return masters[0]["public_dns_name"]
+
+
 def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
     """
     Get the EC2 instances in an existing cluster if available.
     Returns a tuple of lists of EC2 instance objects for the masters and slaves.
+
+    If the cluster's state was cached recently (see --cache-ttl), only the cached
+    instance ids are looked up; the cache is only trusted if none of them went away.
+    Otherwise the master and slave instances are found with a single DescribeInstances
+    call, filtering on both security groups and on instance state server-side.
     """
     print("Searching for existing cluster {c} in region {r}...".format(
           c=cluster_name, r=opts.region))
 
-    def get_instances(group_names):
-        """
-        Get all non-terminated instances that belong to any of the provided security groups.
-
-        EC2 reservation filters and instance states are documented here:
-            http://docs.aws.amazon.com/cli/latest/reference/ec2/describe-instances.html#options
-        """
-        reservations = conn.get_all_reservations(
-            filters={"instance.group-name": group_names})
-        instances = itertools.chain.from_iterable(r.instances for r in reservations)
-        return [i for i in instances if i.state not in ["shutting-down", "terminated"]]
+    live_states = ["pending", "running", "stopping", "stopped"]
+    master_group = cluster_name + "-master"
+    slave_group = cluster_name + "-slaves"
 
-    master_instances = get_instances([cluster_name + "-master"])
-    slave_instances = get_instances([cluster_name + "-slaves"])
+    master_instances = slave_instances = None
+    state = load_cluster_state(opts, cluster_name)
+    if state is not None and state["instances"]:
+        roles = dict((i["id"], i["role"]) for i in state["instances"])
+        try:
+            instances = conn.get_only_instances(instance_ids=list(roles))
+        except boto.exception.EC2ResponseError as e:
+            if e.error_code != "InvalidInstanceID.NotFound":
+                raise
+            instances = []
+        if len(instances) == len(roles) and all(i.state in live_states for i in instances):
+            master_instances = [i for i in instances if roles[i.id] == "master"]
+            slave_instances = [i for i in instances if roles[i.id] == "slave"]
+
+    if master_instances is None:
+        # EC2 reservation filters and instance states are documented here:
+        #     http://docs.aws.amazon.com/cli/latest/reference/ec2/describe-instances.html#options
+        instances = conn.get_only_instances(filters={
+            "instance.group-name": [master_group, slave_group],
+            "instance-state-name": live_states
+        })
+        master_instances = [i for i in instances if master_group in [g.name for g in i.groups]]
+        slave_instances = [i for i in instances if slave_group in [g.name for g in i.groups]]
 
     if any((master_instances, slave_instances)):
         print("Found {m} master{plural_m}, {s} slave{plural_s}.".format(
@@ -777,6 +1397,9 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
               plural_m=('' if len(master_instances) == 1 else 's'),
               s=len(slave_instances),
               plural_s=('' if len(slave_instances) == 1 else 's')))
+        save_cluster_state(opts, cluster_name, master_instances, slave_instances)
+    else:
+        forget_cluster_state(opts, cluster_name)
 
     if not master_instances and die_on_error:
         print("ERROR: Could not find a master for cluster {c} in region {r}.".format(
@@ -788,7 +1411,12 @@ def get_existing_cluster(conn, opts, cluster_name, die_on_error=True):
 
 # Deploy configuration files and run setup scripts on a newly launched
 # or started EC2 cluster.
-def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
+# Set up a cluster whose instances are all ssh-ready. If new_slaves is given, these
+# have just been added to the (already set up) cluster, and only they are set up.
+# With skip_init, the modules are known to be installed on the master already, so
+# setup.sh doesn't run their init.sh scripts.
+def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key, new_slaves=None,
+                  skip_init=False):
     master = get_dns_name(master_nodes[0], opts.private_ips)
     if deploy_ssh_key:
         print("Generating cluster's SSH key on master...")
@@ -797,14 +1425,49 @@ def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
             (ssh-keygen -q -t rsa -N '' -f ~/.ssh/id_rsa &&
              cat ~/.ssh/id_rsa.pub >> ~/.ssh/authorized_keys)
         """
-        ssh(master, opts, key_setup)
-        dot_ssh_tar = ssh_read(master, opts, ['tar', 'c', '.ssh'])
+        with profiler.phase("generate SSH key"):
+            ssh(master, opts, key_setup)
+            dot_ssh_tar = ssh_read(master, opts, ['tar', 'c', '.ssh'])
         print("Transferring cluster's SSH key to slaves...")
-        for slave in slave_nodes:
-            slave_address = get_dns_name(slave, opts.private_ips)
-            print(slave_address)
-            ssh_write(slave_address, opts, ['tar', 'x'], dot_ssh_tar)
+        with profiler.phase("transfer SSH key"):
+            transfer_ssh_key(
+                hosts=[get_dns_name(slave, opts.private_ips)
+                       for slave in (slave_nodes if new_slaves is None else new_slaves)],
+                opts=opts,
+                dot_ssh_tar=dot_ssh_tar
+            )
+
+    deploy_spark_ec2(conn, master_nodes, slave_nodes, opts)
+
+    if new_slaves is None:
+        print("Running setup on master...")
+        with profiler.phase("setup.sh"):
+            setup_spark_cluster(master, opts, skip_init)
+    else:
+        print("Setting up the new slaves...")
+        with profiler.phase("resize-cluster.sh"):
+            resize_spark_cluster(master, opts, "add", new_slaves)
+    print("Done!")
+
+
+def remove_slaves(conn, master_nodes, slave_nodes, removed_slaves, opts):
+    """
+    Take removed_slaves out of the set up cluster, leaving it with slave_nodes:
+    their DataNodes are decommissioned, so that HDFS keeps a copy of their blocks
+    elsewhere, their worker, DataNode and NodeManager are stopped and they are
+    dropped from the master's slave lists. Terminating them is up to the caller.
+    """
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    deploy_spark_ec2(conn, master_nodes, slave_nodes, opts)
+    print("Removing slaves from the cluster...")
+    with profiler.phase("resize-cluster.sh"):
+        resize_spark_cluster(master, opts, "remove", removed_slaves)
+
 
+# Put a fresh copy of the spark-ec2 scripts on the master, along with the
+# configuration of a cluster made of master_nodes and slave_nodes.
+def deploy_spark_ec2(conn, master_nodes, slave_nodes, opts):
+    master = get_dns_name(master_nodes[0], opts.private_ips)
     modules = ['spark', 'ephemeral-hdfs', 'persistent-hdfs',
                'mapreduce', 'spark-standalone', 'tachyon', 'rstudio']
 
@@ -822,58 +1485,115 @@ def setup_cluster(conn, master_nodes, slave_nodes, opts, deploy_ssh_key):
     # prevent ec2-variables.sh from being overwritten
     print("Cloning spark-ec2 scripts from {r}/tree/{b} on master...".format(
         r=opts.spark_ec2_git_repo, b=opts.spark_ec2_git_branch))
-    ssh(
-        host=master,
-        opts=opts,
-        command="rm -rf spark-ec2"
-        + " && "
-        + "git clone {r} -b {b} spark-ec2".format(r=opts.spark_ec2_git_repo,
-                                                  b=opts.spark_ec2_git_branch)
-    )
+    with profiler.phase("clone spark-ec2"):
+        ssh(
+            host=master,
+            opts=opts,
+            command="rm -rf spark-ec2"
+            + " && "
+            + "git clone {r} -b {b} spark-ec2".format(r=opts.spark_ec2_git_repo,
+                                                      b=opts.spark_ec2_git_branch)
+        )
 
     print("Deploying files to master...")
-    deploy_files(
-        conn=conn,
-        root_dir=SPARK_EC2_DIR + "/" + "deploy.generic",
-        opts=opts,
-        master_nodes=master_nodes,
-        slave_nodes=slave_nodes,
-        modules=modules
-    )
+    with profiler.phase("deploy files"):
+        deploy_files(
+            conn=conn,
+            root_dir=SPARK_EC2_DIR + "/" + "deploy.generic",
+            opts=opts,
+            master_nodes=master_nodes,
+            slave_nodes=slave_nodes,
+            modules=modules
+        )
+        local_scripts = [os.path.join(os.path.dirname(SPARK_EC2_DIR), script)
+                         for script in LOCAL_SCRIPTS]
+        local_scripts = [path for path in local_scripts if os.path.isfile(path)]
+        if local_scripts:
+            subprocess.check_call(
+                ['rsync', '-cvz', '-e', stringify_command(ssh_command(opts))] +
+                local_scripts + ["%s@%s:spark-ec2/" % (opts.user, master)])
 
     if opts.deploy_root_dir is not None:
         print("Deploying {s} to master...".format(s=opts.deploy_root_dir))
-        deploy_user_files(
-            root_dir=opts.deploy_root_dir,
-            opts=opts,
-            master_nodes=master_nodes
-        )
+        with profiler.phase("deploy user files"):
+            deploy_user_files(
+                root_dir=opts.deploy_root_dir,
+                opts=opts,
+                master_nodes=master_nodes
+            )
 
-    print("Running setup on master...")
-    setup_spark_cluster(master, opts)
-    print("Done!")
 
+def transfer_ssh_key(hosts, opts, dot_ssh_tar):
+    """
+    Unpack the master's .ssh tarball on every host, writing to at most
+    opts.parallelism hosts at a time. Each host retries on its own (see ssh_write),
+    so one slow or flaky host doesn't hold up the others; hosts that still fail
+    are reported together at the end.
+    """
+    def transfer(host):
+        try:
+            ssh_write(host, opts, ['tar', 'x'], dot_ssh_tar)
+        except RuntimeError as e:
+            print("{h}: {e}".format(h=host, e=e), file=stderr)
+            return False
+        print(host)
+        return True
+
+    succeeded = parallel_map(transfer, hosts, opts.parallelism)
+    failed = [h for (h, ok) in zip(hosts, succeeded) if not ok]
+    if failed:
+        raise UsageError(
+            "Failed to transfer the cluster's SSH key to {n} host{s}:\n{h}".format(
+                n=len(failed), s=('' if len(failed) == 1 else 's'), h='\n'.join(failed)))
 
-def setup_spark_cluster(master, opts):
+
+def setup_spark_cluster(master, opts, skip_init=False):
     ssh(master, opts, "chmod u+x spark-ec2/setup.sh")
-    ssh(master, opts, "spark-ec2/setup.sh")
+    if skip_init and ssh_read(master, opts, "grep -q -e --skip-init spark-ec2/setup.sh && "
+                              "echo yes || echo no").strip() != b"yes":
+        print("The setup.sh of {r} ({b}) can't skip the module downloads, running all "
+              "of it".format(r=opts.spark_ec2_git_repo, b=opts.spark_ec2_git_branch),
+              file=stderr)
+        skip_init = False
+    ssh(master, opts, "spark-ec2/setup.sh" + (" --skip-init" if skip_init else ""),
+        on_output=profiler.add_remote_timing)
     print("Spark standalone cluster started at http://%s:8080" % master)
 
     if opts.ganglia:
         print("Ganglia started at http://%s:5080/ganglia" % master)
 
 
+def has_resize_script(master, opts):
+    return ssh_read(master, opts, "test -f spark-ec2/resize-cluster.sh && echo yes || "
+                    "echo no").strip() == b"yes"
+
+
+def resize_spark_cluster(master, opts, action, slaves):
+    # deploy_spark_ec2() copies it from this checkout, if it has it
+    if not has_resize_script(master, opts):
+        raise UsageError(
+            "resize-cluster.sh is missing from both {r} ({b}) and {d}; use a "
+            "--spark-ec2-git-repo/--spark-ec2-git-branch that has it".format(
+                r=opts.spark_ec2_git_repo, b=opts.spark_ec2_git_branch,
+                d=os.path.dirname(SPARK_EC2_DIR)))
+    ssh(master, opts,
+        ["bash", "spark-ec2/resize-cluster.sh", action] +
+        [get_dns_name(i, opts.private_ips) for i in slaves],
+        on_output=profiler.add_remote_timing)
+
+
 def is_ssh_available(host, opts, print_ssh_output=True):
     """
     Check if SSH is available on a host.
     """
-    s = subprocess.Popen(
-        ssh_command(opts) + ['-t', '-t', '-o', 'ConnectTimeout=3',
-                             '%s@%s' % (opts.user, host), stringify_command('true')],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT  # we pipe stderr through stdout to preserve output order
-    )
-    cmd_output = s.communicate()[0]  # [1] is stderr, which we redirected to stdout
+    with ssh_sessions.timed(host):
+        s = subprocess.Popen(
+            ssh_command(opts) + ['-t', '-t', '-o', 'ConnectTimeout=3',
+                                 '%s@%s' % (opts.user, host), stringify_command('true')],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT  # we pipe stderr through stdout to preserve output order
+        )
+        cmd_output = s.communicate()[0]  # [1] is stderr, which we redirected to stdout
 
     if s.returncode != 0 and print_ssh_output:
         # extra leading newline is for spacing in wait_for_cluster_state()
@@ -891,21 +1611,87 @@ def is_ssh_available(host, opts, print_ssh_output=True):
     return s.returncode == 0
 
 
+def get_boot_id(host, opts):
+    """
+    Return the boot id of a host, which changes every time it boots, or None if the
+    host can't be reached over SSH.
+    """
+    with ssh_sessions.timed(host):
+        with open(os.devnull, 'w') as devnull:
+            s = subprocess.Popen(
+                ssh_command(opts) + ['-o', 'ConnectTimeout=5', '%s@%s' % (opts.user, host),
+                                     stringify_command(['cat', '/proc/sys/kernel/random/boot_id'])],
+                stdout=subprocess.PIPE,
+                stderr=devnull
+            )
+            boot_id = s.communicate()[0].strip()
+    return boot_id if s.returncode == 0 and boot_id else None
+
+
+def get_ssh_ready_instances(cluster_instances, opts):
+    """
+    Probe SSH on the given instances in parallel, using at most opts.parallelism
+    concurrent connections.
+    Returns the list of instances that accepted an SSH connection.
+    """
+    def probe(instance):
+        return is_ssh_available(host=get_dns_name(instance, opts.private_ips), opts=opts)
+
+    available = parallel_map(probe, cluster_instances, opts.parallelism)
+    return [i for (i, ok) in zip(cluster_instances, available) if ok]
+
+
 def is_cluster_ssh_available(cluster_instances, opts):
     """
     Check if SSH is available on all the instances in a cluster.
     """
-    available_instances = 0
-    for i in cluster_instances:
-        dns_name = get_dns_name(i, opts.private_ips)
-        if not is_ssh_available(host=dns_name, opts=opts):
-            print("%d instances not SSH ready.\n" % (len(cluster_instances) - available_instances))
-            return False
-        else:
-            available_instances += 1
+    num_ready = len(get_ssh_ready_instances(cluster_instances, opts))
+    if num_ready < len(cluster_instances):
+        print("%d instances not SSH ready.\n" % (len(cluster_instances) - num_ready))
+        return False
     return True
 
 
+# Refresh the given boto Instance objects in place, issuing one DescribeInstances
+# call per batch of ids instead of one per instance (as Instance.update() does).
+# Instances EC2 doesn't know about yet (eventual consistency) are left untouched.
+def refresh_instances(conn, instances, max_batch=100):
+    by_id = dict((i.id, i) for i in instances)
+    ids = list(by_id)
+    for j in xrange(0, len(ids), max_batch):
+        batch = ids[j:j + max_batch]
+        try:
+            fresh_instances = conn.get_only_instances(instance_ids=batch)
+        except boto.exception.EC2ResponseError as e:
+            if e.error_code != "InvalidInstanceID.NotFound":
+                raise
+            # At least one id isn't visible yet; fall back to per-instance lookups
+            # for this batch only.
+            fresh_instances = []
+            for instance_id in batch:
+                try:
+                    fresh_instances += conn.get_only_instances(instance_ids=[instance_id])
+                except boto.exception.EC2ResponseError as e:
+                    if e.error_code != "InvalidInstanceID.NotFound":
+                        raise
+        for fresh in fresh_instances:
+            if fresh.id in by_id:
+                by_id[fresh.id]._update(fresh)
+
+
+def get_healthy_instance_ids(conn, instance_ids, max_batch=100):
+    """
+    Return the set of instance ids whose EC2 system and instance status checks both pass.
+    """
+    healthy = set()
+    for j in xrange(0, len(instance_ids), max_batch):
+        batch = instance_ids[j:j + max_batch]
+        for s in conn.get_all_instance_status(instance_ids=batch):
+            if s.system_status.status == 'ok' and s.instance_status.status == 'ok':
+                healthy.add(s.id)
+    return healthy
+
+
 def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
     """
     Wait for all the instances in the cluster to reach a designated state.
@@ -915,6 +1701,15 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
            value can be 'ssh-ready' or a valid value from boto.ec2.instance.InstanceState such as
            'running', 'terminated', etc.
            (would be nice to replace this with a proper enum: http://stackoverflow.com/a/1695250)
+
+    Every round refreshes all instances with batched DescribeInstances and
+    DescribeInstanceStatus calls, then probes SSH in parallel on the instances
+    that are running and pass their status checks. Instances that became
+    ssh-ready are remembered and not probed again. The poll interval starts
+    short and backs off while no instance makes progress.
+
+    Returns a dict mapping each instance id to the number of seconds it took to
+    reach the designated state.
     """
     sys.stdout.write(
         "Waiting for cluster to enter '{s}' state.".format(s=cluster_state)
@@ -922,33 +1717,47 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
     sys.stdout.flush()
 
     start_time = datetime.now()
-    num_attempts = 0
+    ready_times = {}
+    min_delay, max_delay = 5, 30  # seconds
+    delay = min_delay
 
     while True:
-        time.sleep(15)  # seconds
+        profiler.sleep(delay)
+        num_ready = len(ready_times)
+        elapsed = (datetime.now() - start_time).seconds
 
-        for i in cluster_instances:
-            i.update()
-
-        max_batch = 100
-        statuses = []
-        for j in xrange(0, len(cluster_instances), max_batch):
-            batch = [i.id for i in cluster_instances[j:j + max_batch]]
-            statuses.extend(conn.get_all_instance_status(instance_ids=batch))
+        if cluster_state == 'ssh-ready':
+            refresh_instances(conn, cluster_instances)
+        else:
+            # These instances are known to EC2 already, so a single request per
+            # 1000 of them is enough
+            refresh_instances(conn, cluster_instances, max_batch=1000)
 
         if cluster_state == 'ssh-ready':
-            if all(i.state == 'running' for i in cluster_instances):
-                if all(s.system_status.status == 'ok' for s in statuses) and \
-                    all(s.instance_status.status == 'ok' for s in statuses) and \
-                   is_cluster_ssh_available(cluster_instances, opts):
-                    break
-            else:
+            pending = [i for i in cluster_instances if i.id not in ready_times]
+            running = [i for i in pending if i.state == 'running']
+            if len(running) < len(pending):
                 sys.stdout.write("not all instances are running\n")
+            healthy_ids = get_healthy_instance_ids(conn, [i.id for i in running])
+            healthy = [i for i in running if i.id in healthy_ids]
+            for i in get_ssh_ready_instances(healthy, opts):
+                ready_times[i.id] = elapsed
+                emit_node_ready(i, cluster_state, elapsed, opts)
         else:
-            if all(i.state == cluster_state for i in cluster_instances):
-                break
+            for i in cluster_instances:
+                if i.state != cluster_state:
+                    ready_times.pop(i.id, None)
+                elif i.id not in ready_times:
+                    ready_times[i.id] = elapsed
+                    emit_node_ready(i, cluster_state, elapsed, opts)
+
+        if len(ready_times) == len(cluster_instances):
+            break
 
-        num_attempts += 1
+        if len(ready_times) > num_ready:
+            delay = min_delay
+        else:
+            delay = min(delay * 2, max_delay)
 
         sys.stdout.write(".")
         sys.stdout.flush()
@@ -960,22 +1769,503 @@ def wait_for_cluster_state(conn, opts, cluster_instances, cluster_state):
         s=cluster_state,
         t=(end_time - start_time).seconds
     ))
+    for i in sorted(cluster_instances, key=lambda i: ready_times[i.id]):
+        print("  {id} ({h}) reached '{s}' after {t} seconds".format(
+            id=i.id, h=get_dns_name(i, opts.private_ips), s=cluster_state, t=ready_times[i.id]))
+    return ready_times
 
 
-# Get number of local disks available for a given EC2 instance type.
-def get_num_disks(instance_type):
-    # Source: http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/InstanceStorage.html
-    # Last Updated: 2015-06-19
-    # For easy maintainability, please keep this manually-inputted dictionary sorted by key.
-    disks_by_instance = {
-        "c1.medium":   1,
-        "c1.xlarge":   4,
-        "c3.large":    2,
-        "c3.xlarge":   2,
-        "c3.2xlarge":  2,
-        "c3.4xlarge":  2,
-        "c3.8xlarge":  2,
-        "c4.large":    0,
+def emit_node_ready(instance, cluster_state, seconds, opts):
+    event_log.emit("node-ready", id=instance.id, state=cluster_state, seconds=seconds,
+                   host=get_dns_name(instance, opts.private_ips) or None,
+                   private_ip_address=instance.private_ip_address)
+
+
+def wait_for_volumes(conn, volume_ids, status, max_batch=200, timeout=900):
+    """
+    Wait for all the given EBS volumes to reach status, polling all of them with
+    batched DescribeVolumes calls every round. Volumes EC2 doesn't know about yet
+    (eventual consistency, right after CreateVolume) are waited on like the others.
+
+    Returns a dict mapping the volumes that did not get there (because they went
+    into the "error" state or the timeout expired) to their last status.
+    """
+    pending = set(volume_ids)
+    failed = {}
+    start_time = time.time()
+    min_delay, max_delay = 2, 15  # seconds
+    delay = min_delay
+    while pending:
+        ids = sorted(pending)
+        for j in xrange(0, len(ids), max_batch):
+            batch = ids[j:j + max_batch]
+            try:
+                volumes = conn.get_all_volumes(batch)
+            except boto.exception.EC2ResponseError as e:
+                if e.error_code != "InvalidVolume.NotFound":
+                    raise
+                # At least one id isn't visible yet; fall back to per-volume lookups
+                # for this batch only.
+                volumes = []
+                for vol_id in batch:
+                    try:
+                        volumes += conn.get_all_volumes([vol_id])
+                    except boto.exception.EC2ResponseError as e:
+                        if e.error_code != "InvalidVolume.NotFound":
+                            raise
+            for vol in volumes:
+                if vol.status == status:
+                    pending.discard(vol.id)
+                elif vol.status == "error":
+                    pending.discard(vol.id)
+                    failed[vol.id] = vol.status
+        if not pending:
+            break
+        if time.time() - start_time > timeout:
+            failed.update((vol_id, "timed out") for vol_id in pending)
+            break
+        profiler.sleep(delay)
+        delay = min(delay * 2, max_delay)
+    return failed
+
+
+def create_volumes(conn, opts, instances):
+    """
+    Create an EBS volume for each of the given instances and attach it as
+    opts.ebs_vol_dev_name.
+
+    All CreateVolume calls are sent up front and the new volumes are waited on
+    together; creating and attaching happen opts.parallelism at a time.
+
+    Returns a dict mapping the ids of the instances that didn't get a volume to
+    what went wrong.
+    """
+    failed = {}
+
+    def create(inst):
+        try:
+            # Volumes can only be attached to instances in the same zone
+            return conn.create_volume(opts.ebs_vol_size, inst.placement,
+                                      volume_type=opts.ebs_vol_type)
+        except boto.exception.EC2ResponseError as e:
+            failed[inst.id] = "creating a volume failed ({c})".format(c=e.error_code)
+
+    volumes = dict((inst.id, vol) for (inst, vol) in
+                   zip(instances, parallel_map(create, instances, opts.parallelism))
+                   if vol is not None)
+    for (inst_id, vol) in sorted(volumes.items()):
+        print("Created volume %s for instance %s" % (vol.id, inst_id))
+
+    print("Waiting for %d volumes to become available..." % len(volumes))
+    unavailable = wait_for_volumes(conn, [vol.id for vol in volumes.values()], "available")
+
+    def attach(inst_id):
+        vol = volumes[inst_id]
+        if vol.id in unavailable:
+            failed[inst_id] = "volume {v} is {s}".format(v=vol.id, s=unavailable[vol.id])
+            return
+        try:
+            conn.attach_volume(vol.id, inst_id, opts.ebs_vol_dev_name)
+            print("Attached volume %s to instance %s on device %s" %
+                  (vol.id, inst_id, opts.ebs_vol_dev_name))
+        except boto.exception.EC2ResponseError as e:
+            failed[inst_id] = "attaching volume {v} failed ({c})".format(
+                v=vol.id, c=e.error_code)
+
+    parallel_map(attach, list(volumes), opts.parallelism)
+    return failed
+
+
+def delete_volumes(conn, opts, instances):
+    """
+    Detach and delete the EBS volumes attached to the given instances as
+    opts.ebs_vol_dev_name.
+
+    All volumes are detached first and waited on together; detaching and deleting
+    happen opts.parallelism at a time.
+
+    Returns the ids of the deleted volumes and a dict mapping the ids of the instances
+    whose volume wasn't deleted to what went wrong.
+    """
+    failed = {}
+    deleted = []
+    volume_ids = {}
+    for inst in instances:
+        if opts.ebs_vol_dev_name not in inst.block_device_mapping:
+            print("Cannot find volume on %s on instance %s" % (opts.ebs_vol_dev_name, inst.id))
+        else:
+            volume_ids[inst.id] = inst.block_device_mapping[opts.ebs_vol_dev_name].volume_id
+
+    def detach(inst_id):
+        vol_id = volume_ids[inst_id]
+        print("Found volume %s on instance %s, detaching..." % (vol_id, inst_id))
+        try:
+            if conn.detach_volume(vol_id, inst_id):
+                return inst_id
+            failed[inst_id] = "detaching volume {v} failed".format(v=vol_id)
+        except boto.exception.EC2ResponseError as e:
+            failed[inst_id] = "detaching volume {v} failed ({c})".format(v=vol_id, c=e.error_code)
+
+    detached = [i for i in parallel_map(detach, list(volume_ids), opts.parallelism) if i]
+    print("Waiting for %d volumes to be detached..." % len(detached))
+    unavailable = wait_for_volumes(conn, [volume_ids[i] for i in detached], "available")
+
+    def delete(inst_id):
+        vol_id = volume_ids[inst_id]
+        if vol_id in unavailable:
+            failed[inst_id] = "volume {v} is {s}".format(v=vol_id, s=unavailable[vol_id])
+            return
+        try:
+            conn.delete_volume(vol_id)
+            print("Volume %s was successfully deleted" % vol_id)
+            deleted.append(vol_id)
+        except boto.exception.EC2ResponseError as e:
+            if e.error_code == "InvalidVolume.NotFound":
+                print("Volume %s was already deleted" % vol_id)
+                return
+            failed[inst_id] = "deleting volume {v} failed ({c})".format(v=vol_id, c=e.error_code)
+
+    parallel_map(delete, detached, opts.parallelism)
+    return (deleted, failed)
+
+
+def print_volume_failures(failed, num_instances):
+    if not failed:
+        print("Done with all %d instances." % num_instances)
+        return
+    print("Failed on %d of %d instances:" % (len(failed), num_instances), file=stderr)
+    for (inst_id, error) in sorted(failed.items()):
+        print("  %s: %s" % (inst_id, error), file=stderr)
+
+
+# Run on the master by probe_cluster_health(). Everything is collected at the same time
+# and printed in sections: the slaves the master knows, the NodeManagers YARN knows, the
+# HDFS report, the Spark master's state, the master's clock and, from every node, its
+# names and disk space.
+HEALTH_PROBE = r"""
+  out=$(mktemp -d)
+  node_info='echo names $(hostname) $(hostname -i); df -P -k /mnt* /vol* 2>/dev/null'
+  /root/ephemeral-hdfs/bin/yarn node -list -all > $out/yarn 2>/dev/null &
+  /root/ephemeral-hdfs/bin/hadoop dfsadmin -report > $out/hdfs 2>/dev/null &
+  curl -s --max-time 10 http://localhost:8080/json > $out/spark 2>/dev/null &
+  bash -c "$node_info" | sed 's/^/master /' > $out/nodes.master &
+  for node in $(cat /root/spark-ec2/slaves); do
+    ssh -o StrictHostKeyChecking=no -o ConnectTimeout=5 -o BatchMode=yes $node "$node_info" \
+      2>/dev/null | sed "s/^/$node /" > $out/nodes.$node &
+  done
+  wait
+  for section in yarn hdfs spark; do
+    echo "==> $section"
+    cat $out/$section
+    echo
+  done
+  echo "==> date"
+  LC_ALL=C date
+  echo "==> slaves"
+  cat /root/spark-ec2/slaves
+  echo "==> nodes"
+  cat $out/nodes.*
+  rm -rf $out
+"""
+
+
+def parse_date(text):
+    """
+    Parse a date as printed by date and by Java ("Sat Oct 17 10:00:00 UTC 2026"), in
+    seconds since the epoch if its time zone were the local one, or None if it can't.
+    """
+    fields = text.split()
+    try:
+        return time.mktime(time.strptime(" ".join(fields[:4] + fields[5:6]),
+                                         "%a %b %d %H:%M:%S %Y"))
+    except (ValueError, OverflowError):
+        return None
+
+
+# NodeManager states YARN reports
+YARN_NODE_STATES = ["NEW", "RUNNING", "UNHEALTHY", "DECOMMISSIONED", "LOST", "REBOOTED"]
+
+
+def probe_cluster_health(master, opts, min_free_disk=0.1):
+    """
+    Check the health of every node of the cluster with a single command on the master:
+    whether its NodeManager is running (on YARN), whether its DataNode is live, whether
+    its Spark worker is registered with the Spark master (if that one answers), and
+    whether its /mnt* and /vol* disks have at least min_free_disk of their space free.
+    The probe is retried a few times if it can't be run.
+
+    Returns a dict with "master" and "slaves", the latter a dict from the address of
+    every slave the master knows to its results:
+
+        {"reachable": True, "nodemanager": "RUNNING", "datanode": "live",
+         "spark_worker": "ALIVE", "disks": {"/mnt": 0.85}, "problems": [],
+         "nodemanager_ids": ["ip-10-0-0-1.ec2.internal:41234"], "datanode_contact": 2}
+
+    Daemons that are not known to their master are None. "nodemanager_ids" are the
+    Node-Ids the node's NodeManagers are RUNNING under, and "datanode_contact" is how
+    many seconds ago its DataNode last sent a heartbeat (None if unknown). "problems" lists what is
+    wrong with the node, so that the caller can repair just the nodes that need it.
+    The master only has "disks" and "problems", e.g. when HDFS or YARN don't answer.
+    """
+    tries = 0
+    while True:
+        try:
+            output = ssh_read(master, opts, HEALTH_PROBE)
+            break
+        except subprocess.CalledProcessError as e:
+            tries += 1
+            if tries > 2:
+                raise UsageError("Failed to probe the health of the cluster: {e}".format(e=e))
+            print("Error {0} while probing the cluster's health, retrying after {1} seconds".
+                  format(e.returncode, 10 * tries), file=stderr)
+            profiler.sleep(10 * tries)
+    if not isinstance(output, str):
+        output = output.decode("utf-8", "replace")
+    sections = dict.fromkeys(["yarn", "hdfs", "spark", "date", "slaves", "nodes"], "")
+    for part in re.compile(r"^==> ", re.M).split(output)[1:]:
+        (name, text) = part.split("\n", 1)
+        sections[name.strip()] = text
+
+    # The daemons' names for their node, by any of the node's names and addresses
+    nodemanagers = {}
+    nodemanager_ids = {}
+    for line in sections["yarn"].splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[1] in YARN_NODE_STATES:
+            host = fields[0].split(":")[0]
+            # A NodeManager that was restarted is listed again under a new Node-Id
+            if nodemanagers.get(host) != "RUNNING":
+                nodemanagers[host] = fields[1]
+            if fields[1] == "RUNNING":
+                nodemanager_ids.setdefault(host, []).append(fields[0])
+    now = parse_date(sections["date"])
+    datanodes = {}
+    datanode_contacts = {}
+    state = "live"
+    live_left = None
+    names = []
+    for line in sections["hdfs"].splitlines():
+        # "Live datanodes (N):" and "Dead datanodes (N):" on Hadoop 2
+        match = re.match(r"(Live|Dead) datanodes", line)
+        if match:
+            state = match.group(1).lower()
+        # "Datanodes available: N (M total, K dead)" on Hadoop 1, which lists the N live
+        # DataNodes first and then the dead ones
+        match = re.match(r"Datanodes available: (\d+)", line)
+        if match:
+            live_left = int(match.group(1))
+        # "Name: 10.0.0.1:50010 (ip-10-0-0-1.ec2.internal)"
+        match = re.match(r"Name: ([^:\s]+)(?::\d+)?(?: \((.+)\))?", line)
+        if match:
+            if live_left is not None:
+                state = live_left > 0 and "live" or "dead"
+                live_left -= 1
+            names = [name for name in match.groups() if name]
+            for name in names:
+                datanodes[name] = state
+        # "Last contact: Sat Oct 17 10:00:00 UTC 2026", by the master's clock
+        match = re.match(r"Last contact: (.+)", line)
+        if match:
+            contact = parse_date(match.group(1))
+            for name in names:
+                if now is not None and contact is not None:
+                    datanode_contacts[name] = now - contact
+    workers = {}
+    try:
+        for worker in json.loads(sections["spark"])["workers"]:
+            # Workers that were restarted stay listed as DEAD
+            if workers.get(worker["host"]) != "ALIVE":
+                workers[worker["host"]] = worker["state"]
+        spark_master_up = True
+    except (ValueError, KeyError):
+        spark_master_up = False
+
+    nodes = {}
+    for line in sections["nodes"].splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        node = nodes.setdefault(fields[0], {"names": set([fields[0]]), "disks": {}})
+        if fields[1] == "names":
+            node["names"].update(fields[2:])
+        elif len(fields) == 7 and fields[2].isdigit() and int(fields[2]) > 0:
+            # node, filesystem, 1024-blocks, used, available, capacity, mounted on
+            node["disks"][fields[6]] = int(fields[4]) / int(fields[2])
+
+    def disk_problems(address):
+        disks = nodes.get(address, {"disks": {}})["disks"]
+        return ["only {p:.0%} of {d} is free".format(p=free, d=disk)
+                for (disk, free) in sorted(disks.items()) if free < min_free_disk]
+
+    health = {
+        "master": {
+            "disks": nodes.get("master", {"disks": {}})["disks"],
+            "problems": disk_problems("master")
+        },
+        "slaves": {}
+    }
+    if opts.hadoop_major_version == "yarn" and not nodemanagers:
+        health["master"]["problems"].append("YARN doesn't know any NodeManager")
+    if not datanodes:
+        health["master"]["problems"].append("HDFS doesn't know any DataNode")
+
+    def lookup(names, states):
+        for name in names:
+            if name in states:
+                return states[name]
+        return None
+
+    for address in sections["slaves"].split():
+        node = nodes.get(address, {"names": set([address]), "disks": {}})
+        result = {
+            "reachable": address in nodes,
+            "nodemanager": lookup(node["names"], nodemanagers),
+            "datanode": lookup(node["names"], datanodes),
+            "spark_worker": lookup(node["names"], workers),
+            "disks": node["disks"],
+            "problems": disk_problems(address),
+            "nodemanager_ids": sorted(lookup(node["names"], nodemanager_ids) or []),
+            "datanode_contact": lookup(node["names"], datanode_contacts)
+        }
+        if not result["reachable"]:
+            result["problems"].append("can't be reached")
+        if opts.hadoop_major_version == "yarn" and result["nodemanager"] != "RUNNING":
+            result["problems"].append("NodeManager is {s}".format(
+                s=result["nodemanager"] or "not running"))
+        if result["datanode"] != "live":
+            result["problems"].append("DataNode is {s}".format(
+                s=result["datanode"] or "not running"))
+        if spark_master_up and result["spark_worker"] != "ALIVE":
+            result["problems"].append("Spark worker is {s}".format(
+                s=result["spark_worker"] or "not registered"))
+        health["slaves"][address] = result
+    return health
+
+
+def wait_for_registration(master, opts, before, booted, timeout=900):
+    """
+    Wait until the DataNodes and, on YARN, the NodeManagers of the slaves in before (a
+    dict from their addresses to their results of probe_cluster_health() from before
+    they were rebooted) that were up then are registered with their masters again.
+    The daemons of a node that went down stay reported live (RUNNING) until their
+    master gives up on them, so a DataNode has to have sent a heartbeat since the
+    slaves booted again (at booted, a time.time()), and a NodeManager has to be RUNNING
+    under a Node-Id it didn't have before (NodeManagers listen on a new port every time
+    they start). Raises a UsageError if that takes more than timeout seconds.
+    """
+    start_time = time.time()
+    delay = 5  # seconds
+    while True:
+        slaves = probe_cluster_health(master, opts)["slaves"]
+        waiting = {}
+        for (address, old) in before.items():
+            new = slaves.get(address, {})
+            daemons = []
+            contact = new.get("datanode_contact")
+            if old["datanode"] == "live" and (
+                    new.get("datanode") != "live" or contact is None or
+                    contact > time.time() - booted):
+                daemons.append("DataNode")
+            if old["nodemanager"] == "RUNNING" and \
+                    not set(new.get("nodemanager_ids", [])) - set(old["nodemanager_ids"]):
+                daemons.append("NodeManager")
+            if daemons:
+                waiting[address] = daemons
+        if not waiting:
+            return
+        if time.time() - start_time > timeout:
+            raise UsageError(
+                "These slaves didn't register with their masters again within {t} seconds: "
+                "{w}".format(t=timeout, w="; ".join(
+                    "{a} ({d})".format(a=a, d=", ".join(d)) for (a, d) in sorted(waiting.items()))))
+        profiler.sleep(delay)
+        delay = min(delay * 2, 30)
+
+
+def ensure_resize_script(conn, master_nodes, slave_nodes, opts):
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    # Clusters set up by older versions of spark-ec2 don't have resize-cluster.sh yet
+    if not has_resize_script(master, opts):
+        deploy_spark_ec2(conn, master_nodes, slave_nodes, opts)
+
+
+def reboot_instances(conn, opts, instances, timeout=900):
+    """
+    Reboot instances and wait until every one of them has booted again, as told by its
+    boot id, and can be reached over SSH. EC2 only reboots an instance some time after
+    it is asked to, so its state can't tell. Raises a UsageError if that takes more
+    than timeout seconds.
+    """
+    hosts = [get_dns_name(i, opts.private_ips) for i in instances]
+    boot_ids = parallel_map(lambda h: get_boot_id(h, opts), hosts, opts.parallelism)
+    for host in hosts:
+        ssh_sessions.forget(host)
+    for inst_id in batch_instance_action(conn, opts, "reboot", instances):
+        print("Rebooting " + inst_id)
+
+    start_time = time.time()
+    rebooting = dict(zip(hosts, boot_ids))
+    delay = 5  # seconds
+    while rebooting:
+        if time.time() - start_time > timeout:
+            raise UsageError("{n} instances didn't come back within {t} seconds of being "
+                             "rebooted: {h}".format(n=len(rebooting), t=timeout,
+                                                    h=", ".join(sorted(rebooting))))
+        profiler.sleep(delay)
+        delay = min(delay * 2, 30)
+        new_boot_ids = parallel_map(lambda h: get_boot_id(h, opts), list(rebooting),
+                                    opts.parallelism)
+        for (host, boot_id) in zip(list(rebooting), new_boot_ids):
+            if boot_id is not None and boot_id != rebooting[host]:
+                print("{h} is back after {t} seconds".format(
+                    h=host, t=int(time.time() - start_time)))
+                del rebooting[host]
+
+
+def rolling_reboot(conn, opts, master_nodes, slave_nodes, timeout=900):
+    """
+    Reboot slave_nodes opts.rolling_batch_size at a time. Once a batch is back up
+    (every node in it has booted again, as told by its boot id), its daemons are
+    started again, and the next batch is only rebooted after every DataNode and
+    NodeManager of the batch that was up before has registered with its master again
+    (see wait_for_registration()). Raises a UsageError, leaving the remaining batches
+    alone, if a batch doesn't come back within timeout seconds.
+    """
+    master = get_dns_name(master_nodes[0], opts.private_ips)
+    ensure_resize_script(conn, master_nodes, slave_nodes, opts)
+    batch_size = opts.rolling_batch_size
+    for n in xrange(0, len(slave_nodes), batch_size):
+        batch = slave_nodes[n:n + batch_size]
+        hosts = [get_dns_name(i, opts.private_ips) for i in batch]
+        print("Rebooting slaves {a}-{b} of {c}: {h}".format(
+            a=n + 1, b=n + len(batch), c=len(slave_nodes), h=", ".join(hosts)))
+        slaves = probe_cluster_health(master, opts)["slaves"]
+        before = dict((h, slaves[h]) for h in hosts if h in slaves)
+        with profiler.phase("reboot batch"):
+            reboot_instances(conn, opts, batch, timeout)
+        booted = time.time()
+
+        with profiler.phase("wait for health"):
+            resize_spark_cluster(master, opts, "start", batch)
+            wait_for_registration(master, opts, before, booted, timeout)
+        print("Slaves {a}-{b} are registered with their masters again".format(
+            a=n + 1, b=n + len(batch)))
+
+
+# Get number of local disks available for a given EC2 instance type.
+def get_num_disks(instance_type):
+    # Source: http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/InstanceStorage.html
+    # Last Updated: 2015-06-19
+    # For easy maintainability, please keep this manually-inputted dictionary sorted by key.
+    disks_by_instance = {
+        "c1.medium":   1,
+        "c1.xlarge":   4,
+        "c3.large":    2,
+        "c3.xlarge":   2,
+        "c3.2xlarge":  2,
+        "c3.4xlarge":  2,
+        "c3.8xlarge":  2,
+        "c4.large":    0,
         "c4.xlarge":   0,
         "c4.2xlarge":  0,
         "c4.4xlarge":  0,
@@ -1031,6 +2321,203 @@ def get_num_disks(instance_type):
         return 1
 
 
+# Get number of virtual CPUs for a given EC2 instance type.
+def get_num_vcpus(instance_type):
+    # Source: http://aws.amazon.com/ec2/instance-types/
+    # Last Updated: 2015-10-20
+    # For easy maintainability, please keep this manually-inputted dictionary sorted by key.
+    vcpus_by_instance = {
+        "c1.medium":   2,
+        "c1.xlarge":   8,
+        "c3.large":    2,
+        "c3.xlarge":   4,
+        "c3.2xlarge":  8,
+        "c3.4xlarge":  16,
+        "c3.8xlarge":  32,
+        "c4.large":    2,
+        "c4.xlarge":   4,
+        "c4.2xlarge":  8,
+        "c4.4xlarge":  16,
+        "c4.8xlarge":  36,
+        "cc1.4xlarge": 16,
+        "cc2.8xlarge": 32,
+        "cg1.4xlarge": 16,
+        "cr1.8xlarge": 32,
+        "d2.xlarge":   4,
+        "d2.2xlarge":  8,
+        "d2.4xlarge":  16,
+        "d2.8xlarge":  36,
+        "g2.2xlarge":  8,
+        "g2.8xlarge":  32,
+        "hi1.4xlarge": 16,
+        "hs1.8xlarge": 16,
+        "i2.xlarge":   4,
+        "i2.2xlarge":  8,
+        "i2.4xlarge":  16,
+        "i2.8xlarge":  32,
+        "m1.small":    1,
+        "m1.medium":   1,
+        "m1.large":    2,
+        "m1.xlarge":   4,
+        "m2.xlarge":   2,
+        "m2.2xlarge":  4,
+        "m2.4xlarge":  8,
+        "m3.medium":   1,
+        "m3.large":    2,
+        "m3.xlarge":   4,
+        "m3.2xlarge":  8,
+        "m4.large":    2,
+        "m4.xlarge":   4,
+        "m4.2xlarge":  8,
+        "m4.4xlarge":  16,
+        "m4.10xlarge": 40,
+        "r3.large":    2,
+        "r3.xlarge":   4,
+        "r3.2xlarge":  8,
+        "r3.4xlarge":  16,
+        "r3.8xlarge":  32,
+        "t1.micro":    1,
+        "t2.micro":    1,
+        "t2.small":    1,
+        "t2.medium":   2,
+        "t2.large":    2,
+    }
+    if instance_type in vcpus_by_instance:
+        return vcpus_by_instance[instance_type]
+    else:
+        print("WARNING: Don't know number of vCPUs on instance type %s; assuming 1"
+              % instance_type, file=stderr)
+        return 1
+
+
+def get_spot_price_history(conn, instance_type, product_description, start_time, end_time):
+    """
+    Fetch the complete spot price history of an instance type between two datetimes,
+    following DescribeSpotPriceHistory's pagination.
+    Returns a list of boto.ec2.spotpricehistory.SpotPriceHistory.
+    """
+    history = []
+    next_token = None
+    while True:
+        page = conn.get_spot_price_history(
+            start_time=start_time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            end_time=end_time.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            instance_type=instance_type,
+            product_description=product_description,
+            max_results=1000,
+            next_token=next_token)
+        history += page
+        next_token = page.next_token
+        if not next_token:
+            return history
+
+
+def get_spot_price_stats(history, end_time, bid):
+    """
+    Compute time-weighted statistics of one zone's spot price history: each price
+    counts for as long as it was in effect, up to end_time.
+
+    bid: the price to evaluate the interruption risk at, or None to recommend a bid
+         (10% over the 95th percentile price).
+
+    Returns a dict with the median, p95, mean and max price, the volatility (standard
+    deviation over mean), the bid, and the fraction of time spent above the bid.
+    """
+    points = sorted((datetime.strptime(h.timestamp[:19], "%Y-%m-%dT%H:%M:%S"), h.price)
+                    for h in history)
+    weighted = []
+    for (n, (timestamp, price)) in enumerate(points):
+        until = points[n + 1][0] if n + 1 < len(points) else end_time
+        duration = until - timestamp
+        weighted.append((price, max(duration.days * 86400 + duration.seconds, 1)))
+    total = sum(w for (p, w) in weighted)
+
+    def percentile(fraction):
+        seen = 0
+        for (price, w) in sorted(weighted):
+            seen += w
+            if seen >= fraction * total:
+                return price
+        return weighted[-1][0]
+
+    mean = sum(p * w for (p, w) in weighted) / total
+    variance = sum((p - mean) ** 2 * w for (p, w) in weighted) / total
+    p95 = percentile(0.95)
+    if bid is None:
+        bid = round(p95 * 1.1, 3)
+    return {
+        "median": percentile(0.5),
+        "p95": p95,
+        "mean": mean,
+        "max": max(p for (p, w) in weighted),
+        "volatility": (variance ** 0.5) / mean if mean else 0.0,
+        "bid": bid,
+        "above_bid": sum(w for (p, w) in weighted if p > bid) / total
+    }
+
+
+def get_spot_price_advice(conn, opts, instance_types):
+    """
+    Rank every (instance type, zone) pair by the expected cost per vCPU-hour of
+    running spot instances there, based on the last opts.price_history_days of prices.
+
+    Pairs whose price spent more than opts.max_spot_risk of the time above the bid
+    (opts.spot_price, or a recommended bid if it isn't set) are ranked last, by
+    increasing risk.
+
+    Returns a list of dicts, best first, holding the instance type, zone, number
+    of vCPUs, cost per vCPU-hour and the statistics from get_spot_price_stats.
+    """
+    end_time = datetime.utcnow()
+    start_time = end_time - timedelta(days=opts.price_history_days)
+    product_description = "Linux/UNIX" if opts.vpc_id is None else "Linux/UNIX (Amazon VPC)"
+    zones = set(z.name for z in conn.get_all_zones())
+
+    def fetch(instance_type):
+        return get_spot_price_history(
+            conn, instance_type, product_description, start_time, end_time)
+
+    advice = []
+    for (instance_type, history) in zip(instance_types,
+                                        parallel_map(fetch, instance_types, opts.parallelism)):
+        by_zone = {}
+        for h in history:
+            if h.availability_zone in zones:
+                by_zone.setdefault(h.availability_zone, []).append(h)
+        num_vcpus = get_num_vcpus(instance_type)
+        for (zone, zone_history) in by_zone.items():
+            stats = get_spot_price_stats(zone_history, end_time, opts.spot_price)
+            stats.update({
+                "instance_type": instance_type,
+                "zone": zone,
+                "vcpus": num_vcpus,
+                "vcpu_hour": stats["mean"] / num_vcpus
+            })
+            advice.append(stats)
+
+    def rank(a):
+        if a["above_bid"] > opts.max_spot_risk:
+            return (1, a["above_bid"], a["vcpu_hour"])
+        return (0, a["vcpu_hour"], a["above_bid"])
+
+    return sorted(advice, key=rank)
+
+
+def print_spot_price_advice(advice, opts):
+    print("Spot prices over the last {d} days (time-weighted, in $/hour):".format(
+        d=opts.price_history_days))
+    print("{t:<12} {z:<12} {med:>8} {p95:>8} {max:>8} {vol:>6} {bid:>8} {above:>7} {vh:>9}".format(
+        t="type", z="zone", med="median", p95="p95", max="max", vol="vol",
+        bid="bid", above=">bid", vh="$/vCPU-h"))
+    for a in advice:
+        print("{instance_type:<12} {zone:<12} {median:>8.4f} {p95:>8.4f} {max:>8.4f} "
+              "{volatility:>6.2f} {bid:>8.3f} {above_bid:>7.1%} {vcpu_hour:>9.5f}".format(**a))
+    if advice:
+        best = advice[0]
+        print("Recommended: --instance-type {t} --zone {z} --spot-price {b:.3f}".format(
+            t=best["instance_type"], z=best["zone"], b=best["bid"]))
+
+
 # Deploy the configuration file templates in a given local directory to
 # a cluster, filling in any template parameters with information about the
 # cluster (e.g. lists of masters and slaves). Files are only deployed to
@@ -1091,36 +2578,137 @@ def deploy_files(conn, root_dir, opts, master_nodes, slave_nodes, modules):
         template_vars["aws_access_key_id"] = ""
         template_vars["aws_secret_access_key"] = ""
 
-    # Create a temp directory in which we will place all the files to be
-    # deployed after we substitue template parameters in them
-    tmp_dir = tempfile.mkdtemp()
+    # Render the templates into a staging directory that is kept between runs, so that
+    # rsync (comparing checksums) only sends the files whose content actually changed.
+    # Files with AWS credentials in them are only rendered into a temporary directory.
+    staging_dir = get_staging_dir(opts, active_master)
+    secret_dir = tempfile.mkdtemp()
+    try:
+        render_templates(root_dir, os.path.join(staging_dir, "files"), template_vars, opts,
+                         secret_dir=secret_dir, secret_vars=AWS_CREDENTIAL_VARS)
+        # rsync both directories over to the master machine
+        command = [
+            'rsync', '-rcvz',
+            '-e', stringify_command(ssh_command(opts)),
+            "%s/" % os.path.join(staging_dir, "files"),
+            "%s/" % secret_dir,
+            "%s@%s:/" % (opts.user, active_master)
+        ]
+        subprocess.check_call(command)
+    finally:
+        shutil.rmtree(secret_dir)
+
+
+# Template variables deploy_files() never keeps rendered files of in the staging directory
+AWS_CREDENTIAL_VARS = ["aws_access_key_id", "aws_secret_access_key"]
+
+
+def get_staging_dir(opts, master):
+    return os.path.join(SPARK_EC2_CACHE_DIR, "staging", master)
+
+
+def forget_staging_dirs(opts, master_nodes):
+    """
+    Remove the files deploy_files() kept for master_nodes, under any of their addresses.
+    """
+    for instance in master_nodes:
+        for address in set([instance.public_dns_name, instance.private_ip_address]):
+            if address:
+                shutil.rmtree(get_staging_dir(opts, address), ignore_errors=True)
+
+
+# Templates compiled by compile_template(), by path, along with the file's mtime
+_compiled_templates = {}
+
+TEMPLATE_VAR_PATTERN = re.compile(r"\{\{(\w+)\}\}")
+
+
+def compile_template(path):
+    """
+    Split a template file into a list alternating literal text and variable names,
+    so that rendering it is a single pass over the parts. The result is cached until
+    the file changes.
+    """
+    mtime = os.path.getmtime(path)
+    if path not in _compiled_templates or _compiled_templates[path][0] != mtime:
+        with open(path) as src:
+            _compiled_templates[path] = (mtime, TEMPLATE_VAR_PATTERN.split(src.read()))
+    return _compiled_templates[path][1]
+
+
+def render_template(parts, template_vars):
+    # Odd parts are variable names; unknown variables are left as they are
+    return ''.join(
+        part if n % 2 == 0 else template_vars.get(part, "{{" + part + "}}")
+        for (n, part) in enumerate(parts))
+
+
+def render_templates(root_dir, dest_dir, template_vars, opts, secret_dir=None, secret_vars=()):
+    """
+    Render all the templates under root_dir into dest_dir, opts.parallelism at a time.
+
+    dest_dir is meant to persist between runs: a manifest of content hashes next to it
+    records what was rendered last time, so files whose content didn't change are left
+    untouched, and files that are no longer rendered are removed. Templates that use one
+    of secret_vars with a value are rendered into secret_dir instead, which is left to
+    the caller to remove. Rendered files are only readable by their owner.
+    """
+    templates = []
     for path, dirs, files in os.walk(root_dir):
         if path.find(".svn") == -1:
-            dest_dir = os.path.join('/', path[len(root_dir):])
-            local_dir = tmp_dir + dest_dir
-            if not os.path.exists(local_dir):
-                os.makedirs(local_dir)
             for filename in files:
                 if filename[0] not in '#.~' and filename[-1] != '~':
-                    dest_file = os.path.join(dest_dir, filename)
-                    local_file = tmp_dir + dest_file
-                    with open(os.path.join(path, filename)) as src:
-                        with open(local_file, "w") as dest:
-                            text = src.read()
-                            for key in template_vars:
-                                text = text.replace("{{" + key + "}}", template_vars[key])
-                            dest.write(text)
-                            dest.close()
-    # rsync the whole directory over to the master machine
-    command = [
-        'rsync', '-rv',
-        '-e', stringify_command(ssh_command(opts)),
-        "%s/" % tmp_dir,
-        "%s@%s:/" % (opts.user, active_master)
-    ]
-    subprocess.check_call(command)
-    # Remove the temp directory we created above
-    shutil.rmtree(tmp_dir)
+                    templates.append(os.path.relpath(os.path.join(path, filename), root_dir))
+
+    manifest_path = dest_dir.rstrip("/") + ".manifest.json"
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    os.chmod(os.path.dirname(dest_dir.rstrip("/")), S_IRWXU)
+    secret_vars = set(v for v in secret_vars if template_vars.get(v))
+
+    def write(dest_file, text):
+        if not os.path.isdir(os.path.dirname(dest_file)):
+            try:
+                os.makedirs(os.path.dirname(dest_file))
+            except OSError:
+                # Created by another worker in the meantime
+                pass
+        with os.fdopen(os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+                       "w") as dest:
+            dest.write(text)
+        os.chmod(dest_file, 0o600)
+
+    def render(template):
+        parts = compile_template(os.path.join(root_dir, template))
+        text = render_template(parts, template_vars)
+        if secret_vars.intersection(parts[1::2]):
+            write(os.path.join(secret_dir, template), text)
+            return None
+        digest = hashlib.sha1(text if isinstance(text, bytes) else text.encode("utf-8"))
+        digest = digest.hexdigest()
+        dest_file = os.path.join(dest_dir, template)
+        if manifest.get(template) != digest or not os.path.isfile(dest_file):
+            write(dest_file, text)
+        return digest
+
+    new_manifest = dict((template, digest) for (template, digest) in
+                        zip(templates, parallel_map(render, templates, opts.parallelism))
+                        if digest is not None)
+    for template in set(manifest) - set(new_manifest):
+        stale_file = os.path.join(dest_dir, template)
+        if os.path.isfile(stale_file):
+            os.remove(stale_file)
+
+    tmp_path = "%s.%d" % (manifest_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(new_manifest, f, indent=2)
+    os.rename(tmp_path, manifest_path)
 
 
 # Deploy a given local directory to a cluster, WITHOUT parameter substitution.
@@ -1152,6 +2740,8 @@ def ssh_args(opts):
     parts += ['-o', 'UserKnownHostsFile=/dev/null']
     if opts.identity_file is not None:
         parts += ['-i', opts.identity_file]
+    if opts.ssh_multiplexing:
+        parts += ssh_sessions.control_args()
     return parts
 
 
@@ -1159,15 +2749,478 @@ def ssh_command(opts):
     return ['ssh'] + ssh_args(opts)
 
 
+class SSHSessions(object):
+    """
+    Shares one SSH connection per host between all the remote commands spark-ec2 runs.
+
+    The first command sent to a host starts a background ControlMaster for it, and
+    every later ssh/rsync invocation goes through that master's socket instead of
+    doing a full handshake. Commands are run with ControlMaster=no, so they fall back
+    to a direct connection whenever a host has no master (yet). All masters are shut
+    down when spark-ec2 exits.
+
+    Also keeps per-host counts of remote commands and the time spent in them.
+    """
+
+    # How long an idle master is kept around, in case close() never gets to run.
+    control_persist = 600  # seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.control_dir = None
+        self.masters = {}  # host -> command that stops its master, or None while starting
+        self.commands = {}  # host -> number of remote commands
+        self.seconds = {}  # host -> seconds spent in remote commands
+
+    def control_path(self):
+        with self.lock:
+            if self.control_dir is None:
+                # Keep this short: unix socket paths are limited to ~100 characters.
+                self.control_dir = tempfile.mkdtemp(prefix="spark-ec2-", dir="/tmp")
+                atexit.register(self.close)
+        return os.path.join(self.control_dir, "%r@%h:%p")
+
+    def control_args(self):
+        return ['-o', 'ControlMaster=no', '-o', 'ControlPath=' + self.control_path()]
+
+    def open(self, host, opts):
+        """
+        Start a ControlMaster for host unless there already is one.
+        Failures are ignored: commands then simply connect directly.
+        """
+        if not opts.ssh_multiplexing:
+            return
+        with self.lock:
+            if host in self.masters:
+                return
+            self.masters[host] = None
+        target = '%s@%s' % (opts.user, host)
+        # ControlMaster=yes has to come before ssh_command()'s ControlMaster=no,
+        # since ssh uses the first value given for an option.
+        command = ['ssh', '-o', 'ControlMaster=yes',
+                   '-o', 'ControlPersist=%d' % self.control_persist,
+                   '-o', 'ConnectTimeout=10'] + ssh_args(opts)
+        with open(os.devnull, 'r+') as devnull:
+            # -f backgrounds the master once it is authenticated; it must not keep our
+            # stdout/stderr open, or callers reading them would wait for it to exit.
+            status = subprocess.call(command + ['-N', '-f', target],
+                                     stdin=devnull, stdout=devnull, stderr=devnull)
+        exit_command = ssh_command(opts) + ['-O', 'exit', target]
+        with self.lock:
+            if status == 0:
+                self.masters[host] = exit_command
+            else:
+                del self.masters[host]
+
+    def forget(self, host):
+        """
+        Stop host's master, if it has one, e.g. because host is about to be rebooted.
+        The next command sent to host starts a new master.
+        """
+        with self.lock:
+            exit_command = self.masters.pop(host, None)
+        if exit_command is not None:
+            with open(os.devnull, 'r+') as devnull:
+                subprocess.call(exit_command, stdin=devnull, stdout=devnull, stderr=devnull)
+
+    @contextlib.contextmanager
+    def timed(self, host):
+        """
+        Count the enclosed block as one remote command sent to host.
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.commands[host] = self.commands.get(host, 0) + 1
+                self.seconds[host] = self.seconds.get(host, 0) + time.time() - start_time
+
+    def stats(self):
+        """
+        Return a dict mapping each host to a (number of commands, seconds spent) tuple.
+        """
+        with self.lock:
+            return dict((h, (self.commands[h], self.seconds[h])) for h in self.commands)
+
+    def close(self):
+        with self.lock:
+            masters = [(h, c) for (h, c) in self.masters.items() if c is not None]
+            self.masters = {}
+            control_dir, self.control_dir = self.control_dir, None
+        with open(os.devnull, 'r+') as devnull:
+            for (host, exit_command) in masters:
+                subprocess.call(exit_command, stdin=devnull, stdout=devnull, stderr=devnull)
+        if control_dir is not None:
+            shutil.rmtree(control_dir, ignore_errors=True)
+
+
+ssh_sessions = SSHSessions()
+
+
+class PhaseProfiler(object):
+    """
+    Records where the time of a spark-ec2 run goes.
+
+    Code that makes up a phase of the run is wrapped in phase(name); phases can nest.
+    For every phase we keep its wall time, the EC2 API calls made (counted by
+    instrument_connection()), the remote commands sent (from ssh_sessions) and the time
+    spent sleeping between polls and retries (see sleep()). The "[timing]" lines that
+    setup.sh prints on the master are recorded too, see add_remote_timing().
+    """
+
+    REMOTE_TIMING_PATTERN = re.compile(r"\[timing\] (.+?):\s+(\d+)h (\d+)m (\d+)s")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.trace_path = None  # where report() writes the trace; nothing is reported if None
+        self.api_calls = {}  # EC2 API action -> number of calls
+        self.sleep_seconds = 0
+        self.depth = 0
+        self.phases = []  # finished phases, as dicts
+        self.remote_timings = []  # (name, start time, end time)
+
+    def count_api_call(self, action):
+        with self.lock:
+            self.api_calls[action] = self.api_calls.get(action, 0) + 1
+
+    def sleep(self, seconds):
+        """
+        time.sleep(), counted as time spent waiting in the current phase.
+        """
+        time.sleep(seconds)
+        with self.lock:
+            self.sleep_seconds += seconds
+
+    def _counters(self):
+        with self.lock:
+            api_calls = dict(self.api_calls)
+            sleep_seconds = self.sleep_seconds
+        ssh_commands = sum(n for (n, seconds) in ssh_sessions.stats().values())
+        return (api_calls, ssh_commands, sleep_seconds)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        (api_calls, ssh_commands, sleep_seconds) = self._counters()
+        start_time = time.time()
+        event_log.emit("phase-start", phase=name, depth=self.depth)
+        self.depth += 1
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.depth -= 1
+            end_time = time.time()
+            (end_api_calls, end_ssh_commands, end_sleep_seconds) = self._counters()
+            phase = {
+                "name": name,
+                "depth": self.depth,
+                "start": start_time,
+                "end": end_time,
+                "api_calls": dict((a, n - api_calls.get(a, 0))
+                                  for (a, n) in end_api_calls.items()
+                                  if n > api_calls.get(a, 0)),
+                "ssh_commands": end_ssh_commands - ssh_commands,
+                "sleep_seconds": end_sleep_seconds - sleep_seconds
+            }
+            self.phases.append(phase)
+            event_log.emit(
+                "phase-end", phase=name, depth=self.depth, ok=ok,
+                seconds=round(end_time - start_time, 3), api_calls=phase["api_calls"],
+                ssh_commands=phase["ssh_commands"], sleep_seconds=phase["sleep_seconds"])
+
+    def add_remote_timing(self, line):
+        """
+        Record a step of the remote setup if line is one of setup.sh's "[timing]" lines.
+        The step is taken to have ended when its line was printed.
+        """
+        match = self.REMOTE_TIMING_PATTERN.search(line)
+        if match:
+            (h, m, s) = [int(g) for g in match.group(2, 3, 4)]
+            end_time = time.time()
+            self.remote_timings.append(
+                (match.group(1).strip(), end_time - (h * 3600 + m * 60 + s), end_time))
+
+    def write_trace(self, path):
+        def micros(t):
+            return int((t - self.start_time) * 1000000)
+
+        events = [{"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "spark-ec2"}},
+                  {"name": "thread_name", "ph": "M", "pid": 1, "tid": 1,
+                   "args": {"name": "local"}},
+                  {"name": "thread_name", "ph": "M", "pid": 1, "tid": 2,
+                   "args": {"name": "setup.sh on master"}}]
+        for p in self.phases:
+            events.append({
+                "name": p["name"], "cat": "phase", "ph": "X", "pid": 1, "tid": 1,
+                "ts": micros(p["start"]), "dur": micros(p["end"]) - micros(p["start"]),
+                "args": {"api_calls": p["api_calls"],
+                         "ssh_commands": p["ssh_commands"],
+                         "sleep_seconds": p["sleep_seconds"]}
+            })
+        for (name, start_time, end_time) in self.remote_timings:
+            events.append({
+                "name": name, "cat": "remote", "ph": "X", "pid": 1, "tid": 2,
+                "ts": micros(start_time), "dur": micros(end_time) - micros(start_time)
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, indent=1)
+
+    def print_summary(self):
+        print("\n{0:<40} {1:>9} {2:>9} {3:>8} {4:>9}".format(
+            "Phase", "Wall (s)", "API calls", "SSH cmds", "Sleep (s)"))
+        for p in sorted(self.phases, key=lambda p: (p["start"], p["depth"])):
+            print("{0:<40} {1:>9.1f} {2:>9} {3:>8} {4:>9.1f}".format(
+                ("  " * p["depth"] + p["name"])[:40],
+                p["end"] - p["start"],
+                sum(p["api_calls"].values()),
+                p["ssh_commands"],
+                p["sleep_seconds"]))
+        for (name, start_time, end_time) in self.remote_timings:
+            print("{0:<40} {1:>9.1f}".format(("  [setup.sh] " + name)[:40], end_time - start_time))
+        (api_calls, ssh_commands, sleep_seconds) = self._counters()
+        print("{0:<40} {1:>9.1f} {2:>9} {3:>8} {4:>9.1f}".format(
+            "total", time.time() - self.start_time, sum(api_calls.values()), ssh_commands,
+            sleep_seconds))
+
+    def report(self):
+        if self.trace_path is None:
+            return
+        self.print_summary()
+        self.write_trace(self.trace_path)
+        print("Wrote trace of this run to " + self.trace_path)
+
+
+profiler = PhaseProfiler()
+
+
+class APIRateLimiter(object):
+    """
+    Token bucket shared by all the threads sending EC2 API requests.
+
+    Requests are let through at up to `rate` per second on average, with bursts of up
+    to `burst` requests. When EC2 throttles us anyway the rate is halved, so we stop
+    adding to the pile of throttled requests (see instrument_connection()).
+    """
+
+    def __init__(self, rate=20, burst=40):
+        self.lock = threading.Lock()
+        self.configure(rate, burst)
+        self.throttled = 0  # requests EC2 throttled
+        self.wait_seconds = 0  # time requests were held back
+
+    def configure(self, rate, burst):
+        with self.lock:
+            self.rate = float(rate)
+            self.burst = float(burst)
+            self.tokens = self.burst
+            self.last_refill = time.time()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Take the token right away, even if that leaves the bucket in debt, and
+            # wait for the debt to be paid off outside the lock.
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.wait_seconds += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttle(self):
+        with self.lock:
+            self.throttled += 1
+            self.rate = max(1.0, self.rate / 2)
+
+    def report(self):
+        """
+        Print the EC2 API requests sent during this run, per action.
+        """
+        if not profiler.api_calls:
+            return
+        print("EC2 API requests: {c} ({t} throttled, held back {w:.1f}s in total)".format(
+            c=", ".join("%s %d" % (a, n) for (a, n) in sorted(profiler.api_calls.items())),
+            t=self.throttled, w=self.wait_seconds), file=stderr)
+
+
+api_limiter = APIRateLimiter()
+
+
+class EventLog(object):
+    """
+    Newline-delimited JSON events about a spark-ec2 run (see --output json), for
+    orchestration code to consume as they happen.
+
+    Every event is a JSON object on a line of its own with an "event" and a "time"
+    field. Once open() was called, stdout carries nothing but events: everything else
+    printed, including the output of ssh and rsync, goes to stderr instead.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.out = None
+
+    @property
+    def enabled(self):
+        return self.out is not None
+
+    def open(self):
+        sys.stdout.flush()
+        self.out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        # Child processes inherit file descriptor 1, so point it at stderr itself
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def emit(self, event, **fields):
+        if self.out is None:
+            return
+        fields["event"] = event
+        fields["time"] = round(time.time(), 3)
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            self.out.write(line + "\n")
+            self.out.flush()
+
+
+event_log = EventLog()
+
+
+def describe_instance(instance):
+    return {
+        "id": instance.id,
+        "state": instance.state,
+        "instance_type": instance.instance_type,
+        "zone": instance.placement,
+        "public_dns_name": instance.public_dns_name or None,
+        "public_ip_address": instance.ip_address,
+        "private_dns_name": instance.private_dns_name or None,
+        "private_ip_address": instance.private_ip_address
+    }
+
+
+def emit_cluster(cluster_name, master_nodes, slave_nodes, opts):
+    """
+    Emit the final "cluster" event of a run: the cluster's instances and their addresses.
+    """
+    if not event_log.enabled:
+        return
+    master = get_dns_name(master_nodes[0], opts.private_ips) if master_nodes else None
+    event_log.emit(
+        "cluster",
+        name=cluster_name,
+        region=opts.region,
+        master=master or None,
+        masters=[describe_instance(i) for i in master_nodes],
+        slaves=[describe_instance(i) for i in slave_nodes])
+
+
+# Error codes of the requests EC2 throttled
+THROTTLING_ERRORS = ["RequestLimitExceeded", "Throttling"]
+
+
+def instrument_connection(conn):
+    """
+    Route all the EC2 API requests made through conn by api_limiter, and count them
+    per action in profiler. That includes boto's retries: the first throttled response
+    (a 503, or a 400 with one of THROTTLING_ERRORS) lowers the rate, and the request
+    is retried through api_limiter, up to boto's number of retries.
+    """
+    make_request = conn.make_request
+    mexe = conn._mexe
+
+    def retry_throttled(action, num_retries, response, i, next_sleep):
+        # Called by boto's _mexe() with every response, before it retries 5xx ones
+        if response.status == 400:
+            # boto caches the body, so the caller can still read() it
+            error = boto.exception.EC2ResponseError(
+                response.status, response.reason, response.read())
+            if error.error_code not in THROTTLING_ERRORS:
+                return None
+        elif response.status != 503:
+            return None
+        api_limiter.throttle()
+        if i >= num_retries:
+            return None
+        api_limiter.acquire()
+        profiler.count_api_call(action)
+        if response.status == 503:
+            # boto retries it itself, after next_sleep
+            return None
+        return ("Throttled, retrying in %3.1f seconds" % next_sleep, i + 1, next_sleep)
+
+    def limited_mexe(request, sender=None, override_num_retries=None, retry_handler=None):
+        if retry_handler is None:
+            num_retries = override_num_retries
+            if num_retries is None:
+                num_retries = boto.config.getint('Boto', 'num_retries', conn.num_retries)
+            action = request.params.get("Action")
+            retry_handler = lambda response, i, next_sleep: retry_throttled(
+                action, num_retries, response, i, next_sleep)
+        return mexe(request, sender, override_num_retries, retry_handler)
+
+    def limited_make_request(action, *args, **kwargs):
+        api_limiter.acquire()
+        profiler.count_api_call(action)
+        try:
+            response = make_request(action, *args, **kwargs)
+        except boto.exception.BotoServerError as e:
+            # What boto raises once it gave up retrying 5xx responses
+            if event_log.enabled:
+                event_log.emit("api-error", action=action, status=e.status,
+                               code=e.error_code, message=e.error_message)
+            raise
+        status = getattr(response, "status", None)
+        if event_log.enabled and status is not None and status >= 400:
+            # boto caches the body, so the caller can still read() it to raise its error
+            error = boto.exception.EC2ResponseError(status, response.reason, response.read())
+            event_log.emit("api-error", action=action, status=status,
+                           code=error.error_code, message=error.error_message)
+        return response
+
+    conn._mexe = limited_mexe
+    conn.make_request = limited_make_request
+    return conn
+
+
+def batch_instance_action(conn, opts, action, instances, max_batch=1000):
+    """
+    Start, stop, terminate or reboot (action) instances with one API request per
+    max_batch instances rather than one per instance, sending up to opts.parallelism
+    requests at a time. Returns the ids acted on.
+    """
+    instance_ids = [i.id for i in instances]
+
+    def send(batch):
+        if action == "reboot":
+            # boto sends RebootInstances as a GET, which can't carry 1000 ids
+            params = {}
+            conn.build_list_params(params, batch, 'InstanceId')
+            conn.get_status('RebootInstances', params, verb='POST')
+        else:
+            getattr(conn, action + "_instances")(batch)
+
+    parallel_map(send, [instance_ids[n:n + max_batch]
+                        for n in xrange(0, len(instance_ids), max_batch)], opts.parallelism)
+    return instance_ids
+
+
 # Run a command on a host through ssh, retrying up to five times
 # and then throwing an exception if ssh continues to fail.
-def ssh(host, opts, command):
+# If given, on_output is called with every line the command prints.
+def ssh(host, opts, command, on_output=None):
+    ssh_sessions.open(host, opts)
     tries = 0
     while True:
         try:
-            return subprocess.check_call(
-                ssh_command(opts) + ['-t', '-t', '%s@%s' % (opts.user, host),
-                                     stringify_command(command)])
+            with ssh_sessions.timed(host):
+                args = ssh_command(opts) + ['-t', '-t', '%s@%s' % (opts.user, host),
+                                            stringify_command(command)]
+                if on_output is None:
+                    return subprocess.check_call(args)
+                return _check_call_lines(args, on_output)
         except subprocess.CalledProcessError as e:
             if tries > 5:
                 # If this was an ssh failure, provide the user with hints.
@@ -1180,7 +3233,7 @@ def ssh(host, opts, command):
                     raise e
             print("Error executing remote command, retrying after 30 seconds: {0}".format(e),
                   file=stderr)
-            time.sleep(30)
+            profiler.sleep(30)
             tries = tries + 1
 
 
@@ -1199,28 +3252,88 @@ def _check_output(*popenargs, **kwargs):
     return output
 
 
+# Like subprocess.check_call, but passes the command's output on to our stdout
+# line by line, calling on_output with each line.
+def _check_call_lines(args, on_output):
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    for line in iter(process.stdout.readline, b''):
+        stdout.write(line)
+        stdout.flush()
+        on_output(line.decode('utf-8', 'replace'))
+    process.stdout.close()
+    retcode = process.wait()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, args)
+    return retcode
+
+
+def parallel_map(func, items, max_workers):
+    """
+    Apply func to every element of items using a pool of at most max_workers threads.
+    Returns the results in the same order as items. If any call raises, the first
+    exception is re-raised once all the other calls have finished.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    lock = threading.Lock()
+    indices = iter(xrange(len(items)))
+
+    def worker():
+        while True:
+            with lock:
+                try:
+                    index = next(indices)
+                except StopIteration:
+                    return
+            try:
+                results[index] = func(items[index])
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(min(max(max_workers, 1),
+                                                                    len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # Join with a timeout so that Ctrl-C still reaches the main thread.
+        while t.is_alive():
+            t.join(1)
+    if errors:
+        raise errors[0]
+    return results
+
+
 def ssh_read(host, opts, command):
-    return _check_output(
-        ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)])
+    ssh_sessions.open(host, opts)
+    with ssh_sessions.timed(host):
+        return _check_output(
+            ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)])
 
 
 def ssh_write(host, opts, command, arguments):
+    ssh_sessions.open(host, opts)
     tries = 0
     while True:
-        proc = subprocess.Popen(
-            ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)],
-            stdin=subprocess.PIPE)
-        proc.stdin.write(arguments)
-        proc.stdin.close()
-        status = proc.wait()
+        with ssh_sessions.timed(host):
+            proc = subprocess.Popen(
+                ssh_command(opts) + ['%s@%s' % (opts.user, host), stringify_command(command)],
+                stdin=subprocess.PIPE)
+            # communicate() rather than stdin.write() so that an ssh process dying early
+            # counts as a failed attempt instead of raising a broken pipe error.
+            proc.communicate(arguments)
+        status = proc.returncode
         if status == 0:
             break
         elif tries > 5:
             raise RuntimeError("ssh_write failed with error %s" % proc.returncode)
         else:
-            print("Error {0} while executing remote command, retrying after 30 seconds".
-                  format(status), file=stderr)
-            time.sleep(30)
+            print("Error {0} while executing remote command on {1}, retrying after 30 seconds".
+                  format(status, host), file=stderr)
+            profiler.sleep(30)
             tries = tries + 1
 
 
@@ -1233,6 +3346,12 @@ def get_zones(conn, opts):
     return zones
 
 
+# Gets a list of (zone, number of slaves) pairs spreading opts.slaves over the zones
+def get_zone_partitions(conn, opts):
+    zones = get_zones(conn, opts)
+    return [(zone, get_partition(opts.slaves, len(zones), i)) for (i, zone) in enumerate(zones)]
+
+
 # Gets the number of items in a partition
 def get_partition(total, num_partitions, current_partitions):
     num_slaves_this_zone = total // num_partitions
@@ -1255,11 +3374,408 @@ def get_dns_name(instance, private_ips=False):
     return dns
 
 
+class Cluster(object):
+    """
+    A spark-ec2 cluster, for Python programs that manage clusters without going
+    through the command line:
+
+        cluster = Cluster("my-cluster", key_pair="spark", identity_file="spark.pem",
+                          slaves=4, spot_price=0.6)
+        cluster.launch()
+        cluster.wait()
+        cluster.setup()
+        cluster.ssh("spark/bin/spark-submit ...")
+        cluster.stop()
+
+    Options are given either as keyword arguments (see make_opts()) or as opts. All the
+    methods of a cluster share one EC2 connection, the SSH connections to its hosts
+    (see SSHSessions), and its instances, which are only looked up when first needed
+    and are kept up to date by the methods that change them. Neither boto nor the
+    connection are set up before they are needed, so e.g. getting the address of a
+    master that is in the cluster state cache doesn't even import boto.
+    """
+
+    def __init__(self, name, opts=None, conn=None, **options):
+        if opts is None:
+            opts = make_opts(**options)
+        elif options:
+            raise UsageError("Cluster takes either opts or options, not both")
+        self.name = name
+        self.opts = opts
+        self._conn = conn
+        self.master_nodes = None
+        self.slave_nodes = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            setup_boto()
+            try:
+                conn = ec2.connect_to_region(self.opts.region)
+            except Exception as e:
+                raise UsageError(repr(e))
+            if conn is None:
+                raise UsageError("Unknown EC2 region: " + self.opts.region)
+            self._conn = instrument_connection(conn)
+        return self._conn
+
+    def refresh(self):
+        """
+        Look up the cluster's instances again. Returns (master_nodes, slave_nodes).
+        """
+        (self.master_nodes, self.slave_nodes) = get_existing_cluster(
+            self.conn, self.opts, self.name, die_on_error=False)
+        return (self.master_nodes, self.slave_nodes)
+
+    def nodes(self):
+        """
+        The cluster's (master_nodes, slave_nodes), looked up if not known yet.
+        """
+        if self.master_nodes is None:
+            return self.refresh()
+        return (self.master_nodes, self.slave_nodes)
+
+    def require_master(self):
+        (master_nodes, slave_nodes) = self.nodes()
+        if not master_nodes:
+            raise UsageError("Could not find a master for cluster {c} in region {r}.".format(
+                c=self.name, r=self.opts.region))
+        return (master_nodes, slave_nodes)
+
+    @property
+    def master(self):
+        """
+        The address of the cluster's master, from the cluster state cache if possible.
+        """
+        if self.master_nodes is None:
+            master = get_cached_master(self.opts, self.name)
+            if master is not None:
+                return master
+        (master_nodes, slave_nodes) = self.require_master()
+        return get_dns_name(master_nodes[0], self.opts.private_ips)
+
+    def newest_slaves(self, num_slaves):
+        (master_nodes, slave_nodes) = self.nodes()
+        if num_slaves <= 0:
+            return []
+        return sorted(slave_nodes, key=lambda i: i.launch_time)[-num_slaves:]
+
+    def launch(self):
+        """
+        Launch the cluster's instances, or with opts.resume, pick up the instances of an
+        earlier launch. Doesn't wait for them to come up, see wait().
+        """
+        with profiler.phase("launch cluster"):
+            if self.opts.resume:
+                self.refresh()
+                self.require_master()
+            else:
+                (self.master_nodes, self.slave_nodes) = launch_cluster(
+                    self.conn, self.opts, self.name)
+        return (self.master_nodes, self.slave_nodes)
+
+    def wait(self, cluster_state='ssh-ready', instances=None):
+        """
+        Wait for instances, by default all of the cluster's, to reach cluster_state
+        (see wait_for_cluster_state()).
+        """
+        if instances is None:
+            (master_nodes, slave_nodes) = self.nodes()
+            instances = master_nodes + slave_nodes
+        with profiler.phase("wait for " + cluster_state):
+            ready_times = wait_for_cluster_state(
+                conn=self.conn,
+                opts=self.opts,
+                cluster_instances=instances,
+                cluster_state=cluster_state
+            )
+        if cluster_state == 'ssh-ready' and self.master_nodes is not None:
+            save_cluster_state(self.opts, self.name, self.master_nodes, self.slave_nodes)
+        return ready_times
+
+    def setup(self, deploy_ssh_key=True):
+        """
+        Set up the cluster, whose instances must all be ssh-ready.
+        """
+        (master_nodes, slave_nodes) = self.require_master()
+        with profiler.phase("setup cluster"):
+            setup_cluster(self.conn, master_nodes, slave_nodes, self.opts, deploy_ssh_key)
+
+    def add_slaves(self, num_slaves):
+        """
+        Launch num_slaves more slaves like the existing ones, wait for them to be
+        ssh-ready and add them to the set up cluster. Their instance type is that of
+        the existing slaves unless one was asked for. Returns the new slaves.
+        """
+        (master_nodes, slave_nodes) = self.require_master()
+        opts = copy.copy(self.opts)
+        opts.slaves = num_slaves
+        # The new slaves are launched just like the existing ones
+        if slave_nodes:
+            if opts.instance_type == get_parser().get_default_values().instance_type:
+                opts.instance_type = slave_nodes[0].instance_type
+            if opts.ami is None:
+                opts.ami = slave_nodes[0].image_id
+            if opts.zone in ["", "auto"]:
+                opts.zone = slave_nodes[0].placement
+        elif opts.zone in ["", "auto"]:
+            opts.zone = master_nodes[0].placement
+        with profiler.phase("launch cluster"):
+            (master_nodes, new_slaves) = launch_cluster(
+                self.conn, opts, self.name, existing_cluster=(master_nodes, slave_nodes))
+        self.slave_nodes = slave_nodes + new_slaves
+        self.wait(instances=new_slaves)
+        with profiler.phase("setup cluster"):
+            setup_cluster(self.conn, master_nodes, self.slave_nodes, opts, True,
+                          new_slaves=new_slaves)
+        return new_slaves
+
+    def remove_slaves(self, removed_slaves):
+        """
+        Take the given slaves out of the set up cluster and terminate them.
+        """
+        (master_nodes, slave_nodes) = self.require_master()
+        removed_ids = set(i.id for i in removed_slaves)
+        slave_nodes = [i for i in slave_nodes if i.id not in removed_ids]
+        with profiler.phase("remove slaves"):
+            remove_slaves(self.conn, master_nodes, slave_nodes, removed_slaves, self.opts)
+        print("Terminating removed slaves...")
+        batch_instance_action(self.conn, self.opts, "terminate", removed_slaves)
+        self.slave_nodes = slave_nodes
+        save_cluster_state(self.opts, self.name, master_nodes, slave_nodes)
+
+    def resize(self, num_slaves):
+        """
+        Add or remove slaves until the cluster has num_slaves of them. The most recently
+        launched slaves are removed first.
+        """
+        (master_nodes, slave_nodes) = self.require_master()
+        if num_slaves <= 0:
+            raise UsageError("A cluster needs at least 1 slave")
+        if num_slaves > len(slave_nodes):
+            self.add_slaves(num_slaves - len(slave_nodes))
+        elif num_slaves < len(slave_nodes):
+            self.remove_slaves(self.newest_slaves(len(slave_nodes) - num_slaves))
+
+    def health(self, min_free_disk=0.1):
+        """
+        Probe the health of the cluster's nodes, see probe_cluster_health().
+        """
+        return probe_cluster_health(self.master, self.opts, min_free_disk)
+
+    def repair(self, health, min_free_disk=0.1):
+        """
+        Repair the unhealthy slaves in health, as returned by health(): the daemons of
+        the slaves that can be reached are started again, and the slaves that can't be
+        reached are replaced by new ones. Slaves that are short of disk space are only
+        reported, as replacing them would lose the HDFS blocks they hold. Problems of
+        the master are left to setup(). Returns the addresses of the restarted slaves
+        and of the replaced ones.
+        """
+        (master_nodes, slave_nodes) = self.require_master()
+        by_address = dict((get_dns_name(i, self.opts.private_ips), i) for i in slave_nodes)
+        restarted = []
+        replaced = []
+        for (address, result) in sorted(health["slaves"].items()):
+            full_disks = [disk for (disk, free) in sorted(result["disks"].items())
+                          if free < min_free_disk]
+            if full_disks:
+                print("{a} is short of space on {d}, not replacing it".format(
+                    a=address, d=", ".join(full_disks)), file=stderr)
+            if not result["reachable"]:
+                replaced.append(address)
+            elif len(result["problems"]) > len(full_disks) and address in by_address:
+                restarted.append(address)
+        if restarted:
+            print("Starting the daemons of {n} unhealthy slaves again...".format(n=len(restarted)))
+            ensure_resize_script(self.conn, master_nodes, slave_nodes, self.opts)
+            with profiler.phase("resize-cluster.sh"):
+                resize_spark_cluster(get_dns_name(master_nodes[0], self.opts.private_ips),
+                                     self.opts, "start", [by_address[a] for a in restarted])
+        if replaced:
+            print("Replacing {n} unhealthy slaves...".format(n=len(replaced)))
+            removed = [by_address[a] for a in replaced if a in by_address]
+            if removed:
+                self.remove_slaves(removed)
+            self.add_slaves(len(replaced))
+        return (restarted, replaced)
+
+    def start(self, wait=True):
+        """
+        Start the cluster's stopped instances. If wait, also wait for them to be
+        ssh-ready and set the cluster up again.
+        """
+        (master_nodes, slave_nodes) = self.require_master()
+        print("Starting master and slaves...")
+        batch_instance_action(self.conn, self.opts, "start", [
+            i for i in master_nodes + slave_nodes
+            if i.state not in ["shutting-down", "terminated"]])
+        if not wait:
+            return
+        self.wait()
+
+        # Determine types of running instances
+        existing_master_type = master_nodes[0].instance_type
+        existing_slave_type = slave_nodes[0].instance_type
+        # Setting opts.master_instance_type to the empty string indicates we
+        # have the same instance type for the master and the slaves
+        if existing_master_type == existing_slave_type:
+            existing_master_type = ""
+        self.opts.master_instance_type = existing_master_type
+        self.opts.instance_type = existing_slave_type
+
+        self.setup(deploy_ssh_key=False)
+
+    def stop(self, wait=False):
+        """
+        Stop the cluster's instances. Spot instances can't be stopped, so they are
+        terminated. If wait, wait for all of them to be stopped or terminated.
+        """
+        (master_nodes, slave_nodes) = self.nodes()
+        live_nodes = [i for i in master_nodes + slave_nodes
+                      if i.state not in ["shutting-down", "terminated"]]
+        print("Stopping master and slaves...")
+        stopping = [i for i in live_nodes if not i.spot_instance_request_id]
+        terminating = [i for i in live_nodes if i.spot_instance_request_id]
+        batch_instance_action(self.conn, self.opts, "stop", stopping)
+        batch_instance_action(self.conn, self.opts, "terminate", terminating)
+        if wait:
+            for (instances, state) in [(stopping, 'stopped'), (terminating, 'terminated')]:
+                if instances:
+                    self.wait(state, instances)
+        # Instances get new addresses when they are started again
+        forget_cluster_state(self.opts, self.name)
+        forget_staging_dirs(self.opts, master_nodes)
+        self.master_nodes = self.slave_nodes = None
+
+    def park(self, wait=False):
+        """
+        Put the set up cluster in a warm pool: its master, which must be EBS-backed, is
+        stopped with the modules installed on it, and its slaves are terminated after
+        saving how they were launched. warm_start() then only needs to launch slaves.
+        If wait, wait for the master to be stopped and the slaves terminated.
+        """
+        (master_nodes, slave_nodes) = self.require_master()
+        slave_nodes = [i for i in slave_nodes if i.state not in ["shutting-down", "terminated"]]
+        if not slave_nodes:
+            raise UsageError("Cluster {c} has no slaves to park".format(c=self.name))
+        if master_nodes[0].root_device_type != "ebs":
+            raise UsageError("Only a cluster with an EBS-backed master can be parked")
+        slave = slave_nodes[0]
+        save_warm_pool(self.opts, self.name, {
+            "master_id": master_nodes[0].id,
+            "slaves": len(slave_nodes),
+            "instance_type": slave.instance_type,
+            "ami": slave.image_id,
+            "zone": slave.placement,
+            "spot_price": self.opts.spot_price if slave.spot_instance_request_id else None
+        })
+        print("Parking cluster {c}: stopping master, terminating slaves...".format(c=self.name))
+        batch_instance_action(self.conn, self.opts, "stop", master_nodes)
+        batch_instance_action(self.conn, self.opts, "terminate", slave_nodes)
+        if wait:
+            self.wait('stopped', master_nodes)
+            self.wait('terminated', slave_nodes)
+        forget_cluster_state(self.opts, self.name)
+        forget_staging_dirs(self.opts, master_nodes)
+        self.master_nodes = self.slave_nodes = None
+
+    def warm_pool(self):
+        """
+        The cluster's warm pool (see park()) if it can be started from there, else None:
+        its master must still be the one that was parked, and no slaves must be left.
+        """
+        pool = load_warm_pool(self.opts, self.name)
+        if pool is None:
+            return None
+        (master_nodes, slave_nodes) = self.nodes()
+        if not master_nodes or master_nodes[0].id != pool["master_id"] or \
+                master_nodes[0].state in ["shutting-down", "terminated"]:
+            return None
+        if [i for i in slave_nodes if i.state not in ["shutting-down", "terminated"]]:
+            return None
+        return pool
+
+    def warm_start(self, num_slaves=None):
+        """
+        Start a parked cluster: launch num_slaves slaves (by default as many as it was
+        parked with) like the parked ones, start the master and set the cluster up
+        without installing the modules again.
+        """
+        pool = self.warm_pool()
+        if pool is None:
+            raise UsageError("Cluster {c} is not in a warm pool".format(c=self.name))
+        opts = copy.copy(self.opts)
+        opts.slaves = num_slaves or pool["slaves"]
+        opts.instance_type = pool["instance_type"]
+        opts.ami = pool["ami"]
+        opts.zone = pool["zone"]
+        opts.spot_price = pool["spot_price"]
+        opts.use_existing_master = True
+        opts.resume = False
+        with profiler.phase("launch cluster"):
+            (self.master_nodes, self.slave_nodes) = launch_cluster(self.conn, opts, self.name)
+        self.wait()
+        if self.master_nodes[0].instance_type != opts.instance_type:
+            opts.master_instance_type = self.master_nodes[0].instance_type
+        else:
+            opts.master_instance_type = ""
+        with profiler.phase("setup cluster"):
+            setup_cluster(self.conn, self.master_nodes, self.slave_nodes, opts, True,
+                          skip_init=True)
+
+    def destroy(self, wait=False, delete_groups=False):
+        """
+        Terminate all the cluster's instances. If wait, wait for them to be terminated.
+        If delete_groups, also delete the cluster's security groups once nothing uses
+        them anymore; returns whether that worked.
+        """
+        (master_nodes, slave_nodes) = self.nodes()
+        print("Terminating master and slaves...")
+        batch_instance_action(self.conn, self.opts, "terminate", master_nodes + slave_nodes)
+        forget_cluster_state(self.opts, self.name)
+        forget_warm_pool(self.opts, self.name)
+        forget_staging_dirs(self.opts, master_nodes)
+        if wait:
+            self.wait('terminated', master_nodes + slave_nodes)
+        self.master_nodes = self.slave_nodes = None
+        if not delete_groups:
+            return True
+        group_names = [self.name + "-master", self.name + "-slaves"]
+        groups = get_security_groups(self.conn, group_names, self.opts.vpc_id)
+        print("Deleting security groups once the instances using them are gone...")
+        outcomes = delete_security_groups(self.conn, groups)
+        for group in groups:
+            print("  {n}: {o}".format(n=group.name, o=outcomes[group.name][1]))
+        return all(deleted for (deleted, outcome) in outcomes.values())
+
+    def ssh(self, command, host=None, on_output=None):
+        """
+        Run command on host, by default the master, see ssh().
+        """
+        return ssh(host or self.master, self.opts, command, on_output=on_output)
+
+    def ssh_read(self, command, host=None):
+        return ssh_read(host or self.master, self.opts, command)
+
+    def close(self):
+        """
+        Shut down the SSH connections to the cluster's hosts.
+        """
+        ssh_sessions.close()
+
+
 def real_main():
     (opts, action, cluster_name) = parse_args()
+    if opts.output == "json":
+        event_log.open()
+    profiler.trace_path = opts.profile
+    api_limiter.configure(opts.api_rate, 2 * opts.api_rate)
 
     # Input parameter validation
-    get_validate_spark_version(opts.spark_version, opts.spark_git_repo)
+    # (only for the actions that deploy Spark, as a commit hash is checked on GitHub)
+    if action in ["launch", "add-slaves", "remove-slaves", "start"]:
+        get_validate_spark_version(opts.spark_version, opts.spark_git_repo)
 
     if opts.wait is not None:
         # NOTE: DeprecationWarnings are silent in 2.7+ by default.
@@ -1306,6 +3822,10 @@ def real_main():
                       t=EC2_INSTANCE_TYPES[opts.instance_type]), file=stderr)
                 sys.exit(1)
 
+    if opts.api_rate <= 0:
+        print("api-rate must be positive", file=stderr)
+        sys.exit(1)
+
     if opts.ebs_vol_num > 8:
         print("ebs-vol-num cannot be greater than 8", file=stderr)
         sys.exit(1)
@@ -1328,35 +3848,63 @@ def real_main():
               "on the local file system", file=stderr)
         sys.exit(1)
 
-    try:
-        conn = ec2.connect_to_region(opts.region)
-    except Exception as e:
-        print(repr(e), file=stderr)
-        sys.exit(1)
-
-    # Select an AZ at random if it was not specified.
-    if opts.zone == "":
-        opts.zone = random.choice(conn.get_all_zones()).name
+    # The EC2 connection (and boto) are only set up once an action uses cluster.conn
+    cluster = Cluster(cluster_name, opts)
+
+    if opts.zone == "auto" and action in ["launch", "add-slaves"]:
+        advice = get_spot_price_advice(cluster.conn, opts, [opts.instance_type])
+        print_spot_price_advice(advice, opts)
+        if advice:
+            opts.zone = advice[0]["zone"]
+            print("Using availability zone " + opts.zone)
+            # Spot options without a price ask for spot slaves, so bid what was advised
+            if opts.spot_price is None and (opts.spot_timeout is not None or
+                                            opts.spot_fallback != "none"):
+                opts.spot_price = round(advice[0]["bid"], 3)
+                print("Using the recommended spot price of {p:.3f}".format(p=opts.spot_price))
+            elif opts.spot_price is None:
+                print("No --spot-price given, launching slaves as on-demand instances")
+
+    # Select an AZ at random if it was not specified (only needed to launch instances).
+    if opts.zone in ["", "auto"] and action == "launch":
+        opts.zone = random.choice(cluster.conn.get_all_zones()).name
 
     if action == "launch":
         if opts.slaves <= 0:
             print("ERROR: You have to start at least 1 slave", file=sys.stderr)
             sys.exit(1)
-        if opts.resume:
-            (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
-        else:
-            (master_nodes, slave_nodes) = launch_cluster(conn, opts, cluster_name)
-        wait_for_cluster_state(
-            conn=conn,
-            opts=opts,
-            cluster_instances=(master_nodes + slave_nodes),
-            cluster_state='ssh-ready'
-        )
-        setup_cluster(conn, master_nodes, slave_nodes, opts, True)
+        cluster.launch()
+        cluster.wait()
+        cluster.setup()
+        emit_cluster(cluster_name, cluster.master_nodes, cluster.slave_nodes, opts)
+
+    elif action == "add-slaves":
+        if opts.slaves <= 0:
+            print("ERROR: You have to add at least 1 slave", file=sys.stderr)
+            sys.exit(1)
+        cluster.add_slaves(opts.slaves)
+        emit_cluster(cluster_name, cluster.master_nodes, cluster.slave_nodes, opts)
+
+    elif action == "remove-slaves":
+        (master_nodes, slave_nodes) = cluster.require_master()
+        if not 0 < opts.slaves < len(slave_nodes):
+            print("ERROR: Can only remove between 1 and {n} of the cluster's {m} slaves".format(
+                  n=len(slave_nodes) - 1, m=len(slave_nodes)), file=stderr)
+            sys.exit(1)
+        # Remove the most recently launched slaves
+        removed_slaves = cluster.newest_slaves(opts.slaves)
+        print("The following slaves will be removed and terminated:")
+        for inst in removed_slaves:
+            print("> %s" % get_dns_name(inst, opts.private_ips))
+        print("ALL DATA ON THESE NODES WILL BE LOST!!")
+        response = raw_input(
+            "Remove {n} slaves from cluster {c}? (y/N) ".format(n=opts.slaves, c=cluster_name))
+        if response == "y":
+            cluster.remove_slaves(removed_slaves)
+            emit_cluster(cluster_name, cluster.master_nodes, cluster.slave_nodes, opts)
 
     elif action == "destroy":
-        (master_nodes, slave_nodes) = get_existing_cluster(
-            conn, opts, cluster_name, die_on_error=False)
+        (master_nodes, slave_nodes) = cluster.nodes()
 
         if any(master_nodes + slave_nodes):
             print("The following instances will be terminated:")
@@ -1367,68 +3915,16 @@ def real_main():
         msg = "Are you sure you want to destroy the cluster {c}? (y/N) ".format(c=cluster_name)
         response = raw_input(msg)
         if response == "y":
-            print("Terminating master...")
-            for inst in master_nodes:
-                inst.terminate()
-            print("Terminating slaves...")
-            for inst in slave_nodes:
-                inst.terminate()
-
             # Delete security groups as well
-            if opts.delete_groups:
-                group_names = [cluster_name + "-master", cluster_name + "-slaves"]
-                wait_for_cluster_state(
-                    conn=conn,
-                    opts=opts,
-                    cluster_instances=(master_nodes + slave_nodes),
-                    cluster_state='terminated'
-                )
-                print("Deleting security groups (this will take some time)...")
-                attempt = 1
-                while attempt <= 3:
-                    print("Attempt %d" % attempt)
-                    groups = [g for g in conn.get_all_security_groups() if g.name in group_names]
-                    success = True
-                    # Delete individual rules in all groups before deleting groups to
-                    # remove dependencies between them
-                    for group in groups:
-                        print("Deleting rules in security group " + group.name)
-                        for rule in group.rules:
-                            for grant in rule.grants:
-                                success &= group.revoke(ip_protocol=rule.ip_protocol,
-                                                        from_port=rule.from_port,
-                                                        to_port=rule.to_port,
-                                                        src_group=grant)
-
-                    # Sleep for AWS eventual-consistency to catch up, and for instances
-                    # to terminate
-                    time.sleep(30)  # Yes, it does have to be this long :-(
-                    for group in groups:
-                        try:
-                            # It is needed to use group_id to make it work with VPC
-                            conn.delete_security_group(group_id=group.id)
-                            print("Deleted security group %s" % group.name)
-                        except boto.exception.EC2ResponseError:
-                            success = False
-                            print("Failed to delete security group %s" % group.name)
-
-                    # Unfortunately, group.revoke() returns True even if a rule was not
-                    # deleted, so this needs to be rerun if something fails
-                    if success:
-                        break
-
-                    attempt += 1
-
-                if not success:
-                    print("Failed to delete all security groups after 3 tries.")
-                    print("Try re-running in a few minutes.")
+            if not cluster.destroy(wait=opts.wait_for_state, delete_groups=opts.delete_groups):
+                print("Failed to delete all security groups.")
+                print("Try re-running in a few minutes.")
 
     elif action == "login":
-        (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
-        if not master_nodes[0].public_dns_name and not opts.private_ips:
+        master = cluster.master
+        if not master:
             print("Master has no public DNS name.  Maybe you meant to specify --private-ips?")
         else:
-            master = get_dns_name(master_nodes[0], opts.private_ips)
             print("Logging into master " + master + "...")
             proxy_opt = []
             if opts.proxy_port is not None:
@@ -1442,20 +3938,25 @@ def real_main():
             cluster_name + " slaves?\n" +
             "Reboot cluster slaves " + cluster_name + " (y/N): ")
         if response == "y":
-            (master_nodes, slave_nodes) = get_existing_cluster(
-                conn, opts, cluster_name, die_on_error=False)
+            (master_nodes, slave_nodes) = cluster.nodes()
             print("Rebooting slaves...")
-            for inst in slave_nodes:
-                if inst.state not in ["shutting-down", "terminated"]:
-                    print("Rebooting " + inst.id)
-                    inst.reboot()
+            rebooting = [i for i in slave_nodes if i.state not in ["shutting-down", "terminated"]]
+            if opts.rolling_batch_size > 0:
+                rolling_reboot(cluster.conn, opts, master_nodes, rebooting)
+                return
+            if opts.wait_for_state:
+                reboot_instances(cluster.conn, opts, rebooting)
+            else:
+                for inst_id in batch_instance_action(cluster.conn, opts, "reboot", rebooting):
+                    print("Rebooting " + inst_id)
 
     elif action == "get-master":
-        (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
-        if not master_nodes[0].public_dns_name and not opts.private_ips:
+        master = cluster.master
+        if not master:
             print("Master has no public DNS name.  Maybe you meant to specify --private-ips?")
         else:
-            print(get_dns_name(master_nodes[0], opts.private_ips))
+            print(master)
+            event_log.emit("master", name=cluster_name, host=master)
 
     elif action == "stop":
         response = raw_input(
@@ -1466,92 +3967,47 @@ def real_main():
             "All data on spot-instance slaves will be lost.\n" +
             "Stop cluster " + cluster_name + " (y/N): ")
         if response == "y":
-            (master_nodes, slave_nodes) = get_existing_cluster(
-                conn, opts, cluster_name, die_on_error=False)
-            print("Stopping master...")
-            for inst in master_nodes:
-                if inst.state not in ["shutting-down", "terminated"]:
-                    inst.stop()
-            print("Stopping slaves...")
-            for inst in slave_nodes:
-                if inst.state not in ["shutting-down", "terminated"]:
-                    if inst.spot_instance_request_id:
-                        inst.terminate()
-                    else:
-                        inst.stop()
+            cluster.stop(wait=opts.wait_for_state)
 
     elif action == "start":
-        (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
-        print("Starting slaves...")
-        for inst in slave_nodes:
-            if inst.state not in ["shutting-down", "terminated"]:
-                inst.start()
-        print("Starting master...")
-        for inst in master_nodes:
-            if inst.state not in ["shutting-down", "terminated"]:
-                inst.start()
-        wait_for_cluster_state(
-            conn=conn,
-            opts=opts,
-            cluster_instances=(master_nodes + slave_nodes),
-            cluster_state='ssh-ready'
-        )
-
-        # Determine types of running instances
-        existing_master_type = master_nodes[0].instance_type
-        existing_slave_type = slave_nodes[0].instance_type
-        # Setting opts.master_instance_type to the empty string indicates we
-        # have the same instance type for the master and the slaves
-        if existing_master_type == existing_slave_type:
-            existing_master_type = ""
-        opts.master_instance_type = existing_master_type
-        opts.instance_type = existing_slave_type
-
-        setup_cluster(conn, master_nodes, slave_nodes, opts, False)
+        cluster.start(wait=opts.wait_for_state is not False)
+        if opts.wait_for_state is False:
+            print("Not waiting for the cluster to come up; run start again without "
+                  "--no-wait to set it up.")
+            return
+        emit_cluster(cluster_name, cluster.master_nodes, cluster.slave_nodes, opts)
 
     elif action == "createvol":
-        (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
-        print("Creating volumes size=%d type=%s in zone %s on device %s..." % (opts.ebs_vol_size, opts.ebs_vol_type, opts.zone, opts.ebs_vol_dev_name))
-        # for each slave, if the device is not available
-	#
-	for inst in master_nodes + slave_nodes:
-	    if opts.ebs_vol_size == 0:
-	        continue
-	    vol = conn.create_volume(opts.ebs_vol_size, opts.zone, volume_type=opts.ebs_vol_type)
-	    print("Created volume: %s" % vol.id)
-	    # wait till its ready
-	    vol_status = conn.get_all_volumes([vol.id])[0].status
-	    while vol_status != 'available':
-	        time.sleep(3)
-		vol_status = conn.get_all_volumes([vol.id])[0].status
-	    print("Volume %s is available! Attaching it to instance %s on device %s"  % (vol.id, inst.id, opts.ebs_vol_dev_name))
-	    status = conn.attach_volume(vol.id, inst.id, opts.ebs_vol_dev_name)
-	    if status:
-	        print("Attaching volume succeeded.")
+        (master_nodes, slave_nodes) = cluster.require_master()
+        if opts.ebs_vol_size > 0:
+            print("Creating volumes size=%d type=%s on device %s..." %
+                  (opts.ebs_vol_size, opts.ebs_vol_type, opts.ebs_vol_dev_name))
+            failed = create_volumes(cluster.conn, opts, master_nodes + slave_nodes)
+            print_volume_failures(failed, len(master_nodes + slave_nodes))
+            if failed:
+                sys.exit(1)
+
     elif action == "deletevol":
         response = raw_input(
             "Are you sure you want to delete volumes on " + opts.ebs_vol_dev_name
             + " ?\nAll data on the volumes will be lost! Go ahead to delete volumes (y/N): ")
         if response == "y":
-            (master_nodes, slave_nodes) = get_existing_cluster(conn, opts, cluster_name)
-            for inst in master_nodes + slave_nodes:
-                # find the specified volume from each node
-                if not inst.block_device_mapping.has_key(opts.ebs_vol_dev_name):
-                    print("Cannot find volume on %s on instance %s" % (opts.ebs_vol_dev_name, inst.id))
-                    continue
-                vol_id = inst.block_device_mapping[opts.ebs_vol_dev_name].volume_id
-                # detach them and delete them
-                print("Found volume %s on instance %s, detaching.." % (vol_id, inst.id))
-                if conn.detach_volume(vol_id, inst.id):
-                    vol_info = conn.get_all_volumes([vol_id])[0]
-                    while vol_info.status != 'available':
-                        time.sleep(3)
-                        vol_info = conn.get_all_volumes([vol_id])[0]
-                    print("Detaching was successful. status: %s. Deleting volume %s" % (vol_id, vol_info.status))
-                    if conn.delete_volume(vol_id):
-                        print("Volume %s was successfull deleted" % vol_id)
-                else:
-                    print("Detaching failed")
+            (master_nodes, slave_nodes) = cluster.require_master()
+            (deleted, failed) = delete_volumes(cluster.conn, opts, master_nodes + slave_nodes)
+            print("Deleted %d volumes of %d instances." %
+                  (len(deleted), len(master_nodes + slave_nodes)))
+            if failed:
+                print_volume_failures(failed, len(master_nodes + slave_nodes))
+                sys.exit(1)
+
+    elif action == "price-advisor":
+        instance_types = [t.strip() for t in opts.advisor_instance_types.split(",") if t.strip()]
+        advice = get_spot_price_advice(
+            cluster.conn, opts, instance_types or [opts.instance_type])
+        if not advice:
+            print("No spot price history found in region " + opts.region, file=stderr)
+            sys.exit(1)
+        print_spot_price_advice(advice, opts)
 
     elif action == "noop":
         # do nothing
@@ -1562,13 +4018,30 @@ def real_main():
 
 
 def main():
+    logging.basicConfig()
+    # However the run fails, the last event says so
+    error = None
     try:
         real_main()
     except UsageError as e:
+        error = {"message": str(e)}
         print("\nError:\n", e, file=stderr)
         sys.exit(1)
+    except SystemExit as e:
+        if e.code:
+            error = {"type": "SystemExit", "message": isinstance(e.code, int) and
+                     "exit status {c}".format(c=e.code) or str(e.code)}
+        raise
+    except BaseException as e:
+        error = {"type": type(e).__name__, "message": str(e)}
+        raise
+    finally:
+        if error is not None:
+            event_log.emit("error", **error)
+        ssh_sessions.close()
+        profiler.report()
+        api_limiter.report()
 
 
 if __name__ == "__main__":
-    logging.basicConfig()
     main()
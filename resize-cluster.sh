@@ -0,0 +1,174 @@
+#!/bin/bash
+
+# Adds slaves to or removes slaves from a cluster that is already set up, without
+# running the whole setup again. Run on the master by spark-ec2's add-slaves and
+# remove-slaves actions, once ec2-variables.sh lists the cluster's new set of slaves.
+# "start" only starts the daemons of slaves again, e.g. after they were rebooted.
+#
+# usage: resize-cluster.sh add|remove|start <slave>...
+
+# usage: echo_time_diff name start_time end_time
+echo_time_diff () {
+  local format='%Hh %Mm %Ss'
+
+  local diff_secs="$(($3-$2))"
+  echo "[timing] $1: " "$(date -u -d@"$diff_secs" +"$format")"
+}
+
+if [[ $# -lt 2 || ! "$1" =~ ^(add|remove|start)$ ]]; then
+  echo "Usage: resize-cluster.sh add|remove|start <slave>..."
+  exit 1
+fi
+ACTION=$1
+shift
+NODES="$@"
+
+# Make sure we are in the spark-ec2 directory
+pushd /root/spark-ec2 > /dev/null
+
+# Load the environment variables specific to this AMI
+source /root/.bash_profile
+
+# Load the cluster variables set by the deploy script
+source ec2-variables.sh
+
+echo "$MASTERS" > masters
+echo "$SLAVES" > slaves
+echo "spark://""`cat masters`"":7077" > cluster-url
+
+SSH_OPTS="-o StrictHostKeyChecking=no -o ConnectTimeout=5"
+
+echo "Setting executable permissions on scripts..."
+find . -regex "^.+.\(sh\|py\)" | xargs chmod a+x
+
+# Update the slave lists the start/stop scripts of the modules use
+for conf_dir in /root/spark/conf /root/ephemeral-hdfs/conf /root/persistent-hdfs/conf \
+    /root/mapreduce/conf; do
+  if [[ -d $conf_dir ]]; then
+    cp slaves $conf_dir/
+  fi
+done
+
+# The daemons every slave runs: a Spark worker, an HDFS DataNode and on YARN a NodeManager
+case "$HADOOP_MAJOR_VERSION" in
+  1)
+    HADOOP_SBIN=/root/ephemeral-hdfs/bin
+    ;;
+  *)
+    HADOOP_SBIN=/root/ephemeral-hdfs/sbin
+    ;;
+esac
+START_DAEMONS="true"
+STOP_DAEMONS="true"
+if [[ $MODULES =~ ephemeral-hdfs ]]; then
+  START_DAEMONS="$START_DAEMONS; $HADOOP_SBIN/hadoop-daemon.sh start datanode"
+  STOP_DAEMONS="$STOP_DAEMONS; $HADOOP_SBIN/hadoop-daemon.sh stop datanode"
+  if [[ "$HADOOP_MAJOR_VERSION" == "yarn" ]]; then
+    START_DAEMONS="$START_DAEMONS; $HADOOP_SBIN/yarn-daemon.sh start nodemanager"
+    STOP_DAEMONS="$STOP_DAEMONS; $HADOOP_SBIN/yarn-daemon.sh stop nodemanager"
+  fi
+fi
+if [[ $MODULES =~ spark-standalone ]]; then
+  START_DAEMONS="$START_DAEMONS; /root/spark/sbin/start-slave.sh `cat cluster-url`"
+  STOP_DAEMONS="$STOP_DAEMONS; /root/spark/sbin/stop-slave.sh"
+fi
+
+if [[ $ACTION == "add" ]]; then
+  echo "RSYNC'ing /root/spark-ec2 and the installed modules to the new slaves..."
+  rsync_start_time="$(date +'%s')"
+  for node in $NODES; do
+    echo $node
+    (
+      rsync -e "ssh $SSH_OPTS" -az /root/spark-ec2 $node:/root
+      scp $SSH_OPTS ~/.ssh/id_rsa $node:.ssh
+      for module in scala $MODULES; do
+        if [[ -d /root/$module ]]; then
+          rsync -e "ssh $SSH_OPTS" -az /root/$module $node:/root
+        fi
+      done
+    ) &
+    sleep 0.1
+  done
+  wait
+  rsync_end_time="$(date +'%s')"
+  echo_time_diff "rsync to new slaves" "$rsync_start_time" "$rsync_end_time"
+
+  echo "Running setup-slave on the new slaves..."
+  setup_slave_start_time="$(date +'%s')"
+  pssh --inline \
+      --host "$NODES" \
+      --user root \
+      --extra-args "-t -t $SSH_OPTS" \
+      --timeout 0 \
+      "spark-ec2/setup-slave.sh"
+  if [[ $MODULES =~ ephemeral-hdfs ]]; then
+    pssh --inline \
+        --host "$NODES" \
+        --user root \
+        --extra-args "-t -t $SSH_OPTS" \
+        --timeout 0 \
+        "spark-ec2/ephemeral-hdfs/setup-slave.sh"
+  fi
+  setup_slave_end_time="$(date +'%s')"
+  echo_time_diff "setup-slave on new slaves" "$setup_slave_start_time" "$setup_slave_end_time"
+
+  echo "Starting the new slaves' daemons..."
+  DAEMONS=$START_DAEMONS
+elif [[ $ACTION == "start" ]]; then
+  echo "Starting the slaves' daemons..."
+  DAEMONS=$START_DAEMONS
+else
+  if [[ $MODULES =~ ephemeral-hdfs ]]; then
+    # Have HDFS copy the blocks of the removed slaves' DataNodes to the other ones first
+    echo "Decommissioning the removed slaves' DataNodes..."
+    decommission_start_time="$(date +'%s')"
+    HADOOP=/root/ephemeral-hdfs/bin/hadoop
+    HDFS_SITE=/root/ephemeral-hdfs/conf/hdfs-site.xml
+    EXCLUDE=/root/ephemeral-hdfs/conf/dfs.exclude
+    # The NameNode knows the DataNodes by their private addresses
+    IPS=""
+    for node in $NODES; do
+      IPS="$IPS $(getent hosts $node | awk '{print $1; exit}')"
+    done
+    echo $IPS | tr ' ' '\n' > $EXCLUDE
+    # Clusters are set up without an exclude file; the NameNode reads it on -refreshNodes
+    if ! grep -q dfs.hosts.exclude $HDFS_SITE; then
+      sed -i "s|</configuration>|  <property>\n    <name>dfs.hosts.exclude</name>\n    <value>$EXCLUDE</value>\n  </property>\n\n</configuration>|" $HDFS_SITE
+    fi
+    $HADOOP dfsadmin -refreshNodes
+    # Dead DataNodes have nothing left to copy, so only wait for the ones in progress
+    while true; do
+      in_progress=$($HADOOP dfsadmin -report 2>/dev/null | awk -v ips="$IPS" '
+        BEGIN { split(ips, list, " "); for (i in list) removed[list[i]] = 1 }
+        /^Name: / { split($2, name, ":"); ip = name[1] }
+        /^Decommission Status : Decommission in progress/ { if (ip in removed) n++ }
+        END { print n + 0 }')
+      if [[ $in_progress == 0 ]]; then
+        break
+      fi
+      echo "Waiting for $in_progress DataNodes to be decommissioned..."
+      sleep 30
+    done
+    decommission_end_time="$(date +'%s')"
+    echo_time_diff "decommission datanodes" "$decommission_start_time" "$decommission_end_time"
+  fi
+  echo "Stopping the removed slaves' daemons..."
+  DAEMONS=$STOP_DAEMONS
+fi
+
+daemons_start_time="$(date +'%s')"
+for node in $NODES; do
+  echo $node
+  ssh -t -t $SSH_OPTS root@$node "source /root/.bash_profile; $DAEMONS" & sleep 0.3
+done
+wait
+daemons_end_time="$(date +'%s')"
+echo_time_diff "$ACTION slave daemons" "$daemons_start_time" "$daemons_end_time"
+
+if [[ $ACTION == "remove" && $MODULES =~ ephemeral-hdfs ]]; then
+  # New slaves may get the addresses of the removed ones
+  > $EXCLUDE
+  $HADOOP dfsadmin -refreshNodes
+fi
+
+popd > /dev/null
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function, with_statement
+
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Run the click model training pipeline on the master, for the train set of one date.
+#
+# The pipeline is the DAG of steps in get_steps(). Each step lists the steps it needs,
+# the HDFS/S3 paths it writes and the commands that write them. Steps run as soon as
+# the steps they need are done, so independent steps run at the same time.
+#
+# A step that finishes is checkpointed in CHECKPOINT_FILE under a key made of the date,
+# the size of the train set, the step's commands and the keys of the steps it needs.
+# The next run skips every step whose key is unchanged and whose outputs still exist
+# (HDFS is ephemeral, so they may not), and only runs what the steps still to run need.
+# When the model of the date and its done file are on S3, nothing runs at all, even
+# without checkpoints (e.g. on a new cluster).
+#
+# At the end it reports how long each step took and the CPU time and memory of its
+# local processes.
+#
+# usage: run_aws_trainer.py <date>
+
+SPARK_MASTER = "yarn-client"
+SPARK_HOME = "/root/spark"
+JAR_DIR = "/vol0/lkung-work/pricer_depjars"
+DEP_JARS = ",".join([JAR_DIR + "/" + jar for jar in [
+  "wstx-asl-3.1.2.jar", "stax2.jar", "wurfl-1.5.1.jar", "slf4j-api-1.7.7.jar",
+  "servlet-api-2.5.jar", "commons-logging-1.1.3.jar", "commons-lang-2.6.jar",
+  "commons-math3-3.5.jar", "trove4j-3.0.3.jar"]])
+HADOOP_OPTS = "-Dmapreduce.map.java.opts=-Xmx5120m -Dmapreduce.map.memory.mb=6100"
+HADOOP_OPTS2 = "-Dmapreduce.map.java.opts=-Xmx15000m -Dmapreduce.map.memory.mb=16384"
+MODEL_FILE = "spark_click_model.tsv"
+DONE_FILE = "TRAINING_DONE"
+WORK_DIR = "/vol0/lkung-work"
+HADOOP = "/root/ephemeral-hdfs/bin/hadoop"
+CHECKPOINT_FILE = os.path.join(WORK_DIR, "trainer-checkpoints.json")
+
+SPARK_JOB = " ".join([
+  "HADOOP_CONF_DIR=/root/ephemeral-hdfs/conf",
+  SPARK_HOME + "/bin/spark-submit",
+  "--master " + SPARK_MASTER,
+  "--conf spark.shuffle.io.maxRetries=6",
+  "--conf spark.driver.maxResultSize=7000M",
+  "--num-executors 50",
+  "--executor-memory 16000m",
+  "--executor-cores 2",
+  "--driver-memory 16000m",
+  "--driver-cores 2"])
+
+SPARK_TRAINER = " ".join([
+  "unset SPARK_WORKER_INSTANCES;",
+  "HADOOP_CONF_DIR=/root/ephemeral-hdfs/conf",
+  SPARK_HOME + "/bin/spark-submit",
+  "--master " + SPARK_MASTER,
+  "--conf spark.local.dir=/vol0/scratch",
+  "--conf spark.driver.extraJavaOptions=-Djava.io.tmpdir=/vol0/tmp",
+  "--conf spark.executor.extraJavaOptions=-Djava.io.tmpdir=/vol0/tmp",
+  "--conf spark.driver.maxResultSize=40000m",
+  "--conf spark.rdd.compress=true",
+  "--conf spark.network.timeout=240000",
+  "--conf spark.akka.frameSize=1024",
+  "--conf spark.shuffle.service.enabled=true",
+  "--conf spark.dynamicAllocation.minExecutors=24",
+  "--conf spark.kryoserializer.buffer.max=2047m",
+  "--num-executors 80",
+  "--executor-memory 30g",
+  "--executor-cores 4",
+  "--driver-memory 30g",
+  "--driver-cores 4",
+  "--class BinaryClassification",
+  "fractional-trainer-1.5.jar",
+  "--algorithm LBFGS --regType MYL2 --regParam 5e-6",
+  "--maxIter 35 --stepSize 1 --miniBatchFrac 1.0 --fracTest 0.001",
+  "--kryoSerializer"])
+
+
+def mapreduce(hadoop_opts, *args):
+  return "%s jar pricer-feature-selection.jar training.FeatureSelectionMapReduce %s " \
+      "-libjars %s %s" % (HADOOP, hadoop_opts, DEP_JARS, " ".join(args))
+
+
+def remove(*paths):
+  return "%s fs -rm -r -f %s" % (HADOOP, " ".join(paths))
+
+
+class Step(object):
+  def __init__(self, name, needs, outputs, commands, values=None):
+    self.name = name
+    # Names of the steps this one needs to be done first
+    self.needs = needs
+    # HDFS or S3 paths the step writes; a step without outputs runs whenever it is needed
+    self.outputs = outputs
+    # Function of the values of the steps it needs to the shell commands to run, in order
+    self.commands = commands
+    # Function that reads the values later steps need from the outputs, or None
+    self.values = values
+
+
+def read_click_counts(inputs):
+  # One line: label, number of positive clicks, number of negative clicks
+  output = read_cmd("%s fs -cat selection/click_counts.tsv/part-*" % HADOOP)
+  fields = output.split("\n")[0].split("\t")
+  return {"num_pos_clicks": fields[1], "num_neg_clicks": fields[2]}
+
+
+# The model published for date and the file that tells it is done
+def get_published_paths(date):
+  output_path = "s3a://spark.data/daily/%s" % date
+  return ("%s/%s.gz" % (output_path, MODEL_FILE), "%s/%s" % (output_path, DONE_FILE))
+
+
+def get_steps(date):
+  train_set = "s3a://spark.data/daily/%s/withpubs_pricer.gz" % date
+  (model, done) = get_published_paths(date)
+
+  return [
+    Step("count clicks", [], ["selection/click_counts.tsv"],
+         lambda v: [
+           remove("selection/click_counts.tsv"),
+           mapreduce(HADOOP_OPTS, "count_clicks", train_set, "selection/click_counts.tsv")],
+         read_click_counts),
+    Step("select features", ["count clicks"], ["selection/feature_pvalues.tsv"],
+         lambda v: [
+           remove("selection/feature_pvalues.tsv"),
+           mapreduce(HADOOP_OPTS, "select_feature", train_set, "selection/feature_pvalues.tsv",
+                     v["num_pos_clicks"], v["num_neg_clicks"], "-chisquare -pvalue 1.01")]),
+    # The featuremap is merged into one file on HDFS without a local copy
+    Step("assign feature ids", ["select features"], ["selection/featuremap.tsv"],
+         lambda v: [
+           remove("selection/featuremap-out.tsv", "selection/featuremap.tsv"),
+           "%s --class AssignIdToFeatureMap fractional-trainer-1.5.jar --numFeatures 50000000 "
+           "selection/feature_pvalues.tsv selection/featuremap-out.tsv" % SPARK_JOB,
+           "%s fs -cat 'selection/featuremap-out.tsv/part-*' | "
+           "%s fs -put - selection/featuremap.tsv" % (HADOOP, HADOOP),
+           remove("selection/featuremap-out.tsv")]),
+    Step("convert", ["assign feature ids"], ["selection/libsvm.txt.bz2"],
+         lambda v: [
+           remove("selection/libsvm.txt.bz2"),
+           mapreduce(HADOOP_OPTS2, "convert", train_set, "selection/libsvm.txt.bz2",
+                     "selection/featuremap.tsv")]),
+    # Runs alongside the jobs above, as soon as the pipeline knows it has to train
+    Step("clear model", [], [],
+         lambda v: [
+           remove(done, "selection/one_click_model.tsv", "selection/one_click_model.tsv-raw")]),
+    Step("train", ["assign feature ids", "convert", "clear model"],
+         ["selection/one_click_model.tsv"],
+         lambda v: [
+           "%s --featureMap selection/featuremap.tsv selection/libsvm.txt.bz2 "
+           "selection/one_click_model.tsv 2>&1 | tee log-training" % SPARK_TRAINER]),
+    # The model is compressed on its way from HDFS to S3, without a local copy
+    Step("publish model", ["train"], [model, done],
+         lambda v: [
+           "%s fs -cat 'selection/one_click_model.tsv/part-*' | gzip | %s fs -put -f - %s"
+           % (HADOOP, HADOOP, model),
+           "%s fs -touchz %s" % (HADOOP, done)]),
+  ]
+
+
+# Run a shell command and return its output
+def read_cmd(command):
+  proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+  output = proc.communicate()[0]
+  if proc.returncode != 0:
+    raise RuntimeError("Command failed: %s" % command)
+  if not isinstance(output, str):
+    output = output.decode("utf-8")
+  return output
+
+
+# Paths of the given ones that exist, found with a single hadoop command
+def existing_paths(paths):
+  if not paths:
+    return set()
+  proc = subprocess.Popen("%s fs -ls -d %s 2>/dev/null" % (HADOOP, " ".join(paths)),
+                          shell=True, stdout=subprocess.PIPE)
+  output = proc.communicate()[0]
+  if not isinstance(output, str):
+    output = output.decode("utf-8")
+  found = set()
+  for line in output.split("\n"):
+    fields = line.split()
+    if fields:
+      found.add(fields[-1].rstrip("/"))
+  return set([path for path in paths if path.rstrip("/") in found])
+
+
+def format_time(seconds):
+  seconds = int(seconds)
+  return "%02dh %02dm %02ds" % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+
+class Pipeline(object):
+  def __init__(self, steps, stamp):
+    self.steps = dict([(step.name, step) for step in steps])
+    self.order = [step.name for step in steps]
+    # Identifies the train set, so that a new or changed one invalidates every step
+    self.stamp = stamp
+    self.checkpoints = {}
+    if os.path.exists(CHECKPOINT_FILE):
+      with open(CHECKPOINT_FILE) as f:
+        self.checkpoints = json.load(f)
+    self.lock = threading.Lock()
+    self.done = threading.Condition(self.lock)
+    self.report = {}
+
+  def inputs(self, name, checkpoints):
+    # The values and keys of the steps a step needs, or None if one has none yet
+    values = {}
+    keys = []
+    for need in self.steps[name].needs:
+      if need not in checkpoints:
+        return None
+      values.update(checkpoints[need]["values"])
+      keys.append(checkpoints[need]["key"])
+    return (values, keys)
+
+  def key(self, name, values, keys):
+    definition = [self.stamp, name, self.steps[name].commands(values), sorted(keys)]
+    return hashlib.sha1(json.dumps(definition).encode("utf-8")).hexdigest()
+
+  def plan(self):
+    """The names of the steps that have to run to bring every output up to date."""
+    current = {}
+    for name in self.order:
+      checkpoint = self.checkpoints.get(name)
+      inputs = self.inputs(name, current)
+      if checkpoint and inputs and checkpoint["key"] == self.key(name, *inputs):
+        current[name] = checkpoint
+    outputs = []
+    for name in current:
+      outputs += self.steps[name].outputs
+    existing = existing_paths(outputs)
+
+    to_run = set()
+
+    def visit(name):
+      step = self.steps[name]
+      if name in to_run:
+        return
+      if name in current and step.outputs and set(step.outputs) <= existing:
+        return
+      to_run.add(name)
+      for need in step.needs:
+        visit(need)
+
+    needed = set()
+    for step in self.steps.values():
+      needed.update(step.needs)
+    for name in self.order:
+      if name not in needed:
+        visit(name)
+    return to_run
+
+  def save_checkpoint(self, name, checkpoint):
+    self.checkpoints[name] = checkpoint
+    with open(CHECKPOINT_FILE + ".tmp", "w") as f:
+      json.dump(self.checkpoints, f, indent=2, sort_keys=True)
+    os.rename(CHECKPOINT_FILE + ".tmp", CHECKPOINT_FILE)
+
+  def run_step(self, name):
+    step = self.steps[name]
+    print("Running %s.." % name)
+    start_time = time.time()
+    cpu_seconds = 0.0
+    max_rss_kb = 0
+    ok = False
+    try:
+      with self.lock:
+        (values, keys) = self.inputs(name, self.checkpoints)
+      failed = False
+      for command in step.commands(values):
+        print("[%s] %s" % (name, command))
+        sys.stdout.flush()
+        # Spawned and reaped by hand: wait4 gives the usage of this very command,
+        # which RUSAGE_CHILDREN can't tell apart from the other steps running
+        pid = os.spawnv(os.P_NOWAIT, "/bin/bash",
+                        ["/bin/bash", "-o", "pipefail", "-c", command])
+        (pid, status, usage) = os.wait4(pid, 0)
+        cpu_seconds += usage.ru_utime + usage.ru_stime
+        max_rss_kb = max(max_rss_kb, usage.ru_maxrss)
+        if status != 0:
+          print("%s failed!" % name, file=sys.stderr)
+          failed = True
+          break
+      if not failed and existing_paths(step.outputs) != set(step.outputs):
+        print("%s did not write %s!" % (name, " ".join(step.outputs)), file=sys.stderr)
+        failed = True
+      if not failed:
+        checkpoint = {"key": self.key(name, values, keys), "outputs": step.outputs,
+                      "values": {}, "finished": time.strftime("%Y-%m-%d %H:%M:%S")}
+        if step.values:
+          checkpoint["values"] = step.values(values)
+        with self.lock:
+          self.save_checkpoint(name, checkpoint)
+        ok = True
+    except Exception as e:
+      print("%s failed: %s" % (name, e), file=sys.stderr)
+    finally:
+      # Whatever happened, run() has to hear that the step is over
+      seconds = time.time() - start_time
+      print("[timing] %s:  %s" % (name, format_time(seconds)))
+      sys.stdout.flush()
+      with self.lock:
+        self.report[name] = (ok and "ran" or "FAILED", seconds, cpu_seconds, max_rss_kb)
+        self.running.discard(name)
+        if not ok:
+          self.failed = True
+        self.done.notify()
+
+  def run(self):
+    to_run = self.plan()
+    for name in self.order:
+      if name not in to_run:
+        self.report[name] = ("skipped", 0, 0, 0)
+    self.running = set()
+    self.failed = False
+    pending = [name for name in self.order if name in to_run]
+    with self.lock:
+      while pending or self.running:
+        if not self.failed:
+          for name in list(pending):
+            if not [need for need in self.steps[name].needs
+                    if need in to_run and self.report.get(need, ("",))[0] != "ran"]:
+              pending.remove(name)
+              self.running.add(name)
+              thread = threading.Thread(target=self.run_step, args=(name,))
+              thread.daemon = True
+              thread.start()
+        elif not self.running:
+          break
+        if self.running:
+          self.done.wait()
+    return not self.failed
+
+  def print_report(self):
+    print("%-20s %-8s %12s %10s %10s" % ("step", "status", "time", "cpu (s)", "rss (MB)"))
+    total = 0
+    for name in self.order:
+      if name not in self.report:
+        continue
+      (status, seconds, cpu_seconds, max_rss_kb) = self.report[name]
+      print("%-20s %-8s %12s %10.1f %10d" % (
+        name, status, format_time(seconds), cpu_seconds, max_rss_kb / 1024))
+      total += cpu_seconds
+    print("%-20s %-8s %12s %10.1f" % (
+      "total", "", format_time(time.time() - self.start_time), total))
+
+  def main(self):
+    self.start_time = time.time()
+    ok = self.run()
+    self.print_report()
+    return ok
+
+
+def main():
+  if len(sys.argv) != 2:
+    print("Usage: run_aws_trainer.py <date>")
+    sys.exit(1)
+  date = sys.argv[1]
+  os.chdir(WORK_DIR)
+
+  train_set = "s3a://spark.data/daily/%s/withpubs_pricer.gz" % date
+  print("Setting DATE to %s.." % date)
+  print("Input path is %s" % train_set)
+  print("Output path prefix is s3a://spark.data/daily/%s" % date)
+  # A published model is never trained again, whatever the checkpoints say
+  published = get_published_paths(date)
+  if existing_paths(published) == set(published):
+    print("Found %s . No more job to run." % published[0])
+    return
+  # Directories, files and bytes of the train set
+  try:
+    stamp = " ".join([date] + read_cmd("%s fs -count %s" % (HADOOP, train_set)).split()[:3])
+  except RuntimeError as e:
+    print("Train set %s not found: %s" % (train_set, e), file=sys.stderr)
+    sys.exit(1)
+
+  pipeline = Pipeline(get_steps(date), stamp)
+  if not pipeline.main():
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
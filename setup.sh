@@ -10,6 +10,14 @@ echo_time_diff () {
   echo "[timing] $1: " "$(date -u -d@"$diff_secs" +"$format")"
 }
 
+# With --skip-init, the modules are already installed on the master (e.g. one that was
+# stopped after being set up), so their init.sh scripts don't download them again. The
+# slaves may be new though, so they still get what init.sh would have given them.
+SKIP_INIT="false"
+if [[ "$1" == "--skip-init" ]]; then
+  SKIP_INIT="true"
+fi
+
 # Make sure we are in the spark-ec2 directory
 pushd /root/spark-ec2 > /dev/null
 
@@ -82,7 +90,27 @@ if [[ ! $MODULES =~ *scala* ]]; then
 fi
 
 # Install / Init module
-for module in $MODULES; do
+if [[ $SKIP_INIT == "true" ]]; then
+  echo "Skipping module downloads, the modules are installed already"
+  MODULES_TO_INIT=""
+  # The Hadoop modules only reach the slaves through their init.sh
+  for module in ephemeral-hdfs persistent-hdfs mapreduce; do
+    if [[ $MODULES =~ $module && -d /root/$module ]]; then
+      echo "Copying $module to slaves"
+      module_init_start_time="$(date +'%s')"
+      /root/spark-ec2/copy-dir /root/$module
+      module_init_end_time="$(date +'%s')"
+      echo_time_diff "$module init" "$module_init_start_time" "$module_init_end_time"
+    fi
+  done
+  # Ganglia's init.sh installs its packages only where they are missing, i.e. on new slaves
+  if [[ $MODULES =~ ganglia ]]; then
+    MODULES_TO_INIT="ganglia"
+  fi
+else
+  MODULES_TO_INIT=$MODULES
+fi
+for module in $MODULES_TO_INIT; do
   echo "Initializing $module"
   module_init_start_time="$(date +'%s')"
   if [[ -e $module/init.sh ]]; then